@@ -1,5 +1,8 @@
 import codon_counts
 import coverage
 import expression
+import gene_arrays
+import ragged_counts
 import read_positions
 import RPKMs
+import step_profile
@@ -10,11 +10,25 @@ def read_file(file_name):
 
     return stratified_mean_enrichments
 
+def read_group(group):
+    ''' Unlike read_file, loads every array into memory so that the file can
+        be closed.
+    '''
+    num_around = group.attrs['num_around']
+    arrays = {condition: {key: group[condition][key][...] for key in group[condition]}
+              for condition in group}
+    stratified_mean_enrichments = pausing.StratifiedMeanEnrichments(num_around, arrays)
+
+    return stratified_mean_enrichments
+
+def write_group(stratified_mean_enrichments, group):
+    group.attrs['num_around'] = stratified_mean_enrichments.num_around
+
+    for condition in stratified_mean_enrichments.arrays:
+        group.create_group(condition)
+        for key in stratified_mean_enrichments.arrays[condition]:
+            group[condition][key] = stratified_mean_enrichments.arrays[condition][key]
+
 def write_file(stratified_mean_enrichments, file_name):
     with h5py.File(file_name, 'w') as hdf5_file:
-        hdf5_file.attrs['num_around'] = stratified_mean_enrichments.num_around
-
-        for condition in stratified_mean_enrichments.arrays:
-            hdf5_file.create_group(condition)
-            for key in stratified_mean_enrichments.arrays[condition]:
-                hdf5_file[condition][key] = stratified_mean_enrichments.arrays[condition][key]
+        write_group(stratified_mean_enrichments, hdf5_file)
@@ -0,0 +1,97 @@
+''' Per-gene values stored as dense HDF5 arrays aligned to a sorted list of
+    gene names instead of one text line per gene. Holds either one number
+    per gene (RPKMs) or a dictionary of fields per gene (read counts), with
+    each field stacked into an array whose first axis is genes.
+    Datasets are contiguous and uncompressed so they can be memory-mapped.
+'''
+
+import h5py
+import numpy as np
+
+def memmap_dataset(dataset, file_name):
+    ''' A read-only memory map of a contiguous dataset, or its contents if
+        it has no storage to map (e.g. because it is empty).
+    '''
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return dataset[...]
+    else:
+        return np.memmap(file_name, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+def write_file(data, file_name):
+    gene_names = sorted(data)
+    with h5py.File(file_name, 'w') as hdf5_file:
+        hdf5_file['gene_names'] = np.array(gene_names, dtype=str)
+
+        if gene_names and isinstance(data[gene_names[0]], dict):
+            hdf5_file.attrs['per_gene'] = 'fields'
+            for key in data[gene_names[0]]:
+                hdf5_file[key] = np.array([data[name][key] for name in gene_names])
+        else:
+            hdf5_file.attrs['per_gene'] = 'value'
+            hdf5_file['values'] = np.array([data[name] for name in gene_names], float)
+
+def read_arrays(file_name, memmap=True):
+    ''' Returns the list of gene names and a dictionary of arrays whose first
+        axis is aligned to it. With memmap=True, the arrays are memory maps
+        into file_name rather than copies.
+    '''
+    with h5py.File(file_name, 'r') as hdf5_file:
+        gene_names = list(hdf5_file['gene_names'][...])
+        arrays = {}
+        for key in hdf5_file:
+            if key == 'gene_names':
+                continue
+            if memmap:
+                arrays[key] = memmap_dataset(hdf5_file[key], file_name)
+            else:
+                arrays[key] = hdf5_file[key][...]
+        per_gene = hdf5_file.attrs['per_gene']
+
+    return gene_names, arrays, per_gene
+
+def read_file(file_name):
+    ''' Returns the same dictionary that was written. '''
+    gene_names, arrays, per_gene = read_arrays(file_name, memmap=False)
+    genes = {}
+    for i, name in enumerate(gene_names):
+        if per_gene == 'fields':
+            genes[name] = {key: arrays[key][i] for key in arrays}
+        else:
+            genes[name] = float(arrays['values'][i])
+
+    return genes
+
+def read_matrix(file_names, key='values', column=None, gene_names=None):
+    ''' Stacks the key arrays of several files into a (genes x files) matrix
+        without building per-gene dictionaries. Rows follow gene_names if
+        given, otherwise the gene order of the first file. If key has more
+        than one value per gene, column picks one of them.
+    '''
+    columns = []
+    for file_name in file_names:
+        file_gene_names, arrays, _ = read_arrays(file_name)
+        values = arrays[key]
+        if column is not None:
+            values = values[:, column]
+
+        if gene_names is None:
+            gene_names = file_gene_names
+
+        if file_gene_names == gene_names:
+            columns.append(np.asarray(values))
+        else:
+            index = {name: i for i, name in enumerate(file_gene_names)}
+            rows = [index[name] for name in gene_names]
+            columns.append(values[rows])
+
+    matrix = np.array(columns).T
+    return gene_names, matrix
+
+def combine_data(first_data, second_data):
+    for gene in second_data:
+        if gene not in first_data:
+            first_data[gene] = second_data[gene]
+        else:
+            raise ValueError
+    return first_data
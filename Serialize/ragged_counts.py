@@ -0,0 +1,52 @@
+''' Codon counts for every gene stored as one contiguous HDF5 array of
+    values, with the offset of each gene's counts in it, instead of one text
+    line per gene. The concatenated values can be memory-mapped.
+'''
+
+import h5py
+import numpy as np
+from gene_arrays import memmap_dataset
+
+def write_file(codon_counts, file_name):
+    gene_names = sorted(codon_counts)
+    lengths = [len(codon_counts[name]) for name in gene_names]
+    offsets = np.zeros(len(gene_names) + 1, int)
+    offsets[1:] = np.cumsum(lengths)
+
+    if gene_names:
+        values = np.concatenate([np.asarray(codon_counts[name]) for name in gene_names])
+    else:
+        values = np.zeros(0, int)
+
+    with h5py.File(file_name, 'w') as hdf5_file:
+        hdf5_file['gene_names'] = np.array(gene_names, dtype=str)
+        hdf5_file['offsets'] = offsets
+        hdf5_file['values'] = values
+
+def read_arrays(file_name, memmap=True):
+    ''' Returns the list of gene names, the offsets of each gene's counts
+        (with one more entry than genes), and the concatenated counts.
+    '''
+    with h5py.File(file_name, 'r') as hdf5_file:
+        gene_names = list(hdf5_file['gene_names'][...])
+        offsets = hdf5_file['offsets'][...]
+        if memmap:
+            values = memmap_dataset(hdf5_file['values'], file_name)
+        else:
+            values = hdf5_file['values'][...]
+
+    return gene_names, offsets, values
+
+def read_file(file_name):
+    gene_names, offsets, values = read_arrays(file_name, memmap=False)
+    genes = {name: values[start:end]
+             for name, start, end in zip(gene_names, offsets, offsets[1:])}
+    return genes
+
+def combine_data(first_data, second_data):
+    for gene in second_data:
+        if gene not in first_data:
+            first_data[gene] = second_data[gene]
+        else:
+            first_data[gene] += second_data[gene]
+    return first_data
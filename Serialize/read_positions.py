@@ -35,31 +35,38 @@ def build_gene(group, specific_keys=None):
                                             )
     return gene
 
-def read_file(file_name, specific_keys=None, show_progress=False):
+def read_group(group, specific_keys=None, show_progress=False):
     genes = {}
+    gene_names = group.keys()
+    if show_progress:
+        gene_names = utilities.progress_bar(len(gene_names), gene_names)
+    for gene_name in gene_names:
+        genes[gene_name] = build_gene(group[gene_name], specific_keys)
+    return genes
+
+def read_file(file_name, specific_keys=None, show_progress=False):
     with h5py.File(file_name, 'r') as hdf5_file:
-        gene_names = hdf5_file.keys()
-        if show_progress:
-            gene_names = utilities.progress_bar(len(gene_names), gene_names)
-        for gene_name in gene_names:
-            genes[gene_name] = build_gene(hdf5_file[gene_name], specific_keys)
+        genes = read_group(hdf5_file, specific_keys, show_progress)
     return genes
 
-def write_file(genes, file_name):
-    with h5py.File(file_name, 'w') as hdf5_file:
-        for gene_name in genes:
-            gene_group = hdf5_file.create_group(gene_name)
-            for key in genes[gene_name]:
-                position_counts = genes[gene_name][key]
-                # HDF5 names must be strings
-                key = str(key)
+def write_group(genes, group):
+    for gene_name in genes:
+        gene_group = group.create_group(gene_name)
+        for key in genes[gene_name]:
+            position_counts = genes[gene_name][key]
+            # HDF5 names must be strings
+            key = str(key)
+
+            gene_group[key] = np.asarray(position_counts.data)
 
-                gene_group[key] = np.asarray(position_counts.data)
+            gene_group[key].attrs['left_buffer'] = position_counts.left_buffer
+            gene_group[key].attrs['right_buffer'] = position_counts.right_buffer
+            for name, value in position_counts.landmarks.items():
+                gene_group[key].attrs[name] = value
 
-                gene_group[key].attrs['left_buffer'] = position_counts.left_buffer
-                gene_group[key].attrs['right_buffer'] = position_counts.right_buffer
-                for name, value in position_counts.landmarks.items():
-                    gene_group[key].attrs[name] = value
+def write_file(genes, file_name):
+    with h5py.File(file_name, 'w') as hdf5_file:
+        write_group(genes, hdf5_file)
 
 def combine_data(first_genes, second_genes):
     for gene_name in second_genes:
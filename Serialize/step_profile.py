@@ -0,0 +1,30 @@
+''' Resource usage records of experiment steps, one JSON object per line so
+    that steps running at the same time can append to the same file.
+'''
+
+import os
+import json
+
+def record_line(record):
+    return json.dumps(record, sort_keys=True) + '\n'
+
+def write_file(records, file_name):
+    with open(file_name, 'w') as fh:
+        for record in records:
+            fh.write(record_line(record))
+
+def append_record(record, file_name):
+    # A single write to a file opened for appending, so lines from
+    # concurrent writers don't interleave.
+    fd = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, record_line(record))
+    finally:
+        os.close(fd)
+
+def read_file(file_name):
+    records = [json.loads(line) for line in open(file_name) if line.strip()]
+    return records
+
+def combine_data(first_data, second_data):
+    return first_data + second_data
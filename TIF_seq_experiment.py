@@ -22,6 +22,7 @@ orientations = ['R1_forward', 'R1_reverse', 'R2_forward', 'R2_reverse']
 
 class TIFSeqExperiment(rna_experiment.RNAExperiment):
     num_stages = 2
+    cost_bam_key = 'combined_extended'
 
     specific_results_files = [
         ('five_prime_boundaries', 'fastq', '{name}_five_prime_boundaries.fastq'),
@@ -9,6 +9,7 @@ import rna_experiment
 
 class TLSeqExperiment(rna_experiment.RNAExperiment):
     num_stages = 2
+    cost_bam_key = 'bam'
 
     specific_results_files = [
         ('bam', 'bam', '{name}.bam'),
@@ -0,0 +1,36 @@
+''' Caches dictionaries of arrays in .npz files, together with a repr of the
+    parameters they were computed from. A cache whose parameters don't match
+    is recomputed, and a cache that can't be read or written is ignored.
+'''
+
+import os
+import zipfile
+import numpy as np
+
+def load_or_compute(cache_fn, parameters, compute):
+    ''' Returns the arrays saved in cache_fn if they were computed from
+        parameters, otherwise calls compute() and tries to save what it
+        returns to cache_fn. If cache_fn is None, nothing is cached.
+    '''
+    parameters = repr(parameters)
+
+    if cache_fn is not None and os.path.exists(cache_fn):
+        try:
+            with np.load(cache_fn) as loaded:
+                if 'parameters' in loaded.files and str(loaded['parameters']) == parameters:
+                    return {key: loaded[key] for key in loaded.files if key != 'parameters'}
+        except (IOError, ValueError, zipfile.BadZipfile):
+            pass
+
+    arrays = compute()
+
+    if cache_fn is not None:
+        try:
+            # Saving to an open file keeps np.savez from adding '.npz' to
+            # cache_fn.
+            with open(cache_fn, 'wb') as fh:
+                np.savez(fh, parameters=parameters, **arrays)
+        except (IOError, OSError):
+            pass
+
+    return arrays
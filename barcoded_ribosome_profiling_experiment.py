@@ -107,6 +107,9 @@ class BarcodedRibosomeProfilingExperiment(RibosomeProfilingExperiment):
                         self.cleanup[1] + specific_cleanup[2],
                        ]
 
+        if self.profile_steps:
+            self.profile_stages()
+
         self.make_file_names()
 
         self.genome_index = genomes.get_genome_index(self.file_names['genome'])
@@ -0,0 +1,349 @@
+''' Times the hot paths of the pipeline on data from synthetic_data and
+    appends the results to a history file, so that the effect of performance
+    work can be measured and regressions caught. Each run is compared to the
+    latest earlier run on the same host with the same synthetic data.
+
+    python benchmark.py work_dir [--only trim_linker ...] [--repeats 3]
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import h5py
+import numpy as np
+import pysam
+import Sequencing.fastq as fastq
+import Sequencing.genomes as genomes
+import codons
+import gff
+import positions
+import trim
+import pausing
+import simulate
+import synthetic_data
+from Serialize import (read_positions,
+                       codon_counts,
+                       ragged_counts,
+                       gene_arrays,
+                       enrichments,
+                      )
+
+relevant_lengths = range(27, 32)
+offset_type = 'yeast'
+
+class Inputs(object):
+    ''' Intermediate results that benchmarks need, computed (untimed) the
+        first time they are asked for.
+    '''
+    def __init__(self, file_names, work_dir):
+        self.file_names = file_names
+        self.work_dir = work_dir
+        self.cache = {}
+
+    def cached(self, key, compute):
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    def reads(self, adapter_type):
+        fastq_fn = self.file_names['fastq'][adapter_type]
+        return self.cached(('reads', adapter_type), lambda: list(fastq.reads(fastq_fn)))
+
+    def mappings(self):
+        return self.cached('mappings', lambda: list(pysam.Samfile(self.file_names['bam'])))
+
+    def CDSs(self):
+        def compute():
+            return gff.get_CDSs(self.file_names['genes'], self.file_names['genome'], annotate_nearby=True)
+        return self.cached('CDSs', compute)
+
+    def max_gene_length(self):
+        def compute():
+            max_gene_length = 0
+            for CDS in self.CDSs():
+                CDS.build_coordinate_maps()
+                max_gene_length = max(max_gene_length, CDS.transcript_length)
+                CDS.delete_coordinate_maps()
+            return max_gene_length
+        return self.cached('max_gene_length', compute)
+
+    def read_positions(self):
+        def compute():
+            gene_infos = positions.get_Transcript_position_counts(self.file_names['bam'],
+                                                                  self.CDSs(),
+                                                                  relevant_lengths,
+                                                                 )
+            return positions.gene_infos_to_read_positions(gene_infos)
+        return self.cached('read_positions', compute)
+
+    def buffered_codon_counts(self):
+        def compute():
+            return positions.compute_buffered_codon_counts(self.read_positions(), offset_type)
+        return self.cached('buffered_codon_counts', compute)
+
+    def codon_counts(self):
+        def compute():
+            return positions.extract_CDS_codon_counts(self.buffered_codon_counts(), 'relaxed')
+        return self.cached('codon_counts', compute)
+
+    def enrichments(self):
+        def compute():
+            return pausing.fast_stratified_mean_enrichments(self.buffered_codon_counts(),
+                                                            [(90, 90)],
+                                                            [0.1],
+                                                            100,
+                                                            count_type='relaxed',
+                                                           )
+        return self.cached('enrichments', compute)
+
+    def temp_fn(self, name):
+        return '{0}/{1}'.format(self.work_dir, name)
+
+# Each benchmark takes Inputs and returns a function to time, which returns
+# the number of records it processed.
+
+def trim_linker(inputs):
+    reads = inputs.reads('linker')
+    def run():
+        return sum(1 for _ in trim.bound_trim['linker'](reads))
+    return run
+
+def trim_polyA(inputs):
+    reads = inputs.reads('polyA')
+    def run():
+        return sum(1 for _ in trim.bound_trim['polyA'](reads))
+    return run
+
+def trim_mismatches_from_start(inputs):
+    mappings = inputs.mappings()
+    bam_file = pysam.Samfile(inputs.file_names['bam'])
+    region_fetcher = genomes.build_region_fetcher(inputs.file_names['genome'],
+                                                  load_references=True,
+                                                  sam_file=bam_file,
+                                                 )
+    type_shape = (synthetic_data.read_length + 1,
+                  synthetic_data.read_length,
+                  fastq.MAX_EXPECTED_QUAL + 1,
+                  6,
+                  6,
+                 )
+    def run():
+        type_counts = np.zeros(type_shape, int)
+        for mapping in mappings:
+            trim.trim_mismatches_from_start(mapping, region_fetcher, type_counts)
+        return len(mappings)
+    return run
+
+def get_Transcript_position_counts(inputs):
+    CDSs = inputs.CDSs()
+    def run():
+        gene_infos = positions.get_Transcript_position_counts(inputs.file_names['bam'],
+                                                              CDSs,
+                                                              relevant_lengths,
+                                                             )
+        return len(gene_infos)
+    return run
+
+def compute_codon_counts(inputs):
+    all_read_positions = inputs.read_positions()
+    def run():
+        return len(positions.compute_buffered_codon_counts(all_read_positions, offset_type))
+    return run
+
+def compute_metagene_positions(inputs):
+    CDSs = inputs.CDSs()
+    all_read_positions = inputs.read_positions()
+    max_gene_length = inputs.max_gene_length()
+    def run():
+        positions.compute_metagene_positions(CDSs, all_read_positions, max_gene_length)
+        return len(CDSs)
+    return run
+
+def fast_stratified_mean_enrichments(inputs):
+    buffered_codon_counts = inputs.buffered_codon_counts()
+    def run():
+        pausing.fast_stratified_mean_enrichments(buffered_codon_counts,
+                                                 [(90, 90)],
+                                                 [0.1],
+                                                 100,
+                                                 count_type='relaxed',
+                                                )
+        return len(buffered_codon_counts)
+    return run
+
+def round_trip(module, data, fn):
+    def run():
+        module.write_file(data, fn)
+        module.read_file(fn)
+        return len(data)
+    return run
+
+def serialize_read_positions(inputs):
+    return round_trip(read_positions, inputs.read_positions(), inputs.temp_fn('read_positions.hdf5'))
+
+def serialize_codon_counts(inputs):
+    return round_trip(codon_counts, inputs.codon_counts(), inputs.temp_fn('codon_counts.txt'))
+
+def serialize_ragged_counts(inputs):
+    return round_trip(ragged_counts, inputs.codon_counts(), inputs.temp_fn('codon_counts.hdf5'))
+
+def serialize_read_counts(inputs):
+    read_counts = positions.compute_read_counts(inputs.read_positions(), 0, 0)
+    return round_trip(gene_arrays, read_counts, inputs.temp_fn('read_counts.hdf5'))
+
+def serialize_enrichments(inputs):
+    stratified_mean_enrichments = inputs.enrichments()
+    fn = inputs.temp_fn('enrichments.hdf5')
+    def run():
+        enrichments.write_file(stratified_mean_enrichments, fn)
+        # read_group, unlike read_file, doesn't leave the file open.
+        with h5py.File(fn, 'r') as hdf5_file:
+            enrichments.read_group(hdf5_file)
+        return 1
+    return run
+
+def simulate_Message(inputs, num_messages=20, num_codons=300):
+    random_state = np.random.RandomState(0)
+    codon_means = {codon: mean for codon, mean in zip(codons.all_codons, random_state.gamma(2, 0.05, size=len(codons.all_codons)))}
+    codon_sequences = [list(random_state.choice(codons.non_stop_codons, size=num_codons)) for _ in range(num_messages)]
+    def run():
+        # Message draws from numpy's global random state.
+        np.random.seed(0)
+        num_events = 0
+        for codon_sequence in codon_sequences:
+            message = simulate.Message(codon_sequence, 5., codon_means, 10.)
+            message.evolve_to_steady_state()
+            message.introduce_CHX()
+            message.collect_measurements()
+            num_events += message.current_event_number
+        return num_events
+    return run
+
+benchmarks = [trim_linker,
+              trim_polyA,
+              trim_mismatches_from_start,
+              get_Transcript_position_counts,
+              compute_codon_counts,
+              compute_metagene_positions,
+              fast_stratified_mean_enrichments,
+              serialize_read_positions,
+              serialize_codon_counts,
+              serialize_ragged_counts,
+              serialize_read_counts,
+              serialize_enrichments,
+              simulate_Message,
+             ]
+
+def time_benchmark(benchmark, inputs, repeats):
+    run = benchmark(inputs)
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        num_records = run()
+        times.append(time.time() - start)
+
+    result = {'best': min(times),
+              'median': float(np.median(times)),
+              'records': num_records,
+             }
+    return result
+
+def git_commit():
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=code_dir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return commit
+
+def read_history(history_fn):
+    if os.path.exists(history_fn):
+        history = [json.loads(line) for line in open(history_fn) if line.strip()]
+    else:
+        history = []
+    return history
+
+def append_to_history(run, history_fn):
+    with open(history_fn, 'a') as history_fh:
+        history_fh.write(json.dumps(run, sort_keys=True) + '\n')
+
+def find_regressions(previous, run, threshold):
+    ''' Benchmarks whose best time in run is at least threshold times their
+        best time in previous, as (name, previous time, time).
+    '''
+    regressions = []
+    for name, result in sorted(run['results'].items()):
+        if name in previous['results']:
+            previous_time = previous['results'][name]['best']
+            if result['best'] >= threshold * previous_time:
+                regressions.append((name, previous_time, result['best']))
+    return regressions
+
+def run_benchmarks(work_dir, names=None, repeats=3, seed=0, num_genes=300, num_reads=100000, threshold=1.2):
+    ''' Runs the benchmarks in names (or all of them), appends the results to
+        work_dir/history.jsonl, and returns them along with any regressions
+        relative to the previous comparable run.
+    '''
+    data = {'seed': seed,
+            'num_genes': num_genes,
+            'num_reads': num_reads,
+           }
+    file_names = synthetic_data.make_all('{0}/data'.format(work_dir), **data)
+    inputs = Inputs(file_names, work_dir)
+
+    run = {'time': time.time(),
+           'commit': git_commit(),
+           'host': socket.gethostname(),
+           'data': data,
+           'repeats': repeats,
+           'results': {},
+          }
+
+    for benchmark in benchmarks:
+        name = benchmark.__name__
+        if names and name not in names:
+            continue
+        run['results'][name] = time_benchmark(benchmark, inputs, repeats)
+        result = run['results'][name]
+        print '{0:<35} {1:>9.3f} s {2:>12,.0f} records/s'.format(name, result['best'], result['records'] / max(result['best'], 1e-9))
+
+    history_fn = '{0}/history.jsonl'.format(work_dir)
+    comparable = [r for r in read_history(history_fn) if r['host'] == run['host'] and r['data'] == data]
+    if comparable:
+        regressions = find_regressions(comparable[-1], run, threshold)
+    else:
+        regressions = []
+
+    append_to_history(run, history_fn)
+
+    return run, regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('work_dir', help='where synthetic data and the history of results are kept')
+    parser.add_argument('--only', nargs='+', help='names of benchmarks to run', choices=[b.__name__ for b in benchmarks])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num_genes', type=int, default=300)
+    parser.add_argument('--num_reads', type=int, default=100000)
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown relative to the previous run reported as a regression')
+    args = parser.parse_args()
+
+    run, regressions = run_benchmarks(args.work_dir.rstrip('/'),
+                                      names=args.only,
+                                      repeats=args.repeats,
+                                      seed=args.seed,
+                                      num_genes=args.num_genes,
+                                      num_reads=args.num_reads,
+                                      threshold=args.threshold,
+                                     )
+
+    for name, previous_time, current_time in regressions:
+        print 'regression: {0} took {1:.3f} s, up from {2:.3f} s'.format(name, current_time, previous_time)
+
+    if regressions:
+        sys.exit(1)
@@ -1,6 +1,7 @@
 import Bio.Data.CodonTable
 import copy
 import string
+import numpy as np
 
 nucleotide_order = 'TCAG'
 nucleotide_to_index = {b: i for i, b in enumerate(nucleotide_order)}
@@ -40,6 +41,44 @@ def codons_from_seq(seq):
     for i in range(0, len(seq), 3):
         yield seq[i:i + 3]
 
+# Characters outside of nucleotide_order are encoded as len(nucleotide_order),
+# and codons containing any such character as len(all_codons).
+unknown_nucleotide_index = len(nucleotide_order)
+unknown_codon_index = len(all_codons)
+
+nucleotide_lookup = np.empty(256, dtype=np.uint8)
+nucleotide_lookup[:] = unknown_nucleotide_index
+for b, i in nucleotide_to_index.items():
+    nucleotide_lookup[ord(b)] = i
+
+def encode_nucleotides(seq):
+    ''' Returns a uint8 array of the indices in nucleotide_order of the
+        characters of seq.
+    '''
+    as_bytes = np.frombuffer(seq, dtype=np.uint8)
+    return nucleotide_lookup[as_bytes]
+
+def encode_codons(codon_identities):
+    ''' Returns a uint8 array of the indices in all_codons of each codon in
+        codon_identities.
+    '''
+    as_strings = np.asarray(codon_identities, dtype='S3')
+    as_bytes = as_strings.view(np.uint8).reshape(len(as_strings), 3)
+    indices = nucleotide_lookup[as_bytes]
+    encoded = 16 * indices[:, 0] + 4 * indices[:, 1] + indices[:, 2]
+    unknown = (indices == unknown_nucleotide_index).any(axis=1)
+    encoded[unknown] = unknown_codon_index
+    return encoded
+
+def make_codon_mask(codon_set):
+    ''' Returns a boolean array indexed by encoded codon that is True for
+        the codons in codon_set.
+    '''
+    mask = np.zeros(len(all_codons) + 1, dtype=bool)
+    for codon in codon_set:
+        mask[codon_to_index[codon]] = True
+    return mask
+
 anticodon_to_codons = {
     'IGC': {'GCU', 'GCC'},
     'UGC': {'GCA', 'GCG'},
@@ -0,0 +1,139 @@
+''' Stand-ins for experiments that defer building the experiment object
+    until something needs it. Building an experiment globs its data files
+    and, unless max_read_length is given in its description, opens every
+    FASTQ file, so building every experiment on disk up front is slow.
+
+    Values derived while building (max_read_length, file_names,
+    figure_file_names) are remembered in an index file keyed by description
+    file name. They are reused until the description file is modified or
+    the source of the experiment class, which determines the file names,
+    changes.
+'''
+
+import os
+import json
+import hashlib
+import inspect
+import rna_experiment
+
+cached_attributes = ['max_read_length',
+                     'file_names',
+                     'figure_file_names',
+                    ]
+
+code_versions = {}
+
+def code_version(experiment_class):
+    ''' A digest of the source files of experiment_class and its bases. '''
+    if experiment_class not in code_versions:
+        digest = hashlib.sha1()
+        for cls in inspect.getmro(experiment_class):
+            try:
+                source_fn = inspect.getsourcefile(cls)
+            except TypeError:
+                # Built-in classes have no source.
+                continue
+            if source_fn is not None:
+                digest.update(open(source_fn).read())
+        code_versions[experiment_class] = digest.hexdigest()
+
+    return code_versions[experiment_class]
+
+def parse_description(description_file_name):
+    ''' Description files have one 'key value' pair per line. '''
+    description = {}
+    for line in open(description_file_name):
+        line = line.strip()
+        if line:
+            key, value = line.split(' ', 1)
+            description[key] = value
+    return description
+
+def read_index(index_fn):
+    if index_fn is not None and os.path.exists(index_fn):
+        index = json.load(open(index_fn))
+    else:
+        index = {}
+    return index
+
+def write_index(index, index_fn):
+    if index_fn is None:
+        return
+
+    # Write then rename so that an interrupted write doesn't lose the index.
+    temp_fn = index_fn + '.tmp'
+    with open(temp_fn, 'w') as index_fh:
+        json.dump(index, index_fh, indent=1, sort_keys=True)
+    os.rename(temp_fn, index_fn)
+
+class LazyExperiment(object):
+    def __init__(self, experiment_class, description_file_name, index, index_fn=None):
+        # Attributes of the stand-in itself are set through __dict__ to
+        # avoid __setattr__, which forwards to the experiment.
+        self.__dict__.update(_experiment_class=experiment_class,
+                             _description_file_name=description_file_name,
+                             _index=index,
+                             _index_fn=index_fn,
+                             _description=None,
+                             _experiment=None,
+                            )
+
+    @property
+    def description(self):
+        if self._description is None:
+            self.__dict__['_description'] = parse_description(self._description_file_name)
+        return self._description
+
+    def index_entry(self):
+        ''' The index's entry for this experiment, if it is up to date. '''
+        entry = self._index.get(self._description_file_name)
+        mtime = os.path.getmtime(self._description_file_name)
+        if entry is not None and \
+           entry['mtime'] == mtime and \
+           entry.get('code_version') == code_version(self._experiment_class):
+            return entry
+        else:
+            return None
+
+    def build(self):
+        if self._experiment is None:
+            entry = self.index_entry()
+            if entry is not None and 'data_dir' in self.description:
+                data_dir = self.description['data_dir'].rstrip('/')
+                rna_experiment.known_max_read_lengths[data_dir] = entry['max_read_length']
+
+            experiment = self._experiment_class.from_description_file_name(self._description_file_name)
+            self.__dict__['_experiment'] = experiment
+
+            if entry is None:
+                entry = {'mtime': os.path.getmtime(self._description_file_name),
+                         'code_version': code_version(self._experiment_class),
+                        }
+                for attribute in cached_attributes:
+                    entry[attribute] = getattr(experiment, attribute, None)
+                self._index[self._description_file_name] = entry
+                write_index(self._index, self._index_fn)
+
+        return self._experiment
+
+    def __getattr__(self, attribute):
+        if self._experiment is None:
+            if attribute in ['name', 'group'] and attribute in self.description:
+                return self.description[attribute]
+
+            if attribute in cached_attributes:
+                entry = self.index_entry()
+                if entry is not None:
+                    return entry[attribute]
+
+        return getattr(self.build(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self.build(), attribute, value)
+
+    def __repr__(self):
+        if self._experiment is None:
+            state = 'not built'
+        else:
+            state = 'built'
+        return '<LazyExperiment {0} ({1})>'.format(self._description_file_name, state)
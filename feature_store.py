@@ -0,0 +1,245 @@
+''' One HDF5 file of gene-level results across experiments, so that
+    cross-study analyses read one file instead of building every experiment
+    and parsing its files.
+
+    Every experiment gets a column of the genes x experiments matrices
+    'read_counts' and 'RPKMs' and a row of each experiments x offsets x codons
+    array 'enrichments/<condition>/<feature>'. 'TEs' is a genes x TEs matrix
+    of named RPF/mRNA pairs. Genes and experiments are appended to their axes
+    as they are first seen, and entries that have not been filled in are nan.
+    Writers hold an exclusive lock on the store, since the cleanup of many
+    experiments may finish at once, and readers hold a shared lock so that
+    they never see a half-written store.
+'''
+
+import fcntl
+import contextlib
+import h5py
+import numpy as np
+from pausing_cython import make_hdf5_key, StratifiedMeanEnrichments
+
+name_dtype = h5py.special_dtype(vlen=str)
+
+# The axes of each matrix.
+axes = {'read_counts': ('gene_names', 'experiment_names'),
+        'RPKMs': ('gene_names', 'experiment_names'),
+        'TEs': ('gene_names', 'TE_names'),
+       }
+
+@contextlib.contextmanager
+def locked_store(store_fn, mode='a'):
+    ''' Opens store_fn holding a shared lock if mode is 'r' and an exclusive
+        lock otherwise.
+    '''
+    if mode == 'r':
+        operation = fcntl.LOCK_SH
+    else:
+        operation = fcntl.LOCK_EX
+
+    with open(store_fn + '.lock', 'a') as lock_fh:
+        fcntl.flock(lock_fh, operation)
+        try:
+            with h5py.File(store_fn, mode) as store:
+                yield store
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+def full_name(experiment):
+    return '{0}:{1}'.format(experiment.group, experiment.name)
+
+def get_names(store, axis):
+    if axis in store:
+        return list(store[axis][...])
+    else:
+        return []
+
+def get_indices(store, axis, names):
+    ''' Indices of names along axis, appending any that are new. '''
+    if axis not in store:
+        store.create_dataset(axis, (0,), dtype=name_dtype, maxshape=(None,))
+
+    existing = get_names(store, axis)
+    index = {name: i for i, name in enumerate(existing)}
+    new_names = [name for name in names if name not in index]
+    if new_names:
+        dataset = store[axis]
+        dataset.resize((len(existing) + len(new_names),))
+        dataset[len(existing):] = new_names
+        for i, name in enumerate(new_names):
+            index[name] = len(existing) + i
+
+    return np.array([index[name] for name in names], int)
+
+def get_dataset(store, key, shape):
+    ''' The dataset key, created or grown to at least shape. '''
+    if key not in store:
+        store.create_dataset(key,
+                             shape,
+                             dtype=float,
+                             maxshape=(None,)*len(shape),
+                             chunks=True,
+                             fillvalue=np.nan,
+                            )
+    dataset = store[key]
+    if dataset.shape != shape:
+        dataset.resize(shape)
+    return dataset
+
+def set_column(store, key, column_name, values):
+    ''' Writes the dictionary values (gene name -> value) as column_name of
+        the matrix key.
+    '''
+    gene_axis, column_axis = axes[key]
+    gene_names = sorted(values)
+    rows = get_indices(store, gene_axis, gene_names)
+    column = get_indices(store, column_axis, [column_name])[0]
+
+    shape = (len(store[gene_axis]), len(store[column_axis]))
+    dataset = get_dataset(store, key, shape)
+
+    full_column = np.full(shape[0], np.nan)
+    full_column[rows] = [values[name] for name in gene_names]
+    dataset[:, column] = full_column
+
+def set_enrichments(store, experiment_name, stratified_mean_enrichments):
+    row = get_indices(store, 'experiment_names', [experiment_name])[0]
+    num_experiments = len(store['experiment_names'])
+
+    for condition in stratified_mean_enrichments.arrays:
+        for feature in stratified_mean_enrichments.arrays[condition]:
+            array = stratified_mean_enrichments.arrays[condition][feature][()]
+            key = 'enrichments/{0}/{1}'.format(condition, feature)
+            dataset = get_dataset(store, key, (num_experiments,) + array.shape)
+            dataset.attrs['num_around'] = stratified_mean_enrichments.num_around
+            dataset[row] = array
+
+def update_experiment(store_fn,
+                      experiment_name,
+                      read_counts=None,
+                      RPKMs=None,
+                      stratified_mean_enrichments=None,
+                     ):
+    ''' Replaces experiment_name's entries with whichever of read_counts (as
+        written by compute_total_read_counts), RPKMs, and
+        stratified_mean_enrichments are given.
+    '''
+    with locked_store(store_fn) as store:
+        if read_counts is not None:
+            counts = {name: read_counts[name]['expression'][0] for name in read_counts}
+            set_column(store, 'read_counts', experiment_name, counts)
+
+            # CDS lengths are a property of the annotation, not the
+            # experiment, so they are a single vector along the gene axis.
+            CDS_lengths = {name: read_counts[name]['CDS_length'] for name in read_counts}
+            gene_names = sorted(CDS_lengths)
+            rows = get_indices(store, 'gene_names', gene_names)
+            dataset = get_dataset(store, 'CDS_lengths', (len(store['gene_names']),))
+            lengths = dataset[...]
+            lengths[rows] = [CDS_lengths[name] for name in gene_names]
+            dataset[...] = lengths
+
+        if RPKMs is not None:
+            set_column(store, 'RPKMs', experiment_name, RPKMs)
+
+        if stratified_mean_enrichments is not None:
+            set_enrichments(store, experiment_name, stratified_mean_enrichments)
+
+def compute_TEs(store, RPF_experiment_name, mRNA_experiment_name):
+    ''' Computes TEs from the stored read counts of an RPF and an mRNA
+        experiment the way pausing.load_TEs does.
+    '''
+    def to_RPKMs(counts, CDS_lengths):
+        total = np.nansum(counts)
+        return np.maximum(0.1, (1.e9 / total) * counts / CDS_lengths)
+
+    gene_names, experiment_names, read_counts = matrix_from_store(store, 'read_counts')
+    CDS_lengths = vector_from_store(store, 'CDS_lengths')
+    RPF_counts = read_counts[:, experiment_names.index(RPF_experiment_name)]
+    mRNA_counts = read_counts[:, experiment_names.index(mRNA_experiment_name)]
+
+    with np.errstate(invalid='ignore'):
+        TEs = to_RPKMs(RPF_counts, CDS_lengths) / to_RPKMs(mRNA_counts, CDS_lengths)
+    TEs = {name: TE for name, TE in zip(gene_names, TEs) if not np.isnan(TE)}
+    return TEs
+
+def update_TEs(store_fn, TE_name, RPF_experiment_name, mRNA_experiment_name):
+    ''' Computes TEs from the stored read counts of an RPF and an mRNA
+        experiment, stores them as TE_name and returns them.
+    '''
+    with locked_store(store_fn) as store:
+        TEs = compute_TEs(store, RPF_experiment_name, mRNA_experiment_name)
+        set_column(store, 'TEs', TE_name, TEs)
+
+    return TEs
+
+def has_experiments(store_fn, experiment_names):
+    with locked_store(store_fn, 'r') as store:
+        stored_names = set(get_names(store, 'experiment_names'))
+    return all(name in stored_names for name in experiment_names)
+
+def vector_from_store(store, key):
+    vector = store[key][...]
+
+    # Genes may have been added after the vector was last written to.
+    num_genes = len(get_names(store, 'gene_names'))
+    full_vector = np.full(num_genes, np.nan)
+    full_vector[:len(vector)] = vector
+
+    return full_vector
+
+def read_vector(store_fn, key):
+    ''' Returns the values of vector key along the gene axis. '''
+    with locked_store(store_fn, 'r') as store:
+        vector = vector_from_store(store, key)
+    return vector
+
+def matrix_from_store(store, key):
+    gene_axis, column_axis = axes[key]
+    gene_names = get_names(store, gene_axis)
+    column_names = get_names(store, column_axis)
+    matrix = store[key][...]
+
+    # Names may have been added along an axis after the matrix was last
+    # written to.
+    full_matrix = np.full((len(gene_names), len(column_names)), np.nan)
+    full_matrix[:matrix.shape[0], :matrix.shape[1]] = matrix
+
+    return gene_names, column_names, full_matrix
+
+def read_matrix(store_fn, key):
+    ''' Returns the names along both axes of matrix key and its values. '''
+    with locked_store(store_fn, 'r') as store:
+        gene_names, column_names, full_matrix = matrix_from_store(store, key)
+
+    return gene_names, column_names, full_matrix
+
+def read_enrichment_array(store_fn, condition, feature):
+    ''' Returns experiment names and the experiments x offsets x codons array
+        of feature in condition, e.g. read_enrichment_array(fn, (0.1, 90, 90), 'codon').
+    '''
+    key = 'enrichments/{0}/{1}'.format(make_hdf5_key(*condition), feature)
+    with locked_store(store_fn, 'r') as store:
+        experiment_names = get_names(store, 'experiment_names')
+        array = store[key][...]
+
+    full_array = np.full((len(experiment_names),) + array.shape[1:], np.nan)
+    full_array[:len(array)] = array
+
+    return experiment_names, full_array
+
+def read_enrichments(store_fn, experiment_name):
+    ''' The stratified mean enrichments of one experiment, in the form
+        returned by experiment.read_file('stratified_mean_enrichments').
+    '''
+    with locked_store(store_fn, 'r') as store:
+        row = get_names(store, 'experiment_names').index(experiment_name)
+        arrays = {}
+        for condition in store['enrichments']:
+            arrays[condition] = {}
+            for feature in store['enrichments'][condition]:
+                dataset = store['enrichments'][condition][feature]
+                num_around = dataset.attrs['num_around']
+                if row < len(dataset):
+                    arrays[condition][feature] = dataset[row]
+
+    return StratifiedMeanEnrichments(num_around, arrays)
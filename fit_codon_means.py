@@ -0,0 +1,203 @@
+''' Infers codon elongation means and CHX_mean by inverse simulation: search
+    for the parameters whose simulated stratified mean enrichments best match
+    those of a real experiment.
+
+    Every evaluation simulates the same genes with the same random streams
+    (common random numbers), so differences between evaluations come from the
+    parameters rather than from simulation noise, and a gradient-free
+    optimizer (Nelder-Mead) can make progress on the noisy objective. Since
+    each block of a gene's simulation has its own stream, the split of genes
+    into blocks is fixed from the starting means rather than re-estimated
+    from each evaluation's means.
+'''
+
+from __future__ import division
+import logging
+import multiprocessing
+import numpy as np
+import scipy.optimize
+import codons
+import pausing
+import simulation_sweep
+
+fitted_codons = codons.non_stop_codons
+
+def parameters_to_means(parameters, stop_mean=1):
+    ''' parameters are the log means of fitted_codons followed by the log of
+        CHX_mean.
+    '''
+    codon_means = {codon_id: np.exp(value) for codon_id, value in zip(fitted_codons, parameters[:-1])}
+    for codon_id in codons.stop_codons:
+        codon_means[codon_id] = stop_mean
+    CHX_mean = np.exp(parameters[-1])
+    return codon_means, CHX_mean
+
+def means_to_parameters(codon_means, CHX_mean):
+    if CHX_mean <= 0:
+        raise ValueError('CHX_mean must be positive to be fit on a log scale, not {0}'.format(CHX_mean))
+    nonpositive = [codon_id for codon_id in fitted_codons if codon_means[codon_id] <= 0]
+    if nonpositive:
+        raise ValueError('codon means must be positive to be fit on a log scale: {0}'.format(', '.join(nonpositive)))
+
+    log_means = [np.log(codon_means[codon_id]) for codon_id in fitted_codons]
+    return np.array(log_means + [np.log(CHX_mean)])
+
+def enrichment_profiles(stratified_mean_enrichments, condition, offsets):
+    ''' Mean enrichments of fitted_codons at each of offsets from the A site,
+        as an (offsets x codons) array.
+    '''
+    offset_slice = slice(offsets[0], offsets[1] + 1)
+    return stratified_mean_enrichments[condition, 'codon', offset_slice, fitted_codons]
+
+class EvaluationLimitReached(Exception):
+    pass
+
+class InverseSimulation(object):
+    ''' The objective of the fit: the sum of squared differences between
+        simulated and observed codon enrichments at offsets from the A site
+        in condition (min_mean, exclude_from_start, exclude_from_end).
+        Genes are split into the blocks that initial_codon_means (by default
+        the template's) would need for every evaluation. Raises
+        EvaluationLimitReached instead of running more than max_evaluations
+        simulations.
+    '''
+    def __init__(self,
+                 template,
+                 observed_enrichments,
+                 base_point,
+                 condition=(0.1, 90, 90),
+                 offsets=(-10, 10),
+                 seed_prefix='fit',
+                 pool=None,
+                 max_block_cost=1e8,
+                 max_evaluations=None,
+                 initial_codon_means=None,
+                ):
+        self.template = template
+        self.base_point = base_point
+        self.condition = condition
+        self.offsets = offsets
+        self.seed_prefix = seed_prefix
+        self.pool = pool
+        self.max_block_cost = max_block_cost
+        self.max_evaluations = max_evaluations
+        self.num_around = max(abs(offsets[0]), abs(offsets[1]))
+        self.num_blocks = simulation_sweep.block_counts(template,
+                                                        base_point,
+                                                        max_block_cost,
+                                                        codon_means=initial_codon_means,
+                                                       )
+
+        self.observed = enrichment_profiles(observed_enrichments, condition, offsets)
+        self.history = []
+
+    def simulated_profiles(self, codon_means, CHX_mean):
+        point = dict(self.base_point, CHX_mean=CHX_mean)
+        simulated_codon_counts = simulation_sweep.simulate_point(self.template,
+                                                                 point,
+                                                                 self.pool,
+                                                                 self.max_block_cost,
+                                                                 codon_means=codon_means,
+                                                                 seed_prefix=self.seed_prefix,
+                                                                 num_blocks=self.num_blocks,
+                                                                )
+        min_mean, exclude_from_start, exclude_from_end = self.condition
+        enrichments = pausing.fast_stratified_mean_enrichments(simulated_codon_counts,
+                                                               [(exclude_from_start, exclude_from_end)],
+                                                               [min_mean],
+                                                               self.num_around,
+                                                               count_type='relaxed',
+                                                              )
+        return enrichment_profiles(enrichments, self.condition, self.offsets)
+
+    def __call__(self, parameters):
+        if self.max_evaluations is not None and len(self.history) >= self.max_evaluations:
+            raise EvaluationLimitReached
+
+        codon_means, CHX_mean = parameters_to_means(parameters)
+        simulated = self.simulated_profiles(codon_means, CHX_mean)
+        loss = np.sum((simulated - self.observed)**2)
+
+        self.history.append((np.copy(parameters), loss))
+        logging.info('evaluation {0}: loss {1:0.5f}, CHX_mean {2:0.2f}'.format(len(self.history), loss, CHX_mean))
+        return loss
+
+def fit_codon_means(template,
+                    observed_enrichments,
+                    base_point,
+                    initial_codon_means=None,
+                    initial_CHX_mean=None,
+                    condition=(0.1, 90, 90),
+                    offsets=(-10, 10),
+                    max_evaluations=2000,
+                    initial_step=0.2,
+                    num_processes=1,
+                    max_block_cost=1e8,
+                    seed_prefix='fit',
+                   ):
+    ''' Fits the 61 codon means and CHX_mean by Nelder-Mead on their logs.
+        template is from simulation_sweep.load_template; base_point supplies
+        the other simulation parameters (initiation_mean_numerator,
+        steady_state, etc.). Starts from the template's codon means and
+        base_point's CHX_mean unless initial values are given, with an
+        initial simplex that steps each log parameter by initial_step.
+        Returns a dictionary of the fitted codon means and CHX_mean, the
+        final loss, and the history of (parameters, loss) evaluations.
+    '''
+    if initial_codon_means is None:
+        initial_codon_means = template['codon_means']
+    if initial_CHX_mean is None:
+        initial_CHX_mean = base_point['CHX_mean']
+
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes)
+    else:
+        pool = None
+
+    objective = InverseSimulation(template,
+                                  observed_enrichments,
+                                  base_point,
+                                  condition,
+                                  offsets,
+                                  seed_prefix,
+                                  pool,
+                                  max_block_cost,
+                                  max_evaluations,
+                                  initial_codon_means,
+                                 )
+
+    x0 = means_to_parameters(initial_codon_means, initial_CHX_mean)
+    initial_simplex = np.vstack([x0, x0 + initial_step * np.eye(len(x0))])
+
+    # Nelder-Mead only checks maxfev between iterations, so the objective
+    # enforces the limit itself.
+    try:
+        result = scipy.optimize.minimize(objective,
+                                         x0,
+                                         method='Nelder-Mead',
+                                         options={'maxfev': max_evaluations,
+                                                  'initial_simplex': initial_simplex,
+                                                  'adaptive': True,
+                                                 },
+                                        )
+    except EvaluationLimitReached:
+        best_parameters, best_loss = min(objective.history, key=lambda evaluation: evaluation[1])
+        result = scipy.optimize.OptimizeResult(x=best_parameters,
+                                               fun=best_loss,
+                                               nfev=len(objective.history),
+                                               success=False,
+                                               message='Maximum number of function evaluations has been exceeded.',
+                                              )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    codon_means, CHX_mean = parameters_to_means(result.x)
+    fit = {'codon_means': codon_means,
+           'CHX_mean': CHX_mean,
+           'loss': result.fun,
+           'history': objective.history,
+           'result': result,
+          }
+    return fit
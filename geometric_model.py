@@ -2,6 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import Serialize
 import positions
+import smoothing
 import brewer2mpl
 from scipy.optimize import leastsq
 from itertools import cycle
@@ -10,14 +11,7 @@ import select_work
 from Sequencing import utilities
 
 def smoothed(array, window_size):
-    smoothed_array = np.zeros_like(array)
-    for i in range(window_size):
-        smoothed_array[i] = array[:i + 1].sum() / float(i + 1)
-    for i in range(window_size, len(array) - window_size):
-        smoothed_array[i] = array[i - window_size:i + window_size + 1].sum() / float(2 * window_size + 1)
-    for i in range(len(array) - window_size, len(array)):
-        smoothed_array[i] = array[i:].sum() / float(len(array) - i)
-    return smoothed_array
+    return smoothing.moving_average(array, window_size, edges='one_sided')
 
 # Generators that yields arrays of counts
 def counts_from_read_positions_fn(read_positions_fn, key='all'):
@@ -207,8 +201,8 @@ def make_P_distribution(l_g, p):
     L_distribution = L_distribution / L_distribution[1:].sum()
     sum_terms = uniform_factor * L_distribution
     P_distribution = sum_terms
-    for x in range(l_g - 1, 0, -1):
-        P_distribution[x] += P_distribution[x + 1]
+    # Suffix sums from the end back to position 1
+    P_distribution[1:] = np.cumsum(sum_terms[:0:-1])[::-1]
     return P_distribution
 
 edge_overlap = 50
@@ -220,46 +214,112 @@ def counts_from_genes(genes):
                      for length in genes[gene_name]['position_counts'])
         yield counts
 
-def get_actual_counts(genes, min_length):
-    total_actual_counts = np.zeros(100000)
-
-    for counts in counts_from_genes(genes):
+def CDS_counts_from_read_positions_fn(read_positions_fn, key='all'):
+    for gene_name, counts in counts_from_read_positions_fn(read_positions_fn, key=key):
+        yield counts['start_codon':'stop_codon']
+
+def summarize_counts(counts_generator, min_length):
+    ''' Everything the fit needs from genes at least min_length long: their
+        lengths, their total counts, and the sum of their counts indexed by
+        distance from the end.
+    '''
+    lengths = []
+    totals = []
+    reversed_counts = []
+    for counts in counts_generator:
         l_g = len(counts)
         if l_g < min_length:
             continue
-        counts = counts[::-1]
-        total_actual_counts[:l_g] += counts
+        lengths.append(l_g)
+        totals.append(counts.sum())
+        reversed_counts.append(counts[::-1])
+
+    lengths = np.array(lengths, int)
+    totals = np.array(totals, float)
+
+    max_length = max(lengths) if len(lengths) > 0 else 0
+    actual_counts = np.zeros(max_length)
+    for counts in reversed_counts:
+        actual_counts[:len(counts)] += counts
+
+    summary = {'lengths': lengths,
+               'totals': totals,
+               'actual_counts': actual_counts,
+              }
+    return summary
+
+def sum_over_longer_genes(summary, weights):
+    ''' Entry x - 1 is the sum of weights over genes with l_g >= x. '''
+    max_length = len(summary['actual_counts'])
+    by_length = np.bincount(summary['lengths'], weights=weights, minlength=max_length + 1)
+    return np.cumsum(by_length[::-1])[::-1][1:]
+
+def geometric_terms(summary, p):
+    ''' With q = 1 - p, the L distribution of a gene of length l_g always
+        sums to q over 1 to l_g, so
+
+            P_g(x) = [p (H(l_g - 1) - H(x - 1)) + q**l_g / l_g] / q
+
+        where H(k) is the sum of q**l / l for l from 1 to k. Summing r_g P_g(x)
+        over genes with l_g >= x then only needs sums of per-gene terms over
+        longer genes.
+    '''
+    q = 1 - p
+    lengths = summary['lengths']
+    totals = summary['totals']
+    max_length = len(summary['actual_counts'])
+
+    l = np.arange(1, max_length + 1)
+    H = np.zeros(max_length + 1)
+    H[1:] = np.cumsum(q**l / l)
+
+    terms = {'q': q,
+             # Indexed by x - 1 for x from 1 to max_length
+             'H_before': H[:-1],
+             'q_before': q**(l - 1),
+             'R': sum_over_longer_genes(summary, totals),
+             'S1': sum_over_longer_genes(summary, totals * H[lengths - 1]),
+             'S2': sum_over_longer_genes(summary, totals * q**lengths / lengths),
+            }
+    return terms
+
+def geometric_counts_from_summary(summary, p):
+    t = geometric_terms(summary, p)
+    return (p * t['S1'] - p * t['H_before'] * t['R'] + t['S2']) / t['q']
+
+def geometric_counts_derivative(summary, p):
+    ''' Derivative with respect to p of geometric_counts_from_summary. '''
+    t = geometric_terms(summary, p)
+    A = p * t['S1'] - p * t['H_before'] * t['R'] + t['S2']
+    dA = t['S1'] - t['R'] * (t['H_before'] + t['q_before'])
+    return A / t['q']**2 + dA / t['q']
 
-    return total_actual_counts
+def get_actual_counts(genes, min_length):
+    summary = summarize_counts(counts_from_genes(genes), min_length)
+    return summary['actual_counts']
 
 def get_geometric_counts(genes, p, min_length):
-    total_geometric_counts = np.zeros(100000)
-
-    for counts in counts_from_genes(genes):
-        l_g = len(counts)
-        if l_g < min_length:
-            continue
-        r_g = counts.sum()
-
-        # Some weirdness about whether to include 0 or not in make_P_distribution
-        geometric_counts = make_P_distribution(l_g, p)[1:] * r_g
-
-        total_geometric_counts[:l_g] += geometric_counts
-
-    return total_geometric_counts
+    summary = summarize_counts(counts_from_genes(genes), min_length)
+    return geometric_counts_from_summary(summary, p)
 
-def residuals(p, genes, min_length):
-    print 'testing', p
-    err = get_actual_counts(genes, min_length) - get_geometric_counts(genes, p, min_length)
+def residuals(p, summary):
+    err = summary['actual_counts'] - geometric_counts_from_summary(summary, p[0])
     return err
 
-def fit_p():
-    read_positions_fn = '/home/jah/projects/arlen/experiments/ingolia_science/mRNA-rich-1/results/mRNA-rich-1_read_positions.txt'
-    #read_positions_fn = '/home/jah/projects/arlen/experiments/ingolia_science/mRNA-rich-2/results/mRNA-rich-2_read_positions.txt'
-    #read_positions_fn = '/home/jah/projects/arlen/experiments/nagalakshmi_science/RH_ori/results/RH_ori_read_positions.txt'
-    genes = Serialize.read_file(read_positions_fn, 'read_positions')
-    min_length = 5000
-    p_lsq = leastsq(residuals, 7.8e-5, args=(genes, min_length), full_output=True)
+def residuals_jacobian(p, summary):
+    return -geometric_counts_derivative(summary, p[0])[:, np.newaxis]
+
+def fit_p(read_positions_fn, min_length=5000, initial_p=7.8e-5):
+    #read_positions_fn = '/home/jah/projects/arlen/experiments/ingolia_science/mRNA-rich-1/results/mRNA-rich-1_read_positions.hdf5'
+    #read_positions_fn = '/home/jah/projects/arlen/experiments/ingolia_science/mRNA-rich-2/results/mRNA-rich-2_read_positions.hdf5'
+    #read_positions_fn = '/home/jah/projects/arlen/experiments/nagalakshmi_science/RH_ori/results/RH_ori_read_positions.hdf5'
+    summary = summarize_counts(CDS_counts_from_read_positions_fn(read_positions_fn), min_length)
+    p_lsq = leastsq(residuals,
+                    [initial_p],
+                    args=(summary,),
+                    Dfun=residuals_jacobian,
+                    full_output=True,
+                   )
     print p_lsq
     return p_lsq
 
@@ -1,10 +1,15 @@
+import os
+import re
 import gtf
 import urllib
 import pprint
 import call_UTRs
 import transcript
 import interval_tree
-from collections import Counter
+import array_cache
+import numpy as np
+from collections import Counter, defaultdict
+from Sequencing import genomes
 
 class Feature(gtf.Feature):
     def __init__(self, line=None):
@@ -270,15 +275,91 @@ def extend_UTRs(old_fn, new_fn, UTR_fn, genome_dir):
         for feature in all_features:
             new_fh.write(str(feature) + '\n')
 
-def populate_all_connections(features):
-    for f in features:
-        f.children = set()
-        f.parent = None
+ID_pattern = re.compile(r'(?:^|;)ID=([^;]*)')
+parent_pattern = re.compile(r'(?:^|;)Parent=([^;]*)')
 
-    id_to_object = {f.attribute['ID']: f for f in features if 'ID' in f.attribute}
+def decode_attribute_value(value):
+    ''' Decodes a raw attribute value the same way as parse_attribute_string. '''
+    if value is not None and ('%' in value or '"' in value):
+        value = urllib.unquote(value).strip('"')
+    return value
 
-    for f in features:
-        f.populate_connections(id_to_object)
+def encode_IDs(IDs, parent_IDs):
+    ''' Codes of IDs and parent_IDs into one list of their distinct values.
+        Features without an ID or Parent have None's code.
+    '''
+    codes, distinct = gtf.encode(list(IDs) + list(parent_IDs))
+    ID_codes = codes[:len(IDs)]
+    parent_codes = codes[len(IDs):]
+    return ID_codes, parent_codes, distinct
+
+def add_ID_columns(columns):
+    ''' Adds codes of the ID and Parent attributes of every line to columns
+        without parsing the rest of their attribute strings. Only distinct
+        values are decoded.
+    '''
+    with gtf.gc_paused():
+        ID_matches = map(ID_pattern.search, columns['attribute_strings'])
+        parent_matches = map(parent_pattern.search, columns['attribute_strings'])
+        raw_IDs = [match.group(1) if match else None for match in ID_matches]
+        raw_parent_IDs = [match.group(1) if match else None for match in parent_matches]
+
+    ID_codes, parent_codes, values = encode_IDs(raw_IDs, raw_parent_IDs)
+
+    values = map(decode_attribute_value, values)
+    if len(set(values)) < len(values):
+        # Different raw values decoded to the same value.
+        value_codes, values = gtf.encode(values)
+        ID_codes = value_codes[ID_codes]
+        parent_codes = value_codes[parent_codes]
+
+    columns['ID_codes'] = ID_codes
+    columns['parent_codes'] = parent_codes
+    columns['ID_values'] = values
+
+def find_parent_indices(ID_codes, parent_codes, ID_values):
+    ''' The index of the line whose ID is each line's Parent, or -1 for lines
+        without a Parent. If several lines have the same ID, the last one is
+        the parent.
+    '''
+    is_missing = np.array([value is None or value == '' for value in ID_values], bool)
+
+    line_of_code = np.full(len(ID_values), -1, int)
+    lines = np.arange(len(ID_codes))
+    has_ID = ~is_missing[ID_codes]
+    # Assignments to repeated indices keep the last value.
+    line_of_code[ID_codes[has_ID]] = lines[has_ID]
+
+    parent_indices = line_of_code[parent_codes]
+
+    has_parent = ~is_missing[parent_codes]
+    parent_indices[~has_parent] = -1
+
+    unknown = np.flatnonzero(has_parent & (parent_indices == -1))
+    if len(unknown) > 0:
+        raise KeyError(ID_values[parent_codes[unknown[0]]])
+
+    return parent_indices
+
+def populate_all_connections(features, parent_indices=None):
+    ''' Links each of features to the feature whose ID is its Parent. If
+        parent_indices aren't given, they are found from the features'
+        attributes.
+    '''
+    if parent_indices is None:
+        IDs = [f.attribute.get('ID') for f in features]
+        parent_IDs = [f.attribute.get('Parent') for f in features]
+        parent_indices = find_parent_indices(*encode_IDs(IDs, parent_IDs))
+
+    with gtf.gc_paused():
+        for f in features:
+            f.children = set()
+            f.parent = None
+
+        for f, parent_index in zip(features, parent_indices.tolist()):
+            if parent_index != -1:
+                f.parent = features[parent_index]
+                f.parent.children.add(f)
 
 def get_all_features(gff_fn):
     ''' Ignore any line starting with '#' and all lines after any lines startin with '##FASTA'
@@ -292,8 +373,11 @@ def get_all_features(gff_fn):
             else:
                 yield line
 
-    all_features = [Feature(line) for line in relevant_lines(gff_fn)]
-    populate_all_connections(all_features)    
+    columns = gtf.read_columns(relevant_lines(gff_fn))
+    add_ID_columns(columns)
+    all_features = gtf.features_from_columns(columns, Feature)
+    parent_indices = find_parent_indices(columns['ID_codes'], columns['parent_codes'], columns['ID_values'])
+    populate_all_connections(all_features, parent_indices)
 
     return all_features
 
@@ -305,7 +389,9 @@ def get_CDSs(gff_fn, genome_dir, annotate_nearby=False):
     all_features = get_all_features(gff_fn)
 
     if annotate_nearby:
-        mark_nearby(all_features, genome_dir)
+        top_level_features = get_top_level_features(all_features)
+        neighbors = load_neighbors(gff_fn, genome_dir, top_level_features)
+        annotate_neighbors(top_level_features, neighbors)
     
     genes = transcript.get_gff_transcripts(all_features, genome_dir)
     translated_genes = [g for g in genes if g.CDSs]
@@ -327,49 +413,78 @@ def get_noncoding_RNA_transcripts(gff_fn):
             other_ncRNA_transcripts.append(gene)
     return rRNA_transcripts, tRNA_transcripts, other_ncRNA_transcripts
 
-def mark_nearby(all_features, genome_dir):
-    def is_nontrivial(possible):
-        if possible.feature in ['chromosome', 'landmark', 'ARS', 'region']:
-            return False
-        elif possible.attribute.get('orf_classification') == 'Dubious':
-            return False
-        else:
-            return True
-    
-    top_level_features = get_top_level_features(all_features)
+def is_nontrivial(possible):
+    if possible.feature in ['chromosome', 'landmark', 'ARS', 'region']:
+        return False
+    elif possible.attribute.get('orf_classification') == 'Dubious':
+        return False
+    else:
+        return True
+
+def compute_neighbors(top_level_features, genome_dir):
+    ''' For each of top_level_features, the end of the closest nontrivial
+        feature to its left, the start of the closest one to its right, and
+        the number of other nontrivial features that overlap it, considering
+        only features on the same strand or unstranded. Returns a dictionary
+        of arrays in the order of top_level_features.
+    '''
     nontrivial_features = filter(is_nontrivial, top_level_features)
     overlap_finder = interval_tree.NamedOverlapFinder(nontrivial_features, genome_dir)
 
-    def is_relevant_to(possible, main):
-        if possible == main:
-            return False
-        elif main.strand != '.' and possible.strand != '.' and main.strand != possible.strand:
-            return False
-        else:
-            return True
-
-    for top_level in top_level_features:
-        overlapping = overlap_finder.overlapping(top_level.seqname,
-                                                 top_level.start,
-                                                 top_level.end,
-                                                )
-        overlapping = [f for f in overlapping if is_relevant_to(f, top_level)]
-
-        before = overlap_finder.find_closest_before(top_level.seqname,
-                                                    top_level.strand,
-                                                    top_level.start,
-                                                   )
-        after = overlap_finder.find_closest_after(top_level.seqname,
-                                                  top_level.strand,
-                                                  top_level.end,
-                                                 )
+    num_features = len(top_level_features)
+    neighbors = {'closest_left': np.zeros(num_features, int),
+                 'closest_right': np.zeros(num_features, int),
+                 'overlapping': np.zeros(num_features, int),
+                }
+
+    by_seqname_and_strand = defaultdict(list)
+    for i, top_level in enumerate(top_level_features):
+        by_seqname_and_strand[top_level.seqname, top_level.strand].append(i)
+
+    for (seqname, strand), indices in by_seqname_and_strand.items():
+        starts = np.array([top_level_features[i].start for i in indices])
+        ends = np.array([top_level_features[i].end for i in indices])
+
+        neighbors['overlapping'][indices] = overlap_finder.count_overlapping(seqname, strand, starts, ends)
+        neighbors['closest_left'][indices] = overlap_finder.closest_ends_before(seqname, strand, starts)
+        neighbors['closest_right'][indices] = overlap_finder.closest_starts_after(seqname, strand, ends)
+
+    # Each nontrivial feature was counted as overlapping itself.
+    is_counted = np.array([is_nontrivial(f) for f in top_level_features], bool)
+    neighbors['overlapping'][is_counted] -= 1
+
+    return neighbors
 
-        top_level.attribute['closest_left'] = before[0].end
-        top_level.attribute['closest_right'] = after[0].start
-        top_level.attribute['overlapping'] = len(overlapping)
+def neighbors_fn(gff_fn):
+    return gff_fn + '.neighbors.npz'
+
+def load_neighbors(gff_fn, genome_dir, top_level_features):
+    ''' compute_neighbors for the top level features of gff_fn, cached next
+        to gff_fn. The cache is recomputed if gff_fn has been modified since
+        it was written or if the lengths of the sequences in genome_dir have
+        changed.
+    '''
+    genome_index = genomes.get_genome_index(genome_dir)
+    seqname_lengths = sorted((name, genome_index[name].length) for name in genome_index)
+    parameters = (os.path.getmtime(gff_fn), seqname_lengths, len(top_level_features))
+
+    def compute():
+        return compute_neighbors(top_level_features, genome_dir)
+
+    return array_cache.load_or_compute(neighbors_fn(gff_fn), parameters, compute)
+
+def annotate_neighbors(top_level_features, neighbors):
+    for i, top_level in enumerate(top_level_features):
+        for key in ['closest_left', 'closest_right', 'overlapping']:
+            top_level.attribute[key] = int(neighbors[key][i])
 
         top_level.unparse_attribute_string()
 
+def mark_nearby(all_features, genome_dir):
+    top_level_features = get_top_level_features(all_features)
+    neighbors = compute_neighbors(top_level_features, genome_dir)
+    annotate_neighbors(top_level_features, neighbors)
+
 if __name__ == '__main__':
     boundaries_fn = '/home/jah/projects/ribosomes/data/organisms/saccharomyces_cerevisiae/EF4/transcriptome/inferred_UTR_lengths.txt'
     genome_dir = '/home/jah/projects/ribosomes/data/organisms/saccharomyces_cerevisiae/EF4/genome/'
@@ -1,9 +1,17 @@
+import gc
+import contextlib
+import numpy as np
+from itertools import izip, imap
 from collections import defaultdict, Counter
 from Sequencing import genomes, utilities
 import positions
 import transcript as transcript_utils
 
 class Feature(object):
+    # Attributes are parsed from attribute_string the first time they are
+    # needed.
+    _attribute = None
+
     def __init__(self, line=None):
         if line == None:
             # Allow __init__ to be called with no arguments to allow the
@@ -12,19 +20,17 @@ class Feature(object):
 
         fields = line.strip().split('\t')
         
-        self.seqname = fields[0]
-        self.source = fields[1]
-        self.feature = fields[2]
+        self.seqname = intern(fields[0])
+        self.source = intern(fields[1])
+        self.feature = intern(fields[2])
         self.start = int(fields[3]) - 1
         self.end = int(fields[4]) - 1
         self.score = fields[5]
-        self.strand = fields[6]
+        self.strand = intern(fields[6])
         self.frame = fields[7]
         if self.frame != '.':
             self.frame = int(self.frame)
         self.attribute_string = fields[8]
-        
-        self.parse_attribute_string()
     
     @classmethod
     def from_fields(cls, seqname, source, feature, start, end, score, strand, frame, attribute_string):
@@ -38,7 +44,6 @@ class Feature(object):
         obj.strand = strand
         obj.frame = frame
         obj.attribute_string = attribute_string
-        obj.parse_attribute_string()
         return obj
 
     @classmethod
@@ -53,8 +58,17 @@ class Feature(object):
         obj.score = '.'
         obj.frame = '.'
         obj.attribute_string = '.'
-        obj.parse_attribute_string()
         return obj
+
+    @property
+    def attribute(self):
+        if self._attribute is None:
+            self.parse_attribute_string()
+        return self._attribute
+
+    @attribute.setter
+    def attribute(self, attribute):
+        self._attribute = attribute
     
     def parse_attribute_string(self):
         if self.attribute_string == '.':
@@ -84,11 +98,34 @@ class Feature(object):
     def pasteable(self):
         return '{0}:{1}-{2}'.format(self.seqname, self.start, self.end)
     
+    @property
+    def identity_key(self):
+        ''' Every field of the feature's line, so that features are equal
+            exactly when their lines are, without building the lines.
+        '''
+        key = (self.seqname,
+               self.start,
+               self.end,
+               self.feature,
+               self.strand,
+               self.source,
+               self.score,
+               self.frame,
+               self.attribute_string,
+              )
+        return key
+
     def __hash__(self):
-        return hash(str(self))
+        return hash(self.identity_key)
 
     def __eq__(self, other):
-        return str(self) == str(other)
+        # Features are often compared to None, e.g. f.parent == None.
+        if not isinstance(other, Feature):
+            return False
+        return self.identity_key == other.identity_key
+
+    def __ne__(self, other):
+        return not self == other
 
     @property
     def comparison_key(self):
@@ -108,8 +145,94 @@ class Feature(object):
                self.start >= other.start and \
                self.end <= other.end
 
+interned_fields = [(0, 'seqname'),
+                   (1, 'source'),
+                   (2, 'feature'),
+                   (5, 'score'),
+                   (6, 'strand'),
+                   (7, 'frame'),
+                  ]
+
+@contextlib.contextmanager
+def gc_paused():
+    ''' Creating many objects that refer to each other triggers collection
+        passes that find nothing to collect, so collection is paused while
+        features are built and linked.
+    '''
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+def encode(values):
+    ''' Returns an array of the code of each of values and the list of
+        distinct values the codes index into.
+    '''
+    distinct = list(set(values))
+    value_to_code = {value: code for code, value in enumerate(distinct)}
+    codes = np.fromiter(imap(value_to_code.__getitem__, values), int, len(values))
+    return codes, distinct
+
+def read_columns(lines):
+    ''' Parses feature lines into columns. Fields that repeat from line to
+        line are stored as an array of codes into a list of their distinct
+        values, start and end as arrays of 0-based coordinates, and attribute
+        strings are left unparsed.
+    '''
+    with gc_paused():
+        split_lines = [line.strip().split('\t') for line in lines]
+        if any(len(fields) < 9 for fields in split_lines):
+            raise ValueError('feature line with fewer than 9 fields')
+
+        if split_lines:
+            fields = zip(*split_lines)
+        else:
+            fields = [()]*9
+
+    columns = {}
+    for i, name in interned_fields:
+        codes, distinct = encode(fields[i])
+        values = [intern(value) for value in distinct]
+        if name == 'frame':
+            values = [value if value == '.' else int(value) for value in values]
+        columns[name + '_values'] = values
+        columns[name + '_codes'] = codes
+
+    columns['starts'] = np.fromiter(imap(int, fields[3]), int, len(fields[3])) - 1
+    columns['ends'] = np.fromiter(imap(int, fields[4]), int, len(fields[4])) - 1
+    columns['attribute_strings'] = list(fields[8])
+
+    return columns
+
+def features_from_columns(columns, feature_class=Feature):
+    ''' Makes a feature_class object for each line in columns. Repeated
+        fields are shared between features instead of copied.
+    '''
+    expanded = [[columns[name + '_values'][code] for code in columns[name + '_codes'].tolist()]
+                for _, name in interned_fields
+               ]
+    seqnames, sources, feature_types, scores, strands, frames = expanded
+
+    with gc_paused():
+        all_features = [feature_class.from_fields(*fields)
+                        for fields in izip(seqnames,
+                                           sources,
+                                           feature_types,
+                                           columns['starts'].tolist(),
+                                           columns['ends'].tolist(),
+                                           scores,
+                                           strands,
+                                           frames,
+                                           columns['attribute_strings'],
+                                          )
+                       ]
+    return all_features
+
 def get_all_features(gtf_fn):
-    all_features = [Feature(line) for line in open(gtf_fn)]
+    all_features = features_from_columns(read_columns(open(gtf_fn)))
     return all_features
 
 def get_noncoding_RNA_transcripts(gtf_fn):
@@ -1,87 +1,90 @@
-import bisect
+import numpy as np
 import Sequencing.genomes as genomes
 import gtf
 from collections import defaultdict
 
-class IntervalTree(object):
-    def __init__(self, intervals):
-        sorted_intervals = sorted(intervals)
-        
-        # Pick a balancing center point by finding the middle of the middle
-        # interval in the sorted list.
-        middle_interval = sorted_intervals[len(sorted_intervals) / 2]
-        self.center_point = (middle_interval.start + middle_interval.end) / 2
-
-        to_left = []
-        overlapping = []
-        to_right = []
-        for interval in sorted_intervals:
-            if interval.end < self.center_point:
-                to_left.append(interval)
-            elif interval.start > self.center_point:
-                to_right.append(interval)
-            else:
-                overlapping.append(interval)
-
-        if to_left:
-            self.left_subtree = IntervalTree(to_left)
+class IntervalIndex(object):
+    ''' Closed intervals [start, end] held as sorted numpy arrays so that
+        overlaps and nearest neighbors of whole arrays of queries can be found
+        with binary searches.
+    '''
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, int)
+        ends = np.asarray(ends, int)
+
+        self.by_start = np.argsort(starts, kind='mergesort')
+        self.starts = starts[self.by_start]
+        self.ends_by_start = ends[self.by_start]
+        # Running maximum of ends in start order. Since it never decreases,
+        # the first interval in start order that could reach a query is a
+        # binary search away.
+        if len(ends) > 0:
+            self.max_ends = np.maximum.accumulate(self.ends_by_start)
         else:
-            self.left_subtree = None
+            self.max_ends = self.ends_by_start
 
-        if to_right:
-            self.right_subtree = IntervalTree(to_right)
-        else:
-            self.right_subtree = None
-
-        self.overlapping_by_start = sorted(overlapping, key=lambda interval: interval.start)
-        self.overlapping_starts = [interval.start for interval in self.overlapping_by_start]
-        self.overlapping_by_end = sorted(overlapping, key=lambda interval: interval.end)
-        self.overlapping_ends = [interval.end for interval in self.overlapping_by_end]
-
-    def containing_point(self, point):
-        if point == self.center_point:
-            overlapping = self.overlapping_by_start
-        elif point < self.center_point:
-            index = bisect.bisect(self.overlapping_starts, point)
-            overlapping = self.overlapping_by_start[:index]
-            if self.left_subtree:
-                overlapping += self.left_subtree.containing_point(point)
-        elif point > self.center_point:
-            index = bisect.bisect_left(self.overlapping_ends, point)
-            overlapping = self.overlapping_by_end[index:]
-            if self.right_subtree:
-                overlapping += self.right_subtree.containing_point(point)
-        
-        return overlapping
-
-class IntervalEndpointList(object):
-    def __init__(self, intervals):
-        starts = [(interval.start, interval) for interval in intervals]
-        ends = [(interval.end, interval) for interval in intervals]
-        self.endpoint_list = sorted(starts + ends)
-        self.endpoints = [endpoint for endpoint, interval in self.endpoint_list]
+        self.sorted_ends = np.sort(ends)
 
-    def endpoint_contained_in(self, start, end):
-        first_index = bisect.bisect_left(self.endpoints, start)
-        past_last_index = bisect.bisect_right(self.endpoints, end)
+    def __len__(self):
+        return len(self.starts)
 
-        overlapping_endpoints = self.endpoint_list[first_index:past_last_index]
-        # Note: intervals may contain duplicates.
-        intervals = [interval for endpoint, interval in overlapping_endpoints]
+    def count_overlapping(self, starts, ends):
+        ''' Number of intervals overlapping each of the queries [starts, ends].
+            Every interval that ends before a query starts also starts at or
+            before the query ends, so the count is a difference of two
+            binary searches.
+        '''
+        starting_before_end = np.searchsorted(self.starts, ends, side='right')
+        ending_before_start = np.searchsorted(self.sorted_ends, starts, side='left')
+        return starting_before_end - ending_before_start
 
-        return intervals
+    def overlapping(self, start, end):
+        ''' Indices (in the order given to __init__) of the intervals
+            overlapping [start, end].
+        '''
+        first = np.searchsorted(self.max_ends, start, side='left')
+        past_last = np.searchsorted(self.starts, end, side='right')
+        candidates = np.arange(first, max(first, past_last))
+        candidates = candidates[self.ends_by_start[candidates] >= start]
+        return self.by_start[candidates]
+
+    def closest_end_before(self, positions, missing=-1):
+        ''' The largest end less than each of positions, or missing if there
+            isn't one.
+        '''
+        indices = np.searchsorted(self.sorted_ends, positions, side='left') - 1
+        found = indices >= 0
+        closest = np.full(np.shape(indices), missing, int)
+        closest[found] = self.sorted_ends[indices[found]]
+        return closest
+
+    def closest_start_after(self, positions, missing=-1):
+        ''' The smallest start greater than each of positions, or missing if
+            there isn't one.
+        '''
+        indices = np.searchsorted(self.starts, positions, side='right')
+        found = indices < len(self.starts)
+        closest = np.full(np.shape(indices), missing, int)
+        closest[found] = self.starts[indices[found]]
+        return closest
 
 class OverlapFinder(object):
     def __init__(self, intervals):
-        self.interval_tree = IntervalTree(intervals)
-        self.endpoint_list = IntervalEndpointList(intervals)
+        self.intervals = list(intervals)
+        self.index = IntervalIndex([interval.start for interval in self.intervals],
+                                   [interval.end for interval in self.intervals],
+                                  )
 
     def overlapping(self, start, end):
-        from_tree = self.interval_tree.containing_point(start)
-        from_list = self.endpoint_list.endpoint_contained_in(start, end)
-        return sorted(set(from_tree + from_list))
+        overlapping = [self.intervals[i] for i in self.index.overlapping(start, end)]
+        return sorted(set(overlapping))
 
 class NamedOverlapFinder(object):
+    ''' Finds overlaps and nearest neighbors among features, with a separate
+        IntervalIndex for each strand of each seqname. Each seqname has
+        unstranded sequence edge features at -1 and its length, so every
+        position has a closest feature on either side.
+    '''
     def __init__(self, named_intervals, genome_dir):
         by_name = defaultdict(list)
         for interval in named_intervals:
@@ -97,33 +100,67 @@ class NamedOverlapFinder(object):
         self.overlap_finders = {}
 
         for name in by_name:
-            self.overlap_finders[name] = OverlapFinder(by_name[name])
+            by_strand = defaultdict(list)
+            for interval in by_name[name]:
+                by_strand[interval.strand].append(interval)
+
+            self.overlap_finders[name] = {strand: OverlapFinder(by_strand[strand])
+                                          for strand in by_strand}
+
+    def finders_for(self, seqname, strands):
+        finders = self.overlap_finders[seqname]
+        return [finders[strand] for strand in set(strands) if strand in finders]
+
+    def compatible_strands(self, seqname, strand):
+        ''' Strands whose features are relevant to a feature on strand.
+            Unstranded features are compatible with everything.
+        '''
+        if strand == '.':
+            return self.overlap_finders[seqname].keys()
+        else:
+            return [strand, '.']
 
     def overlapping(self, seqname, start, end):
-        return self.overlap_finders[seqname].overlapping(start, end)
+        overlapping = []
+        for finder in self.overlap_finders[seqname].values():
+            overlapping.extend(finder.overlapping(start, end))
+        return sorted(set(overlapping))
+
+    def count_overlapping(self, seqname, strand, starts, ends):
+        ''' Number of features on strands compatible with strand that overlap
+            each of the queries [starts, ends].
+        '''
+        counts = np.zeros(len(starts), int)
+        for finder in self.finders_for(seqname, self.compatible_strands(seqname, strand)):
+            counts += finder.index.count_overlapping(starts, ends)
+        return counts
+
+    def closest_ends_before(self, seqname, strand, starts):
+        ''' End of the closest feature on strand or unstranded that ends
+            before each of starts.
+        '''
+        closest = [finder.index.closest_end_before(starts, missing=-2**62)
+                   for finder in self.finders_for(seqname, [strand, '.'])]
+        return np.max(closest, axis=0)
+
+    def closest_starts_after(self, seqname, strand, ends):
+        ''' Start of the closest feature on strand or unstranded that starts
+            after each of ends.
+        '''
+        closest = [finder.index.closest_start_after(ends, missing=2**62)
+                   for finder in self.finders_for(seqname, [strand, '.'])]
+        return np.min(closest, axis=0)
 
     def find_closest_before(self, seqname, strand, start):
-        window = 100
-        before = []
-        while before == []:
-            overlapping = self.overlapping(seqname, start - window, start - 1)
-            before = [f for f in overlapping
-                      if f.end < start and f.strand in ['.', strand]
-                     ]
-            window *= 10
-
-        before = sorted(before, key=lambda f: f.end, reverse=True)
+        ''' Features on strand or unstranded that end closest before start. '''
+        closest_end = self.closest_ends_before(seqname, strand, [start])[0]
+        before = self.overlapping(seqname, closest_end, closest_end)
+        before = [f for f in before if f.end == closest_end and f.strand in ['.', strand]]
         return before
 
     def find_closest_after(self, seqname, strand, end):
-        window = 100
-        after = []
-        while after == []:
-            overlapping = self.overlapping(seqname, end + 1, end + window)
-            after = [f for f in overlapping
-                     if f.start > end and f.strand in ['.', strand]
-                    ]
-            window *= 10
-
-        after = sorted(after, key=lambda f: f.start)
+        ''' Features on strand or unstranded that start closest after end. '''
+        closest_start = self.closest_starts_after(seqname, strand, [end])[0]
+        after = self.overlapping(seqname, closest_start, closest_start)
+        after = [f for f in after if f.start == closest_start and f.strand in ['.', strand]]
         return after
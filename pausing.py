@@ -1,6 +1,7 @@
 from __future__ import division
 import positions
 import codons
+import smoothing
 import numpy as np
 import itertools
 from collections import defaultdict, Counter
@@ -15,6 +16,9 @@ import Sequencing.Visualize
 import itertools
 import scipy.stats
 import os
+import hashlib
+import array_cache
+import feature_store
 from pausing_cython import fast_stratified_mean_enrichments, StratifiedMeanEnrichments, make_hdf5_key
 
 igv_colors = Sequencing.Visualize.igv_colors.normalized_rgbs
@@ -30,49 +34,129 @@ def means_of_rest(a):
     m = (np.sum(a) - a) / float(len(a) - 1)
     return m
 
-def compute_pause_scores(codon_counts_dict, special_sets={}):
-    experiment_names = codon_counts_dict.keys()
-    
-    ratios_dict = {name: defaultdict(list) for name in experiment_names}
-    raw_counts_dict = {name: defaultdict(list) for name in experiment_names}
-
-    representative_counts = codon_counts_dict.itervalues().next()
-    gene_names = representative_counts.keys()
+def segmented_means_of_rest(values, starts, lengths):
+    ''' Like means_of_rest, applied independently to each contiguous segment
+        of the rows of values.
+    '''
+    sums = np.add.reduceat(values, starts, axis=0)
+    per_row_sums = np.repeat(sums, lengths, axis=0)
+    per_row_lengths = np.repeat(lengths, lengths)[:, np.newaxis]
+    return (per_row_sums - values) / (per_row_lengths - 1).astype(float)
+
+def segmented_medians(values, starts, lengths):
+    ''' Medians of each column of each contiguous segment of the rows of
+        values.
+    '''
+    segment_ids = np.repeat(np.arange(len(starts)), lengths)
+    lower = starts + (lengths - 1) // 2
+    upper = starts + lengths // 2
+
+    medians = np.empty((len(starts), values.shape[1]))
+    for column in range(values.shape[1]):
+        order = np.lexsort((values[:, column], segment_ids))
+        sorted_values = values[order, column]
+        medians[:, column] = (sorted_values[lower] + sorted_values[upper]) / 2.
+
+    return medians
+
+def stack_codon_counts(codon_counts_dict, experiment_names=None, gene_names=None, count_type='relaxed'):
+    ''' Stacks the CDS counts of every gene in every experiment into a single
+        (codons across all genes) x (experiments) array. Each gene's codons
+        occupy a contiguous block of rows beginning at gene_starts. Codon
+        identities are taken from the first experiment and encoded with
+        codons.encode_codons.
+    '''
+    if experiment_names is None:
+        experiment_names = codon_counts_dict.keys()
+
+    representative_counts = codon_counts_dict[experiment_names[0]]
+    if gene_names is None:
+        gene_names = representative_counts.keys()
 
     cds_slice = slice(('start_codon', 2), 'stop_codon')
 
-    is_specials = {name: np.vectorize(special_set.__contains__) for name, special_set in special_sets.items()}
-
-    qualifying_genes = 0
+    counts_list = []
+    identities_list = []
+    kept_gene_names = []
 
     for gene_name in gene_names:
-        all_counts = [codon_counts_dict[experiment_name][gene_name]['relaxed'][cds_slice]
+        all_counts = [codon_counts_dict[experiment_name][gene_name][count_type][cds_slice]
                       for experiment_name in experiment_names]
-        medians = np.median(all_counts, axis=1)
-        
-        qualifies = np.all(medians >= 2)
-        if not qualifies:
+        if len(all_counts[0]) == 0:
             continue
-        
-        qualifying_genes += 1
 
         identities = representative_counts[gene_name]['identities'][cds_slice]
-        locations = {name: is_special(identities) for name, is_special in is_specials.items()}
-        
-        if not special_sets:
-            locations['not_special'] = slice(None)
-        else:
-            locations['not_special'] = ~(np.any(locations.values(), axis=0))
 
-        for experiment_name, counts in zip(experiment_names, all_counts):          
-            count_ratios = counts / means_of_rest(counts)
-            
-            for set_name, mask in locations.items():
-                ratios_dict[experiment_name][set_name].extend(count_ratios[mask])
-                raw_counts_dict[experiment_name][set_name].extend(counts[mask])
+        counts_list.append(np.transpose(all_counts))
+        identities_list.append(codons.encode_codons(identities))
+        kept_gene_names.append(gene_name)
+
+    gene_lengths = np.array([len(identities) for identities in identities_list], dtype=int)
+    gene_starts = np.concatenate([[0], np.cumsum(gene_lengths)[:-1]]).astype(int)
+
+    if counts_list:
+        counts = np.concatenate(counts_list)
+        identities = np.concatenate(identities_list)
+    else:
+        counts = np.zeros((0, len(experiment_names)), dtype=int)
+        identities = np.zeros(0, dtype=np.uint8)
+
+    stacked = {'experiment_names': list(experiment_names),
+               'gene_names': kept_gene_names,
+               'gene_starts': gene_starts,
+               'gene_lengths': gene_lengths,
+               'counts': counts,
+               'identities': identities,
+              }
+    return stacked
+
+def pause_scores_from_stacked(stacked, special_sets={}, min_median=2):
+    ''' Computes the ratio of counts at each codon to the mean of the rest of
+        its gene for every experiment in the output of stack_codon_counts,
+        restricted to genes whose median count is at least min_median in all
+        experiments, and splits the ratios and raw counts by special_sets.
+    '''
+    experiment_names = stacked['experiment_names']
+    starts = stacked['gene_starts']
+    lengths = stacked['gene_lengths']
+    counts = stacked['counts']
+    identities = stacked['identities']
+
+    ratios_dict = {name: {} for name in experiment_names}
+    raw_counts_dict = {name: {} for name in experiment_names}
+
+    medians = segmented_medians(counts, starts, lengths)
+    qualifies = np.all(medians >= min_median, axis=1)
+    qualifying_rows = np.repeat(qualifies, lengths)
+
+    counts = counts[qualifying_rows]
+    identities = identities[qualifying_rows]
+    lengths = lengths[qualifies]
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(int)
+
+    if len(lengths) > 0:
+        ratios = counts / segmented_means_of_rest(counts, starts, lengths)
+    else:
+        ratios = np.zeros(counts.shape)
+
+    locations = {name: codons.make_codon_mask(special_set)[identities]
+                 for name, special_set in special_sets.items()}
+    if not special_sets:
+        locations['not_special'] = np.ones(len(identities), dtype=bool)
+    else:
+        locations['not_special'] = ~(np.any(locations.values(), axis=0))
+
+    for i, experiment_name in enumerate(experiment_names):
+        for set_name, mask in locations.items():
+            ratios_dict[experiment_name][set_name] = ratios[mask, i]
+            raw_counts_dict[experiment_name][set_name] = counts[mask, i]
 
     return ratios_dict, raw_counts_dict
 
+def compute_pause_scores(codon_counts_dict, special_sets={}):
+    stacked = stack_codon_counts(codon_counts_dict)
+    return pause_scores_from_stacked(stacked, special_sets)
+
 def get_highly_expressed_gene_names(codon_counts_dict,
                                     min_mean=1,
                                     min_median=0,
@@ -125,68 +209,71 @@ def metacodon_around_pauses(codon_counts,
     old_settings = np.seterr(all='raise')
 
     cds_slice = slice(('start_codon', 2), 'stop_codon')
-    
+    window_length = num_before + num_after + 1
+
     counts_around_list = []
     ratios_around_list = []
-    #codons_around_list = []
     nucleotides_around_list = []
     TE_list = []
-    
-    def is_relevant(position, codons):
-        if codons[position] not in relevant_at_pause:
-            return False
 
-        for offset, not_allowed in not_allowed_at_offset.items():
-            if codons[position + offset] in not_allowed:
-                return False
-        
-        return True
-    
+    relevant_mask = codons.make_codon_mask(relevant_at_pause)
+    not_allowed_masks = {offset: codons.make_codon_mask(not_allowed)
+                         for offset, not_allowed in not_allowed_at_offset.items()}
+
+    def find_relevant_positions(codon_indices):
+        candidates = np.arange(num_before, len(codon_indices) - num_after)
+        is_relevant = relevant_mask[codon_indices[candidates]]
+        for offset, not_allowed_mask in not_allowed_masks.items():
+            is_relevant &= ~not_allowed_mask[codon_indices[candidates + offset]]
+
+        return candidates[is_relevant]
+
     for gene_name in gene_names:
         counts = codon_counts[gene_name][count_type][cds_slice]
-        codons = codon_counts[gene_name]['identities'][cds_slice]
+        identities = codon_counts[gene_name]['identities'][cds_slice]
 
         gene_TE = TEs[gene_name]
 
-        median = np.median(counts)
-        mean = np.mean(counts)
-
-        if len(counts) < num_before + num_after + 1:
+        if len(counts) < window_length:
             raise ValueError
-            
-        #denominators = means_of_rest(counts)
+
         denominators = np.mean(counts[num_before:-num_after])
 
         if denominators == 0:
             raise ValueError(gene_name)
-            
+
         ratios = np.true_divide(counts, denominators)
-            
-        for position in range(num_before, len(counts) - num_after):
-            if is_relevant(position, codons):
-                around_slice = slice(position - num_before, position + num_after + 1)
-                
-                if keep_count_context:
-                    counts_around = counts[around_slice]
-                    ratios_around = ratios[around_slice]
-                else:
-                    counts_around = counts[position]
-                    ratios_around = ratios[position]
-                
-                codons_around = codons[around_slice]
-                nucleotides_around = np.array(list(''.join(codons_around)))
-                
-                counts_around_list.append(counts_around)
-                ratios_around_list.append(ratios_around)
-                #codons_around_list.append(codons_around)
-                nucleotides_around_list.append(nucleotides_around)
-                TE_list.append(gene_TE)
-                    
-    around_lists = {'counts': np.asarray(counts_around_list),
-                    'ratios': np.asarray(ratios_around_list),
-                    'TEs': np.asarray(TE_list),
-                    #'codons': np.asarray(codons_around_list),
-                    'nucleotides': np.asarray(nucleotides_around_list),
+
+        codon_indices = codons.encode_codons(identities)
+        relevant_positions = find_relevant_positions(codon_indices)
+        window_starts = relevant_positions - num_before
+
+        if keep_count_context:
+            counts_around = positions.sliding_windows(counts, window_length)[window_starts]
+            ratios_around = positions.sliding_windows(ratios, window_length)[window_starts]
+        else:
+            counts_around = counts[relevant_positions]
+            ratios_around = ratios[relevant_positions]
+
+        nucleotide_indices = codons.encode_nucleotides(''.join(identities))
+        nucleotide_windows = positions.sliding_windows(nucleotide_indices, 3 * window_length, step=3)
+
+        counts_around_list.append(counts_around)
+        ratios_around_list.append(ratios_around)
+        nucleotides_around_list.append(nucleotide_windows[window_starts])
+        TE_list.append(np.repeat(gene_TE, len(relevant_positions)))
+
+    def concatenate(arrays, row_shape, dtype):
+        if len(arrays) == 0:
+            return np.zeros((0,) + row_shape, dtype=dtype)
+        else:
+            return np.concatenate(arrays)
+
+    count_shape = (window_length,) if keep_count_context else ()
+    around_lists = {'counts': concatenate(counts_around_list, count_shape, int),
+                    'ratios': concatenate(ratios_around_list, count_shape, float),
+                    'TEs': concatenate(TE_list, (), float),
+                    'nucleotides': concatenate(nucleotides_around_list, (3 * window_length,), np.uint8),
                     'num_before': num_before,
                     'num_after': num_after,
                    }
@@ -201,8 +288,8 @@ def compute_binned_base_compositions(around_lists, masks):
         fractions = {}
         for offset in range(-90, 93):
             column = around_lists['nucleotides'][:, 90 + offset][mask]
-            counts = Counter(column)
-            fractions[offset] = {base: counts[base] / float(len(column)) for base in 'TCAG'}
+            counts = np.bincount(column, minlength=len(codons.nucleotide_order))
+            fractions[offset] = {base: counts[codons.nucleotide_to_index[base]] / float(len(column)) for base in 'TCAG'}
             
         binned_base_compositions[bin_name] = fractions
         
@@ -288,7 +375,8 @@ def make_base_identity_masks(around_lists):
     
     masks = {}
     for offset in range(-(num_before * 3), (num_after + 1) * 3):
-        masks[offset] = {base: around_lists['nucleotides'][:, num_before * 3 + offset] == base for base in 'TCAG'}
+        column = around_lists['nucleotides'][:, num_before * 3 + offset]
+        masks[offset] = {base: column == codons.nucleotide_to_index[base] for base in 'TCAG'}
     return masks
 
 def split_into_bins(around_lists, quantize_at, num_quantiles): 
@@ -342,7 +430,7 @@ def plot_cdfs(ratios_dict, ordinal_colors=False, sorting_key=lambda x: x):
     for name in sorted(ratios_dict, key=sorting_key):
         ratios = ratios_dict[name]
         for key in ratios:
-            if ratios[key] == []:
+            if len(ratios[key]) == 0:
                 continue
             sorted_values, cumulative = Sequencing.utilities.empirical_cdf(ratios[key])
             ax.semilogy(sorted_values, 1 - cumulative, color=color_iter.next(), label=name + '_' + key)
@@ -1270,10 +1358,7 @@ def plot_correlations_across_conditions(enrichments,
     return fig
 
 def smooth(ys, window):
-    smoothed = np.copy(ys)
-    for i in range(window, len(ys) - window):
-        smoothed[i] = sum(ys[i - window:i + window + 1]) / float(2 * window + 1)
-    return smoothed
+    return smoothing.moving_average(ys, window, edges='keep')
 
 def get_color_iter():
     bmap = brewer2mpl.get_map('Set1', 'qualitative', 9)
@@ -1317,10 +1402,9 @@ def plot_codon_enrichments(names,
     xs = np.arange(min_x, max_x + 1)
 
     for sample in names:
-        for codon_id in codons.non_stop_codons:
-            ys = enrichments[sample][condition, 'codon', min_x:max_x + 1, codon_id]
-            ys = smooth(ys, smooth_window)
-
+        waves = enrichments[sample][condition, 'codon', min_x:max_x + 1, codons.non_stop_codons]
+        smoothed = smooth(waves, smooth_window)
+        for codon_id, ys in zip(codons.non_stop_codons, smoothed.T):
             all_ys[sample, codon_id] = ys
         
     if sample_to_label == None:
@@ -1553,6 +1637,19 @@ def plot_codon_enrichments_all_amino_acids(enrichments, figure_file_name):
             plt.close(fig)
 
 def load_TEs(RPF_experiment, mRNA_experiment):
+    ''' If both experiments are in the same feature store, TEs are computed
+        from its read counts and stored there under the name of the pair.
+        Otherwise, they are computed from the experiments' read_counts files.
+    '''
+    store_fn = getattr(RPF_experiment, 'feature_store_fn', None)
+    if store_fn is not None and store_fn == getattr(mRNA_experiment, 'feature_store_fn', None) and os.path.exists(store_fn):
+        experiment_names = [feature_store.full_name(RPF_experiment),
+                            feature_store.full_name(mRNA_experiment),
+                           ]
+        if feature_store.has_experiments(store_fn, experiment_names):
+            TE_name = '{0}/{1}'.format(*experiment_names)
+            return feature_store.update_TEs(store_fn, TE_name, *experiment_names)
+
     def experiment_to_RPKMs(experiment):
         read_counts = experiment.read_file('read_counts')
         counts = {gene_name: read_counts[gene_name]['expression'][0] for gene_name in read_counts}
@@ -1679,6 +1776,163 @@ def scatter_offset_relationships(around_lists,
             q = np.log2(q)
         ax.axvline(q, color='black', alpha=0.2)
 
+def rank_along_last_axis(values):
+    ''' Ranks values along their last axis, giving tied values the average of
+        the ranks they span (the same convention as scipy.stats.rankdata).
+    '''
+    values = np.asarray(values, dtype=float)
+    rows = values.reshape(-1, values.shape[-1])
+    num_rows, row_length = rows.shape
+    row_indices = np.arange(num_rows)[:, np.newaxis]
+
+    order = np.argsort(rows, axis=1, kind='mergesort')
+    sorted_rows = rows[row_indices, order]
+
+    starts_group = np.ones(sorted_rows.shape, dtype=bool)
+    starts_group[:, 1:] = sorted_rows[:, 1:] != sorted_rows[:, :-1]
+    group_ids = np.cumsum(starts_group, axis=1) - 1 + row_indices * row_length
+
+    ordinal_ranks = np.tile(np.arange(1, row_length + 1, dtype=float), (num_rows, 1))
+    rank_sums = np.bincount(group_ids.ravel(), weights=ordinal_ranks.ravel(), minlength=rows.size)
+    group_sizes = np.bincount(group_ids.ravel(), minlength=rows.size)
+    average_ranks = rank_sums[group_ids] / group_sizes[group_ids]
+
+    ranks = np.empty(rows.shape)
+    ranks[row_indices, order] = average_ranks
+    return ranks.reshape(values.shape)
+
+def correlate_along_last_axis(xs, ys, method='pearson'):
+    ''' Correlation coefficients and two-sided p-values between xs and ys
+        along their last axis, broadcasting over all other axes. p-values
+        come from the t distribution with n - 2 degrees of freedom, as in
+        scipy.stats.pearsonr and scipy.stats.spearmanr.
+    '''
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+
+    if method == 'spearman':
+        xs = rank_along_last_axis(xs)
+        ys = rank_along_last_axis(ys)
+    elif method != 'pearson':
+        raise ValueError(method)
+
+    n = xs.shape[-1]
+    xs = xs - xs.mean(axis=-1)[..., np.newaxis]
+    ys = ys - ys.mean(axis=-1)[..., np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = (xs * ys).sum(axis=-1) / np.sqrt((xs**2).sum(axis=-1) * (ys**2).sum(axis=-1))
+        rs = np.clip(rs, -1, 1)
+        df = n - 2
+        ts = rs * np.sqrt(df / ((1 - rs) * (1 + rs)))
+        ps = 2 * scipy.stats.t.sf(np.abs(ts), df)
+
+    return rs, ps
+
+def stack_codon_enrichments(enrichments, names, x_min, x_max, condition=None, smooth_window=0):
+    ''' Stacks the enrichments of each non-stop codon at offsets x_min up to
+        (but not including) x_max into an experiments x offsets x codons
+        array.
+    '''
+    key = ('codon', slice(x_min, x_max), codons.non_stop_codons)
+    if condition is not None:
+        key = (condition,) + key
+
+    stacked = np.array([enrichments[name][key] for name in names], dtype=float)
+    return smoothing.moving_average(stacked, smooth_window, axis=1)
+
+def compute_offset_difference_correlations(enrichments,
+                                           noCHX_name,
+                                           CHX_names,
+                                           x_min=-90,
+                                           x_max=90,
+                                           smooth_window=0,
+                                          ):
+    ''' Pearson correlations between enrichments at each offset in each CHX
+        experiment and the changes from noCHX_name to that experiment summed
+        over the A site, A and P sites, and A, P and E sites. rs and ps are
+        indexed by experiment, number of sites - 1, offset.
+    '''
+    # Active site enrichments are ordered A, P, E.
+    noCHX_sites = stack_codon_enrichments(enrichments, [noCHX_name], -2, 1)[:, ::-1]
+    CHX_sites = stack_codon_enrichments(enrichments, CHX_names, -2, 1)[:, ::-1]
+    differences = noCHX_sites - CHX_sites
+    changes = np.cumsum(differences, axis=1)
+
+    waves = stack_codon_enrichments(enrichments, CHX_names, x_min, x_max, smooth_window=smooth_window)
+
+    rs, ps = correlate_along_last_axis(waves[:, np.newaxis, :, :],
+                                       changes[:, :, np.newaxis, :],
+                                      )
+
+    correlations = {'names': np.array(CHX_names),
+                    'offsets': np.arange(x_min, x_max),
+                    'rs': rs,
+                    'ps': ps,
+                   }
+    return correlations
+
+def compute_offset_tAI_correlations(enrichments,
+                                    CHX_names,
+                                    x_min,
+                                    x_max,
+                                    tRNA_value_source='tAI',
+                                    smooth_window=0,
+                                    condition=(0.1, 90, 90),
+                                   ):
+    ''' Spearman correlations between enrichments at each offset from x_min to
+        x_max (inclusive) in each experiment and tRNA values. rs and ps are
+        indexed by experiment, offset.
+    '''
+    tAIs = load_tRNA_copy_numbers(tRNA_value_source)
+    tAI_values = np.array([tAIs[codon] for codon in codons.non_stop_codons])
+
+    waves = stack_codon_enrichments(enrichments,
+                                    CHX_names,
+                                    x_min,
+                                    x_max + 1,
+                                    condition=condition,
+                                    smooth_window=smooth_window,
+                                   )
+
+    rs, ps = correlate_along_last_axis(waves, tAI_values, method='spearman')
+
+    correlations = {'names': np.array(CHX_names),
+                    'offsets': np.arange(x_min, x_max + 1),
+                    'rs': rs,
+                    'ps': ps,
+                   }
+    return correlations
+
+def digest_codon_enrichments(enrichments, names, x_min, x_max, condition=None):
+    ''' A digest of the codon enrichments of names at offsets x_min up to x_max. '''
+    stacked = stack_codon_enrichments(enrichments, names, x_min, x_max, condition=condition)
+    return hashlib.sha1(np.ascontiguousarray(stacked).tostring()).hexdigest()
+
+def cached_correlations(cache_fn, compute_correlations, enrichments, **kwargs):
+    ''' Loads correlations saved in cache_fn by an earlier call with the same
+        kwargs on the same enrichments, or computes them with
+        compute_correlations and saves them to cache_fn. If cache_fn is None,
+        nothing is cached.
+    '''
+    names = list(kwargs['CHX_names'])
+    if 'noCHX_name' in kwargs:
+        names.append(kwargs['noCHX_name'])
+
+    # Covers the active sites and every offset either computation reads.
+    digest = digest_codon_enrichments(enrichments,
+                                      names,
+                                      min(kwargs['x_min'], -2),
+                                      max(kwargs['x_max'] + 1, 1),
+                                      condition=kwargs.get('condition'),
+                                     )
+    parameters = (sorted(kwargs.items()), digest)
+
+    def compute():
+        return compute_correlations(enrichments, **kwargs)
+
+    return array_cache.load_or_compute(cache_fn, parameters, compute)
+
 def offset_difference_correlation(enrichments, names,
                                   plot_lims=(-90, 89),
                                   enrichment_ylims=None,
@@ -1695,6 +1949,7 @@ def offset_difference_correlation(enrichments, names,
                                   withhold_results=False,
                                   annotate_maximum=True,
                                   smooth_window=0,
+                                  cache_fn=None,
                                  ):
     if any('noCHX' in name for name in names):
         noCHX_name = [name for name in names if 'noCHX' in name][0]
@@ -1702,10 +1957,33 @@ def offset_difference_correlation(enrichments, names,
     else:
         noCHX_name = names[0]
         CHX_names = names[1:]
-    
-    noCHX_As = enrichments[noCHX_name]['codon', 0, codons.non_stop_codons]
-    noCHX_Ps = enrichments[noCHX_name]['codon', -1, codons.non_stop_codons]
-    noCHX_Es = enrichments[noCHX_name]['codon', -2, codons.non_stop_codons]
+
+    x_min, x_max = -90, 90
+    xs = np.arange(x_min, x_max)
+
+    correlations = cached_correlations(cache_fn,
+                                       compute_offset_difference_correlations,
+                                       enrichments,
+                                       noCHX_name=noCHX_name,
+                                       CHX_names=CHX_names,
+                                       x_min=x_min,
+                                       x_max=x_max,
+                                       smooth_window=smooth_window,
+                                      )
+
+    nums_of_sites = [1, 2, 3]
+    labels = [
+        'A site',
+        'A site + P site',
+        'A site + P site + E site',
+    ]
+
+    if not use_P_sites:
+        nums_of_sites = nums_of_sites[:1]
+
+    if use_P_sites and not show_A_site:
+        nums_of_sites = nums_of_sites[1:]
+        labels = labels[1:]
     
     if p_value_panels:
         gs_kwargs = dict(hspace=0.07, wspace=0.1, height_ratios=[0.5, 1, 0.5])
@@ -1722,48 +2000,17 @@ def offset_difference_correlation(enrichments, names,
                                 squeeze=False,
                                )
     
-    for CHX_name, ax_col in zip(CHX_names, axs.T):
+    for CHX_i, (CHX_name, ax_col) in enumerate(zip(CHX_names, axs.T)):
         if p_value_panels:
             enrichment_ax, r_ax, p_ax = ax_col
         else:
             enrichment_ax, r_ax = ax_col
 
-        CHX_As = enrichments[CHX_name]['codon', 0, codons.non_stop_codons]
-        CHX_Ps = enrichments[CHX_name]['codon', -1, codons.non_stop_codons]
-        CHX_Es = enrichments[CHX_name]['codon', -2, codons.non_stop_codons]
-
-        x_min, x_max = -90, 90
-        xs = np.arange(x_min, x_max)
-
-        changes_strings = [
-            'noCHX_As - CHX_As',
-            'noCHX_As + noCHX_Ps - CHX_As - CHX_Ps',
-            'noCHX_As + noCHX_Ps + noCHX_Es - CHX_As - CHX_Ps - CHX_Es',
-        ]
-        
-        labels = [
-            'A site',
-            'A site + P site',
-            'A site + P site + E site',
-        ]
-        
-        if not use_P_sites:
-            changes_strings = changes_strings[:1]
-
-        if use_P_sites and not show_A_site:
-            changes_strings = changes_strings[1:]
-            labels = labels[1:]
-
-        for changes_string, label in zip(changes_strings, labels):
-            changes = eval(changes_string)
-            rps = []
-            waves = enrichments[CHX_name]['codon', x_min:x_max, codons.non_stop_codons]
-            smoothed = smooth(waves, smooth_window)
-            for row in smoothed:
-                rps.append(scipy.stats.pearsonr(row, changes))
-            x_rs, x_ps = np.array(rps).T
+        for num_sites, label in zip(nums_of_sites, labels):
+            x_rs = correlations['rs'][CHX_i, num_sites - 1]
+            x_ps = correlations['ps'][CHX_i, num_sites - 1]
             
-            if use_P_sites and show_A_site and changes_string == changes_strings[0]:
+            if use_P_sites and show_A_site and num_sites == nums_of_sites[0]:
                 alpha = 0.5
             else:
                 alpha = 1.0
@@ -1773,7 +2020,7 @@ def offset_difference_correlation(enrichments, names,
             else:
                 ys = x_rs
 
-            if changes_string == changes_strings[0]:
+            if num_sites == nums_of_sites[0]:
                 color = 'blue'
             else:
                 color = 'purple'
@@ -1823,7 +2070,7 @@ def offset_difference_correlation(enrichments, names,
             p_ax.set_yticks([eval('1e{0}'.format(p)) for p in np.arange(0, min_p - 1, -4)])
             p_ax.yaxis.grid(linestyle='-', alpha=0.3)
             p_ax.set_ylabel('P-value of correlation', size=16)
-            if len(changes_strings) > 1:
+            if len(nums_of_sites) > 1:
                 p_ax.legend(framealpha=0.5, loc='lower right')
         
         label_kwargs = {'size': 16, 'family': 'serif'}
@@ -1841,14 +2088,12 @@ def offset_difference_correlation(enrichments, names,
             for label in ax.get_yticklabels() + ax.get_xticklabels():
                 label.set_size(12)
 
-        if len(changes_strings) > 1:
+        if len(nums_of_sites) > 1:
             if variance_explained:
                 loc = 'upper left'
             else:
                 loc = 'lower right'
             r_ax.legend(framealpha=0.5, loc=loc)
-        else:
-            r_ax.set_ylabel(changes_strings[0])
 
         if not use_P_sites:
             if variance_explained:
@@ -1922,9 +2167,21 @@ def offset_tAI_correlation(enrichments,
                            tRNA_value_source='tAI',
                            smooth_window=0,
                            condition=(0.1, 90, 90),
+                           cache_fn=None,
                           ):
-    tAIs = load_tRNA_copy_numbers(tRNA_value_source)
-    tAI_values = [tAIs[codon] for codon in codons.non_stop_codons]
+    x_min, x_max = plot_lims
+    xs = np.arange(x_min, x_max + 1)
+
+    correlations = cached_correlations(cache_fn,
+                                       compute_offset_tAI_correlations,
+                                       enrichments,
+                                       CHX_names=CHX_names,
+                                       x_min=x_min,
+                                       x_max=x_max,
+                                       tRNA_value_source=tRNA_value_source,
+                                       smooth_window=smooth_window,
+                                       condition=condition,
+                                      )
 
     if p_offsets == None:
         p_offsets = [20]*len(CHX_names)
@@ -1975,7 +2232,7 @@ def offset_tAI_correlation(enrichments,
         for column in np.array(row_axes).reshape(low_level.get_geometry()).T:
             columns.append(column)
 
-    for CHX_name, ax_col, p_offset in itertools.izip_longest(CHX_names, columns, p_offsets):
+    for CHX_i, (CHX_name, ax_col, p_offset) in enumerate(itertools.izip_longest(CHX_names, columns, p_offsets)):
         if p_value_panels:
             enrichment_ax, rho_ax, p_ax = ax_col
         else:
@@ -1986,18 +2243,8 @@ def offset_tAI_correlation(enrichments,
                 fig.delaxes(ax)
             continue
 
-        x_rhos = []
-        x_ps = []
-        
-        x_min, x_max = plot_lims
-        xs = np.arange(x_min, x_max + 1)
-        
-        rho_ps = []
-        waves = enrichments[CHX_name][condition, 'codon', x_min:x_max + 1, codons.non_stop_codons]
-        smoothed = smooth(waves, smooth_window)
-        for row in smoothed:
-            rho_ps.append(scipy.stats.spearmanr(row, tAI_values))
-        x_rhos, x_ps = np.array(rho_ps).T
+        x_rhos = correlations['rs'][CHX_i]
+        x_ps = correlations['ps'][CHX_i]
 
         if withhold_results:
             for x, rho in zip(xs, x_rhos):
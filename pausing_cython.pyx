@@ -37,19 +37,79 @@ def find_minimum_density_breakpoints(codon_counts,
 
     return sorted_names, breakpoints
 
-def make_arrays(num_around, dtype=float):
-    arrays = {'nucleotide': np.zeros((3 * (2 * num_around + 1), 4), dtype),
-              'codon': np.zeros((2 * num_around + 1, 64), dtype),
-              'dicodon': np.zeros((2 * num_around + 1, 64, 64), dtype),
+def make_arrays(num_around, dtype=float, keys=('nucleotide', 'codon', 'dicodon')):
+    shapes = {'nucleotide': (3 * (2 * num_around + 1), 4),
+              'codon': (2 * num_around + 1, 64),
+              'dicodon': (2 * num_around + 1, 64, 64),
              }
+    arrays = {key: np.zeros(shapes[key], dtype) for key in keys}
     return arrays
 
 def make_hdf5_key(min_mean, exclude_from_start, exclude_from_end):
     key = '{0:0.2f},{1},{2}'.format(min_mean, exclude_from_start, exclude_from_end)
     return key
 
+def encode_gene(codon_ids):
+    ''' Returns arrays of the indices of each codon in codon_ids and of each
+        nucleotide in the concatenation of codon_ids.
+    '''
+    codon_indices = codons.encode_codons(codon_ids).astype(long)
+    nucleotide_indices = codons.encode_nucleotides(''.join(codon_ids)).astype(long)
+    if len(codon_indices) > 0 and codon_indices.max() >= len(codons.all_codons):
+        raise ValueError('unrecognized codon')
+    return codon_indices, nucleotide_indices
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
+def accumulate_gene_enrichments(double [::1] ratios,
+                                long [::1] codon_indices,
+                                long [::1] nucleotide_indices,
+                                long start,
+                                long end,
+                                long num_around,
+                                long multiplicity,
+                                long [:, ::1] occurences,
+                                double [:, ::1] total_enrichment,
+                                long [:, ::1] nuc_occurences,
+                                double [:, ::1] nuc_total_enrichment,
+                                long [:, :, ::1] dicodon_occurences=None,
+                                double [:, :, ::1] dicodon_total_enrichment=None,
+                               ):
+    ''' Adds multiplicity copies of the ratio at each position from start to
+        end of a gene to the totals for the codon and nucleotide identities at
+        every offset within num_around codons of the position.
+    '''
+    cdef long position, codon_offset, nucleotide_offset, length
+    cdef long absolute_index, last_absolute_index, absolute_position, codon_index, last_codon_index, nuc_index, offset_start, offset_end
+    cdef double ratio
+    cdef bint do_dicodon = dicodon_occurences is not None
+
+    length = ratios.shape[0]
+
+    for position in range(start, end):
+        ratio = ratios[position] * multiplicity
+        offset_start = max(-position, -num_around)
+        offset_end = min(length - position, num_around + 1)
+        for nucleotide_offset in range(offset_start * 3, offset_end * 3):
+            absolute_index = position * 3 + nucleotide_offset
+            absolute_position = num_around * 3 + nucleotide_offset
+            nuc_index = nucleotide_indices[absolute_index]
+            nuc_occurences[absolute_position, nuc_index] += multiplicity
+            nuc_total_enrichment[absolute_position, nuc_index] += ratio
+        
+        for codon_offset in range(offset_start, offset_end):
+            absolute_index = position + codon_offset
+            absolute_position = num_around + codon_offset
+            codon_index = codon_indices[absolute_index]
+            occurences[absolute_position, codon_index] += multiplicity
+            total_enrichment[absolute_position, codon_index] += ratio
+            
+            if do_dicodon and codon_offset > offset_start:
+                last_absolute_index = absolute_index - 1
+                last_codon_index = codon_indices[last_absolute_index]
+                dicodon_occurences[absolute_position, last_codon_index, codon_index] += multiplicity
+                dicodon_total_enrichment[absolute_position, last_codon_index, codon_index] += ratio
+
 def fast_stratified_mean_enrichments(codon_counts,
                                      exclude_from_edges,
                                      min_means,
@@ -57,37 +117,21 @@ def fast_stratified_mean_enrichments(codon_counts,
                                      count_type='relaxed',
                                      keys=['codon', 'nucleotide'],
                                     ):
-    cdef int position, codon_offset, nucleotide_offset, length
-    cdef int absolute_index, last_absolute_index, absolute_position, codon_index, last_codon_index, nuc_index, i, j, exclude_from_start, exclude_from_end, offset_start, offset_end
-    cdef double ratio, numerator, denominator, mean
-
-    cdef long [:, ::1] occurences
-    cdef double [:, ::1] total_enrichment
-    
-    cdef long [:, :, ::1] dicodon_occurences
-    cdef double [:, :, ::1] dicodon_total_enrichment
-    
-    cdef long [:, ::1] nuc_occurences
-    cdef double [:, ::1] nuc_total_enrichment
-    
-    cdef double [::1] ratios
-    cdef long [::1] codon_indices
-    cdef long [::1] nucleotide_indices
-    
+    cdef long length, exclude_from_start, exclude_from_end
+    cdef double mean
+
     enrichment_arrays = {}
+
+    do_dicodon = 'dicodon' in keys
    
     for exclude_from_start, exclude_from_end in exclude_from_edges: 
         occurence_arrays = make_arrays(num_around, int)
         total_enrichment_arrays = make_arrays(num_around, float)
         
-        occurences = occurence_arrays['codon']
-        total_enrichment = total_enrichment_arrays['codon']
-        
-        dicodon_occurences = occurence_arrays['dicodon']
-        dicodon_total_enrichment = total_enrichment_arrays['dicodon']
-        
-        nuc_occurences = occurence_arrays['nucleotide']
-        nuc_total_enrichment = total_enrichment_arrays['nucleotide']
+        if do_dicodon:
+            dicodon_arrays = (occurence_arrays['dicodon'], total_enrichment_arrays['dicodon'])
+        else:
+            dicodon_arrays = (None, None)
         
         cds_slice = slice(('start_codon', 2), 'stop_codon')
 
@@ -103,9 +147,6 @@ def fast_stratified_mean_enrichments(codon_counts,
         for gene_name in sorted_gene_names:
             counts = codon_counts[gene_name][count_type][cds_slice]
             codon_ids = codon_counts[gene_name]['identities'][cds_slice]
-            codon_indices = np.array([codons.codon_to_index[codon] for codon in codon_ids])
-            nucleotides = ''.join(codon_ids)
-            nucleotide_indices = np.array([codons.nucleotide_to_index[n] for n in nucleotides])
             
             length = len(counts)
             
@@ -116,31 +157,22 @@ def fast_stratified_mean_enrichments(codon_counts,
                 mean = np.mean(counts[exclude_from_start:length - exclude_from_end])
 
             if mean != 0.:
-                ratios = counts / mean
-
-                for position in range(exclude_from_start, length - exclude_from_end):
-                    ratio = ratios[position]
-                    offset_start = max(-position, -num_around)
-                    offset_end = min(length - position, num_around + 1)
-                    for nucleotide_offset in range(offset_start * 3, offset_end * 3):
-                        absolute_index = position * 3 + nucleotide_offset
-                        absolute_position = num_around * 3 + nucleotide_offset
-                        nuc_index = nucleotide_indices[absolute_index]
-                        nuc_occurences[absolute_position, nuc_index] += 1
-                        nuc_total_enrichment[absolute_position, nuc_index] += ratio
-                    
-                    for codon_offset in range(offset_start, offset_end):
-                        absolute_index = position + codon_offset
-                        absolute_position = num_around + codon_offset
-                        codon_index = codon_indices[absolute_index]
-                        occurences[absolute_position, codon_index] += 1
-                        total_enrichment[absolute_position, codon_index] += ratio
-                        
-                        if codon_offset > offset_start:
-                            last_absolute_index = absolute_index - 1
-                            last_codon_index = codon_indices[last_absolute_index]
-                            dicodon_occurences[absolute_position, last_codon_index, codon_index] += 1
-                            dicodon_total_enrichment[absolute_position, last_codon_index, codon_index] += ratio
+                codon_indices, nucleotide_indices = encode_gene(codon_ids)
+                ratios = np.ascontiguousarray(counts / mean, dtype=float)
+
+                accumulate_gene_enrichments(ratios,
+                                            codon_indices,
+                                            nucleotide_indices,
+                                            exclude_from_start,
+                                            length - exclude_from_end,
+                                            num_around,
+                                            1,
+                                            occurence_arrays['codon'],
+                                            total_enrichment_arrays['codon'],
+                                            occurence_arrays['nucleotide'],
+                                            total_enrichment_arrays['nucleotide'],
+                                            *dicodon_arrays
+                                           )
 
             if gene_name in breakpoints:
                 label = make_hdf5_key(breakpoints[gene_name], exclude_from_start, exclude_from_end)
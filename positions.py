@@ -171,6 +171,21 @@ class PositionCounts(object):
         else:
             raise ValueError('bad types in PositionCounts subtraction')
 
+def sliding_windows(array, width, step=1):
+    ''' Returns a read-only view of array whose i'th row is
+        array[i * step:i * step + width], without copying any data.
+    '''
+    array = np.asarray(array)
+    num_windows = max(0, (len(array) - width) // step + 1)
+    shape = (num_windows, width) + array.shape[1:]
+    strides = (array.strides[0] * step, array.strides[0]) + array.strides[1:]
+    windows = np.lib.stride_tricks.as_strided(array,
+                                              shape=shape,
+                                              strides=strides,
+                                              writeable=False,
+                                             )
+    return windows
+
 def convert_to_three_prime(position_counts, length):
     ''' Shift position counts that represent 5' edges of fragments of given
         length to represetnt 3' edges.
@@ -336,6 +351,26 @@ def get_Transcript_position_counts(clean_bam_fn,
 
     return gene_infos
 
+def gene_infos_to_read_positions(gene_infos):
+    ''' Rearranges the output of get_Transcript_position_counts into the read
+        positions of each gene that are written to read_positions files.
+    '''
+    read_positions = {}
+    for name, info in gene_infos.iteritems():
+        five_prime_counts = info['five_prime_positions']
+        three_prime_counts = info['three_prime_positions']
+
+        all_positions = {'three_prime_genomic': three_prime_counts[0],
+                         'three_prime_nongenomic': three_prime_counts['all'] - three_prime_counts[0],
+                         'three_prime_nonunique': three_prime_counts['all_nonunique'],
+                         'sequence': info['sequence'],
+                        }
+        all_positions.update(five_prime_counts)
+
+        read_positions[name] = all_positions
+
+    return read_positions
+
 def get_joint_position_counts_sparse(extended_bam_fn, transcript, left_buffer=left_buffer, right_buffer=right_buffer):
     bam_file = pysam.Samfile(extended_bam_fn)
     transcript.build_coordinate_maps(left_buffer, right_buffer)
@@ -461,9 +496,50 @@ def compute_codon_counts(position_counts, offset_type):
                                      )
     return codon_counts, codon_identities
 
+def compute_buffered_codon_counts(read_positions, offset_type):
+    ''' Relaxed, stringent, and anisomycin codon counts and codon identities
+        of every gene in read_positions.
+    '''
+    buffered_codon_counts = {}
+    for name, position_counts in read_positions.iteritems():
+        relaxed, identities = compute_codon_counts(position_counts, offset_type)
+        stringent, _ = compute_codon_counts(position_counts, offset_type + '_stringent')
+        anisomycin, _ = compute_codon_counts(position_counts, offset_type + '_anisomycin')
+        buffered_codon_counts[name] = {'relaxed': relaxed,
+                                       'stringent': stringent,
+                                       'anisomycin': anisomycin,
+                                       'identities': identities,
+                                      }
+    return buffered_codon_counts
+
+def extract_CDS_codon_counts(buffered_codon_counts, count_type):
+    ''' The count_type counts of each gene from the start codon through the
+        stop codon.
+    '''
+    codon_counts = {}
+    for name, buffered in buffered_codon_counts.iteritems():
+        num_codons = buffered[count_type].CDS_length
+        # + 1 is to include the stop codon
+        codon_counts[name] = buffered[count_type]['start_codon', :num_codons + 1]
+    return codon_counts
+
+def ragged_ranges(starts, lengths):
+    ''' The concatenation of np.arange(start, start + length) for each start
+        and length.
+    '''
+    starts = np.asarray(starts, int)
+    lengths = np.asarray(lengths, int)
+    ends = np.cumsum(lengths)
+    offsets = np.repeat(starts - (ends - lengths), lengths)
+    return np.arange(ends[-1] if len(ends) > 0 else 0) + offsets
+
 def compute_metagene_positions(CDSs, position_counts, max_CDS_length):
     ''' max_CDS_length needs to be passed in because it may reflect the max of
         more than just the CDS being considered here.
+
+        The tracks of every included CDS are concatenated once per length, and
+        each metagene track is accumulated with a single bincount over the
+        concatenated positions that land on it.
     '''
     relevant_lengths, left_buffer, right_buffer = extract_lengths_and_buffers(position_counts)
 
@@ -498,82 +574,112 @@ def compute_metagene_positions(CDSs, position_counts, max_CDS_length):
         eligible_key = '{0}_num_eligible'.format(landmark)
         metagene_positions[eligible_key] = make_PositionCounts_dictionary(dtype=float)
 
+    genes = []
     for CDS in CDSs:
         # Skip CDSs that overlap other qualifying features or that have another
         # too close.
         if CDS.num_overlapping > 0:
             continue
 
-        CDS.build_coordinate_maps(left_buffer, right_buffer)
-        downstream = CDS.genomic_to_transcript.get(CDS.downstream_transcript)
-        if downstream != None:
-            if downstream - CDS.transcript_stop_codon < 100:
-                continue
-
         counts = position_counts[CDS.name]
-        CDS_length = CDS.CDS_length
-        
-        # For actual counts, we need to include left_buffer and right_buffer
-        # around start and end to avoid the artifical appearance that there are
-        # no reads base the boundaries. 
-        landmark_slices = [('start', slice(-left_buffer, CDS_length)),
-                           ('start_codon', slice(-left_buffer, CDS_length)),
-                           ('stop_codon', slice(-CDS_length, right_buffer)),
-                           ('end', slice(-CDS_length, right_buffer)),
-                          ]
-        
-        # For uniform counts, we want sharp cutoffs at start and end.
-        uniform_slices = [('start', slice(0, CDS_length)),
-                          ('start_codon', slice(-left_buffer, CDS_length)),
-                          ('stop_codon', slice(-CDS_length, right_buffer)),
-                          ('end', slice(-CDS_length, 0)),
-                         ]
-
-        for length in relevant_lengths:
-            for landmark_slice, uniform_slice in zip(landmark_slices, uniform_slices):
-                landmark, _ = landmark_slice
-                sliced_counts = counts[length][landmark_slice]
-                metagene_positions[landmark][length][landmark_slice] += sliced_counts
-
-                uniform_sliced_counts = counts[length][uniform_slice]
-                density = uniform_sliced_counts.sum() / float(len(uniform_sliced_counts))
-                uniform_counts = np.ones_like(uniform_sliced_counts) * density
-                    
-                uniform_key = '{0}_uniform'.format(landmark)
-                metagene_positions[uniform_key][length][uniform_slice] += uniform_counts
-
-                if density != 0:
-                    enrichment = uniform_sliced_counts / density
-                    enrichment_key = '{0}_sum_of_enrichments'.format(landmark)
-                    metagene_positions[enrichment_key][length][uniform_slice] += enrichment
-
-                    eligible = np.ones_like(enrichment)
-                    eligible_key = '{0}_num_eligible'.format(landmark)
-                    metagene_positions[eligible_key][length][uniform_slice] += eligible
-
-                if landmark == 'end' and length == 'three_prime_genomic':
-                    utr = counts[length]['stop_codon':'end']
-                    #print CDS.name, utr.sum() - len(utr) * density
-                
-                for b in 'TCAG':
-                    base_mask = counts['sequence'][landmark_slice] == b
-                    base_counts = np.multiply(sliced_counts, base_mask)
-                    key = '{0}_{1}'.format(landmark, b)
-                    metagene_positions[key][length][landmark_slice] += base_counts 
-
-                    # Metagene base composition could be skewed simply because
-                    # highly expressed genes happen to have a particular base
-                    # at a given offset, rather than because that base is really
-                    # occuring more often than its neighbors.
-                    # To control for expression-weighted composition, compute
-                    # the average read density for each gene and sum up
-                    # base-masked arrays of it.
-                    uniform_base_mask = counts['sequence'][uniform_slice] == b
-                    uniform_key = '{0}_{1}_uniform'.format(landmark, b)
-                    uniform_base_counts = np.multiply(uniform_counts, uniform_base_mask)
-                    metagene_positions[uniform_key][length][uniform_slice] += uniform_base_counts
-
-        CDS.delete_coordinate_maps()
+        stop_codon = counts['sequence'].landmarks['stop_codon']
+        if CDS.find_transcript_downstream(right_buffer) - stop_codon < 100:
+            continue
+
+        genes.append(counts)
+
+    if not genes:
+        return metagene_positions
+
+    # Every track of a gene shares the layout of its sequence track.
+    layouts = [gene['sequence'] for gene in genes]
+    track_lengths = np.array([len(layout.data) for layout in layouts])
+    track_starts = np.concatenate([[0], np.cumsum(track_lengths)[:-1]])
+    CDS_lengths = np.array([layout.CDS_length for layout in layouts])
+    landmark_indices = {landmark: np.array([layout.landmark_to_index[landmark] for layout in layouts])
+                        for landmark in landmarks}
+
+    sequence = np.concatenate([np.asarray(layout.data, dtype='S1') for layout in layouts])
+    base_indices = codons.nucleotide_lookup[sequence.view(np.uint8)]
+
+    metagene_length = len(metagene_positions['start'][relevant_lengths[0]].data)
+    metagene_landmark_indices = metagene_positions['start'][relevant_lengths[0]].landmark_to_index
+
+    def gather(landmark, relative_starts, relative_stops):
+        ''' Positions in the concatenated tracks of each gene's slice relative
+            to landmark, the metagene positions they land on, and the index of
+            the gene each came from.
+        '''
+        slice_lengths = relative_stops - relative_starts
+        sources = ragged_ranges(track_starts + landmark_indices[landmark] + relative_starts, slice_lengths)
+        targets = ragged_ranges(metagene_landmark_indices[landmark] + relative_starts, slice_lengths)
+        gene_indices = np.repeat(np.arange(len(genes)), slice_lengths)
+        return sources, targets, gene_indices, slice_lengths
+
+    zeros = np.zeros_like(CDS_lengths)
+    # For actual counts, we need to include left_buffer and right_buffer
+    # around start and end to avoid the artifical appearance that there are
+    # no reads base the boundaries. 
+    landmark_slices = [('start', zeros - left_buffer, CDS_lengths),
+                       ('start_codon', zeros - left_buffer, CDS_lengths),
+                       ('stop_codon', -CDS_lengths, zeros + right_buffer),
+                       ('end', -CDS_lengths, zeros + right_buffer),
+                      ]
+    
+    # For uniform counts, we want sharp cutoffs at start and end.
+    uniform_slices = [('start', zeros, CDS_lengths),
+                      ('start_codon', zeros - left_buffer, CDS_lengths),
+                      ('stop_codon', -CDS_lengths, zeros + right_buffer),
+                      ('end', -CDS_lengths, zeros),
+                     ]
+
+    def accumulate(key, length, targets, weights):
+        track = metagene_positions[key][length]
+        sums = np.bincount(targets, weights=weights, minlength=metagene_length)
+        track.data += sums.astype(track.data.dtype)
+
+    def accumulate_by_base(key_template, length, targets, bases, weights):
+        known = bases < len(codons.nucleotide_order)
+        sums = np.bincount(bases[known].astype(int) * metagene_length + targets[known],
+                           weights=weights[known],
+                           minlength=len(codons.nucleotide_order) * metagene_length,
+                          )
+        sums = sums.reshape(len(codons.nucleotide_order), metagene_length)
+        for b, i in codons.nucleotide_to_index.items():
+            track = metagene_positions[key_template.format(b)][length]
+            track.data += sums[i].astype(track.data.dtype)
+
+    gathered = []
+    for (landmark, starts, stops), (_, uniform_starts, uniform_stops) in zip(landmark_slices, uniform_slices):
+        gathered.append((landmark, gather(landmark, starts, stops), gather(landmark, uniform_starts, uniform_stops)))
+
+    for length in relevant_lengths:
+        track = np.concatenate([gene[length].data for gene in genes]).astype(float)
+
+        for landmark, (sources, targets, _, _), (uniform_sources, uniform_targets, gene_indices, uniform_lengths) in gathered:
+            sliced_counts = track[sources]
+            accumulate(landmark, length, targets, sliced_counts)
+            accumulate_by_base(landmark + '_{0}', length, targets, base_indices[sources], sliced_counts)
+
+            uniform_sliced_counts = track[uniform_sources]
+            totals = np.bincount(gene_indices, weights=uniform_sliced_counts, minlength=len(genes))
+            densities = totals / np.maximum(uniform_lengths, 1)
+            uniform_counts = densities[gene_indices]
+            accumulate(landmark + '_uniform', length, uniform_targets, uniform_counts)
+
+            # Metagene base composition could be skewed simply because
+            # highly expressed genes happen to have a particular base
+            # at a given offset, rather than because that base is really
+            # occuring more often than its neighbors.
+            # To control for expression-weighted composition, compute
+            # the average read density for each gene and sum up
+            # base-masked arrays of it.
+            accumulate_by_base(landmark + '_{0}_uniform', length, uniform_targets, base_indices[uniform_sources], uniform_counts)
+
+            eligible = uniform_counts != 0
+            enrichment = uniform_sliced_counts[eligible] / uniform_counts[eligible]
+            accumulate(landmark + '_sum_of_enrichments', length, uniform_targets[eligible], enrichment)
+            accumulate(landmark + '_num_eligible', length, uniform_targets[eligible], np.ones(eligible.sum()))
 
     return metagene_positions
 
@@ -589,10 +695,11 @@ def extract_lengths_and_buffers(position_counts):
 def compute_averaged_codon_densities(codon_counts, offset_key='relaxed', names_to_skip=set()): 
     # To reduce noise, genes with less than min_counts total counts are ignored.
     min_counts = 64
+    totals = {name: counts[offset_key].sum() for name, counts in codon_counts.iteritems()}
     try:
-        max_length = max(counts[offset_key].CDS_length
-                         for counts in codon_counts.itervalues()
-                         if counts[offset_key].sum() >= min_counts
+        max_length = max(codon_counts[name][offset_key].CDS_length
+                         for name in codon_counts
+                         if totals[name] >= min_counts
                         )
     except ValueError:
         # max() arg is an empty sequence
@@ -603,41 +710,62 @@ def compute_averaged_codon_densities(codon_counts, offset_key='relaxed', names_t
     landmarks = {'start_codon': 0,
                  'stop_codon': max_length,
                 }
-    sum_of_normalized_from_start = PositionCounts(landmarks, codon_buffer, codon_buffer, dtype=float)
-    sum_of_normalized_from_end = PositionCounts(landmarks, codon_buffer, codon_buffer, dtype=float)
-    long_enough_genes_from_start = PositionCounts(landmarks, codon_buffer, codon_buffer)
-    long_enough_genes_from_end = PositionCounts(landmarks, codon_buffer, codon_buffer)
-
-    uniform = PositionCounts(landmarks, codon_buffer, codon_buffer)
-    uniform.data[...] = 1
-
+    included = []
     for name, counts_offset_groups in codon_counts.iteritems():
         if name in names_to_skip:
             print 'skipping', name
             continue
 
         counts = counts_offset_groups[offset_key]
-        if counts.sum() < min_counts:
+        if totals[name] < min_counts:
             continue
 
-        num_codons = counts.CDS_length
-        density = counts.sum() / float(num_codons)
-        normalized = counts / float(density)
-        
-        start_slice = ('start_codon', slice(-codon_buffer, counts.CDS_length + codon_buffer))
-        sum_of_normalized_from_start[start_slice] += normalized[start_slice]
-        long_enough_genes_from_start[start_slice] += uniform[start_slice]
-        
-        end_slice = ('stop_codon', slice(-(counts.CDS_length + codon_buffer), codon_buffer))
-        sum_of_normalized_from_end[end_slice] += normalized[end_slice]
-        long_enough_genes_from_end[end_slice] += uniform[end_slice]
+        included.append((counts, totals[name]))
+
+    # Each gene contributes its counts normalized by its density from
+    # codon_buffer before its start codon to codon_buffer after its stop
+    # codon, aligned at the start codon in the from_start average and at the
+    # stop codon in the from_end average. Concatenate these windows across
+    # genes and sum each alignment with one bincount over the positions they
+    # land on. The number of genes covering each position only depends on
+    # window lengths.
+    metagene_length = max_length + 2 * codon_buffer
+    sum_of_normalized_from_start = np.zeros(metagene_length)
+    sum_of_normalized_from_end = np.zeros(metagene_length)
+    long_enough_genes_from_start = np.zeros(metagene_length, int)
+    long_enough_genes_from_end = np.zeros(metagene_length, int)
+
+    if included:
+        CDS_lengths = np.array([counts.CDS_length for counts, total in included])
+        densities = np.array([total for counts, total in included]) / CDS_lengths.astype(float)
+        window_lengths = CDS_lengths + 2 * codon_buffer
+
+        window_starts = [counts.landmark_to_index['start_codon'] - codon_buffer for counts, total in included]
+        windows = np.concatenate([counts.data[start:start + length]
+                                  for (counts, total), start, length in zip(included, window_starts, window_lengths)])
+        normalized = windows / np.repeat(densities, window_lengths)
+
+        from_start_targets = ragged_ranges(np.zeros_like(window_lengths), window_lengths)
+        from_end_targets = from_start_targets + np.repeat(metagene_length - window_lengths, window_lengths)
+
+        sum_of_normalized_from_start += np.bincount(from_start_targets, weights=normalized, minlength=metagene_length)
+        sum_of_normalized_from_end += np.bincount(from_end_targets, weights=normalized, minlength=metagene_length)
+
+        # Number of windows at least i + 1 long
+        windows_by_length = np.bincount(window_lengths, minlength=metagene_length + 1)
+        long_enough = np.cumsum(windows_by_length[::-1])[::-1][1:]
+        long_enough_genes_from_start += long_enough
+        long_enough_genes_from_end += long_enough[::-1]
 
     # Make 0 / 0 be zero instead of NaN.
-    long_enough_genes_from_start.data[long_enough_genes_from_start.data == 0] = 1
-    long_enough_genes_from_end.data[long_enough_genes_from_end.data == 0] = 1
+    long_enough_genes_from_start[long_enough_genes_from_start == 0] = 1
+    long_enough_genes_from_end[long_enough_genes_from_end == 0] = 1
+
+    def make_mean(sums, num_genes):
+        return PositionCounts(landmarks, codon_buffer, codon_buffer, data=sums / num_genes)
         
-    mean_densities = {'from_start': {'codons': sum_of_normalized_from_start / long_enough_genes_from_start},
-                      'from_end': {'codons': sum_of_normalized_from_end / long_enough_genes_from_end},
+    mean_densities = {'from_start': {'codons': make_mean(sum_of_normalized_from_start, long_enough_genes_from_start)},
+                      'from_end': {'codons': make_mean(sum_of_normalized_from_end, long_enough_genes_from_end)},
                      }
 
     return mean_densities
@@ -653,6 +781,21 @@ def normalized_codon_density_distribution(codon_counts, offset_key='relaxed'):
 
     return np.asarray(all_normalized_densities)
 
+def sum_windows_by_codon(values, window_starts, codon_indices, width, divisors=None):
+    ''' Returns an array whose [c, offset] entry is the sum of
+        values[start + offset] (divided by the window's entry in divisors, if
+        given) over every window whose codon_index is c. Windows with unknown
+        codons are dropped.
+    '''
+    num_codons = len(codons.all_codons)
+    sums = np.zeros((num_codons + 1, width))
+    for offset in range(width):
+        weights = values[window_starts + offset].astype(float)
+        if divisors is not None:
+            weights = weights / divisors
+        sums[:, offset] = np.bincount(codon_indices, weights=weights, minlength=num_codons + 1)
+    return sums[:num_codons]
+
 def compute_metacodon_counts(codon_counts):
     window = 30
 
@@ -664,7 +807,15 @@ def compute_metacodon_counts(codon_counts):
                                   }
                         for codon_id in codons.all_codons}
 
-    window_slice = ('codon', slice(-window, window))
+    # Every codon far enough from the edges of its gene contributes the window
+    # of counts around it. Gather the starts of all of these windows in the
+    # concatenated counts of every gene, along with each window's codon and
+    # the density of its gene.
+    tracks = []
+    window_starts = []
+    window_codons = []
+    window_densities = []
+    offset = 0
     for name, read_counts in codon_counts.iteritems():
         codon_identites = read_counts['identities']['start_codon':('stop_codon', 1)]
 
@@ -672,20 +823,41 @@ def compute_metacodon_counts(codon_counts):
         total_counts = counts.sum()
         num_codons = len(counts)
         density = float(total_counts) / num_codons
-        uniform_counts = np.full(2 * window, density)
-        num_eligible = np.ones(2 * window)
-
-        for p, codon_id in enumerate(codon_identites):
-            if p >= window and p <= num_codons - window:
-                id_counts = metacodon_counts[codon_id]
-                actual_counts = counts[p - window:p + window]
-                id_counts['actual'][window_slice] += actual_counts
-                id_counts['uniform'][window_slice] += uniform_counts
 
-                if density > 0:
-                    enrichments = actual_counts / density
-                    id_counts['sum_of_enrichments'][window_slice] += enrichments
-                    id_counts['num_eligible'][window_slice] += num_eligible
+        ps = np.arange(window, num_codons - window + 1)
+        tracks.append(counts)
+        window_starts.append(offset + ps - window)
+        window_codons.append(codons.encode_codons(codon_identites)[ps])
+        window_densities.append(np.full(len(ps), density))
+        offset += num_codons
+
+    if not tracks:
+        return metacodon_counts
+
+    values = np.concatenate(tracks)
+    window_starts = np.concatenate(window_starts)
+    window_codons = np.concatenate(window_codons).astype(int)
+    window_densities = np.concatenate(window_densities)
+
+    num_known = len(codons.all_codons)
+    eligible = window_densities > 0
+
+    actual = sum_windows_by_codon(values, window_starts, window_codons, 2 * window)
+    uniform = np.bincount(window_codons, weights=window_densities, minlength=num_known + 1)[:num_known]
+    sum_of_enrichments = sum_windows_by_codon(values,
+                                              window_starts[eligible],
+                                              window_codons[eligible],
+                                              2 * window,
+                                              divisors=window_densities[eligible],
+                                             )
+    num_eligible = np.bincount(window_codons[eligible], minlength=num_known + 1)[:num_known]
+
+    for c, codon_id in enumerate(codons.all_codons):
+        id_counts = metacodon_counts[codon_id]
+        id_counts['actual'].data[:] = actual[c]
+        id_counts['uniform'].data[:] = uniform[c]
+        id_counts['sum_of_enrichments'].data[:] = sum_of_enrichments[c]
+        id_counts['num_eligible'].data[:] = num_eligible[c]
 
     return metacodon_counts
 
@@ -704,24 +876,44 @@ def compute_metanucleotide_counts(read_positions):
                                       }
                         for features_key in features_keys}
 
-    feature_slice = ('feature', slice(-left_buffer, right_buffer))
-    
-    for name, read_counts in read_positions.iteritems():
-        transcript_sequence = read_counts['sequence']
+    # Gather the start of the window around every codon far enough from the
+    # edges of its coding sequence in the concatenation of each gene's
+    # tracks, which share a layout across lengths.
+    names = sorted(read_positions)
+    window_starts = []
+    window_codons = []
+    offset = 0
+    for name in names:
+        transcript_sequence = read_positions[name]['sequence']
         coding_sequence = ''.join(transcript_sequence['start_codon':('stop_codon', 3)])
 
-        for c, codon_id in enumerate(codons.codons_from_seq(coding_sequence)):
-            p = 3 * c
-            if p >= left_buffer and p <= len(coding_sequence) - right_buffer:
-                p_slice = ('start_codon', slice(p - left_buffer, p + left_buffer))
-                for length in length_keys:
-                    counts = read_positions[name][length][p_slice]
-                    metacodon_counts[codon_id][length][feature_slice] += counts
-                    
-                    #nucleotide = codon_id[0]
-                    #metacodon_counts[nucleotide][length][feature_slice] += counts
-                    #dinucleotide = codon_id[:2]
-                    #metacodon_counts[dinucleotide][length][feature_slice] += counts
+        nucleotides = codons.encode_nucleotides(coding_sequence)
+        num_full_codons = len(nucleotides) // 3
+        triples = nucleotides[:3 * num_full_codons].reshape(num_full_codons, 3).astype(int)
+        codon_indices = 16 * triples[:, 0] + 4 * triples[:, 1] + triples[:, 2]
+        codon_indices[(triples == codons.unknown_nucleotide_index).any(axis=1)] = codons.unknown_codon_index
+
+        ps = np.arange(0, 3 * num_full_codons, 3)
+        ps = ps[(ps >= left_buffer) & (ps <= len(coding_sequence) - right_buffer)]
+
+        layout = read_positions[name][length_keys[0]]
+        start_codon_index = layout.landmark_to_index['start_codon']
+
+        window_starts.append(offset + start_codon_index + ps - left_buffer)
+        window_codons.append(codon_indices[ps // 3])
+        offset += len(layout.data)
+
+    if not names:
+        return metacodon_counts
+
+    window_starts = np.concatenate(window_starts)
+    window_codons = np.concatenate(window_codons)
+
+    for length in length_keys:
+        values = np.concatenate([read_positions[name][length].data for name in names])
+        sums = sum_windows_by_codon(values, window_starts, window_codons, left_buffer + right_buffer)
+        for c, codon_id in enumerate(codons.all_codons):
+            metacodon_counts[codon_id][length].data[:] = sums[c]
 
     return metacodon_counts
 
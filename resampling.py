@@ -0,0 +1,248 @@
+''' Bootstrap and permutation intervals for mean codon and nucleotide
+    enrichments around each position, built on the same accumulation as
+    pausing_cython.fast_stratified_mean_enrichments.
+'''
+
+from __future__ import division
+import multiprocessing
+import numpy as np
+from pausing_cython import (make_arrays,
+                            make_hdf5_key,
+                            encode_gene,
+                            accumulate_gene_enrichments,
+                            StratifiedMeanEnrichments,
+                           )
+
+keys = ['codon', 'nucleotide']
+
+def clear(arrays):
+    for array in arrays.values():
+        array.fill(0)
+
+def encode_genes(codon_counts, min_mean, exclude_from_start, exclude_from_end, count_type='relaxed'):
+    ''' Encodes the ratios of counts to mean density and the codon and
+        nucleotide identities of every gene with mean density greater than
+        min_mean away from the edges, i.e. the genes that contribute to the
+        (min_mean, exclude_from_start, exclude_from_end) condition of
+        fast_stratified_mean_enrichments.
+    '''
+    cds_slice = slice(('start_codon', 2), 'stop_codon')
+
+    genes = []
+    for gene_name in sorted(codon_counts):
+        counts = codon_counts[gene_name][count_type][cds_slice]
+        length = len(counts)
+        if length <= exclude_from_start + exclude_from_end:
+            continue
+
+        mean = np.mean(counts[exclude_from_start:length - exclude_from_end])
+        if mean <= min_mean or mean == 0:
+            continue
+
+        codon_ids = codon_counts[gene_name]['identities'][cds_slice]
+        codon_indices, nucleotide_indices = encode_gene(codon_ids)
+
+        gene = {'name': gene_name,
+                'ratios': np.ascontiguousarray(counts / mean, dtype=float),
+                'codon_indices': codon_indices,
+                'nucleotide_indices': nucleotide_indices,
+                'start': exclude_from_start,
+                'end': length - exclude_from_end,
+               }
+        genes.append(gene)
+
+    return genes
+
+def accumulate(gene, num_around, occurence_arrays, total_enrichment_arrays, multiplicity=1, order=None):
+    codon_indices = gene['codon_indices']
+    nucleotide_indices = gene['nucleotide_indices']
+    if order is not None:
+        codon_indices = codon_indices[order]
+        nucleotide_indices = nucleotide_indices.reshape(-1, 3)[order].ravel()
+
+    accumulate_gene_enrichments(gene['ratios'],
+                                codon_indices,
+                                nucleotide_indices,
+                                gene['start'],
+                                gene['end'],
+                                num_around,
+                                multiplicity,
+                                occurence_arrays['codon'],
+                                total_enrichment_arrays['codon'],
+                                occurence_arrays['nucleotide'],
+                                total_enrichment_arrays['nucleotide'],
+                               )
+
+def flatten(arrays):
+    return np.concatenate([arrays[key].ravel() for key in keys])
+
+def unflatten(flat, num_around):
+    template = make_arrays(num_around, keys=keys)
+    arrays = {}
+    offset = 0
+    for key in keys:
+        shape = template[key].shape
+        size = template[key].size
+        arrays[key] = flat[..., offset:offset + size].reshape(flat.shape[:-1] + shape)
+        offset += size
+    return arrays
+
+def num_flat_features(num_around):
+    template = make_arrays(num_around, keys=keys)
+    return sum(template[key].size for key in keys)
+
+def replicate_random_state(seed, replicate):
+    ''' Each replicate draws from its own stream keyed by (seed, replicate), so
+        results don't depend on how replicates are split across processes.
+    '''
+    return np.random.RandomState([seed, replicate])
+
+def observed_enrichments(genes, num_around):
+    occurence_arrays = make_arrays(num_around, int, keys)
+    total_enrichment_arrays = make_arrays(num_around, float, keys)
+    for gene in genes:
+        accumulate(gene, num_around, occurence_arrays, total_enrichment_arrays)
+
+    enrichments = flatten(total_enrichment_arrays) / np.maximum(1, flatten(occurence_arrays))
+    return enrichments
+
+def bootstrap_replicates(genes, num_around, replicates, seed, genes_per_chunk=200):
+    ''' Resampling genes with replacement makes each replicate's totals a
+        weighted sum of per-gene totals, so per-gene totals are computed once
+        per chunk of genes and combined with every replicate's weights by a
+        matrix product.
+    '''
+    num_genes = len(genes)
+    num_features = num_flat_features(num_around)
+
+    weights = np.array([replicate_random_state(seed, r).multinomial(num_genes, np.ones(num_genes) / num_genes)
+                        for r in replicates],
+                       dtype=float,
+                      )
+
+    total_occurences = np.zeros((len(replicates), num_features))
+    total_enrichments = np.zeros((len(replicates), num_features))
+
+    occurence_arrays = make_arrays(num_around, int, keys)
+    total_enrichment_arrays = make_arrays(num_around, float, keys)
+
+    for chunk_start in range(0, num_genes, genes_per_chunk):
+        chunk = genes[chunk_start:chunk_start + genes_per_chunk]
+        chunk_occurences = np.zeros((len(chunk), num_features))
+        chunk_enrichments = np.zeros((len(chunk), num_features))
+        for i, gene in enumerate(chunk):
+            clear(occurence_arrays)
+            clear(total_enrichment_arrays)
+            accumulate(gene, num_around, occurence_arrays, total_enrichment_arrays)
+            chunk_occurences[i] = flatten(occurence_arrays)
+            chunk_enrichments[i] = flatten(total_enrichment_arrays)
+
+        chunk_weights = weights[:, chunk_start:chunk_start + len(chunk)]
+        total_occurences += np.dot(chunk_weights, chunk_occurences)
+        total_enrichments += np.dot(chunk_weights, chunk_enrichments)
+
+    return total_enrichments / np.maximum(1, total_occurences)
+
+def permutation_replicates(genes, num_around, replicates, seed):
+    ''' Each replicate shuffles the order of codons within every gene while
+        leaving the density ratios in place.
+    '''
+    num_features = num_flat_features(num_around)
+    enrichments = np.zeros((len(replicates), num_features))
+
+    occurence_arrays = make_arrays(num_around, int, keys)
+    total_enrichment_arrays = make_arrays(num_around, float, keys)
+
+    for i, replicate in enumerate(replicates):
+        random_state = replicate_random_state(seed, replicate)
+        clear(occurence_arrays)
+        clear(total_enrichment_arrays)
+        for gene in genes:
+            order = random_state.permutation(len(gene['codon_indices']))
+            accumulate(gene, num_around, occurence_arrays, total_enrichment_arrays, order=order)
+
+        enrichments[i] = flatten(total_enrichment_arrays) / np.maximum(1, flatten(occurence_arrays))
+
+    return enrichments
+
+replicate_fns = {'bootstrap': bootstrap_replicates,
+                 'permutation': permutation_replicates,
+                }
+
+# Set before a pool is forked so that workers don't need the encoded genes
+# pickled to them.
+shared_genes = []
+
+def replicates_worker(args):
+    method, num_around, replicates, seed = args
+    return replicate_fns[method](shared_genes, num_around, replicates, seed)
+
+def compute_replicates(genes, num_around, num_replicates, method='bootstrap', seed=0, num_processes=1):
+    ''' Returns a (num_replicates) x (flattened codon and nucleotide arrays)
+        array of mean enrichments.
+    '''
+    if method not in replicate_fns:
+        raise ValueError(method)
+
+    global shared_genes
+    shared_genes = genes
+
+    num_blocks = max(1, min(num_replicates, num_processes))
+    blocks = [list(block) for block in np.array_split(np.arange(num_replicates), num_blocks)]
+    tasks = [(method, num_around, block, seed) for block in blocks if len(block) > 0]
+
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes)
+        results = pool.map(replicates_worker, tasks)
+        pool.close()
+        pool.join()
+    else:
+        results = map(replicates_worker, tasks)
+
+    return np.concatenate(results)
+
+def resample_enrichments(codon_counts,
+                         num_around,
+                         condition=(0.1, 90, 90),
+                         method='bootstrap',
+                         num_replicates=1000,
+                         confidence=0.95,
+                         seed=0,
+                         num_processes=1,
+                         count_type='relaxed',
+                        ):
+    ''' Resamples the mean codon and nucleotide enrichments of condition
+        (min_mean, exclude_from_start, exclude_from_end) by bootstrapping
+        genes or by permuting codon identities within genes. Returns a
+        StratifiedMeanEnrichments with the observed enrichments under
+        'codon' and 'nucleotide', and the edges of the central confidence
+        fraction of replicates under '{key}_lower' and '{key}_upper'. For
+        permutations, '{key}_p_value' holds the fraction of replicates at
+        least as far from the mean of the replicates as the observed value.
+    '''
+    genes = encode_genes(codon_counts, *condition, count_type=count_type)
+
+    observed = observed_enrichments(genes, num_around)
+    replicates = compute_replicates(genes, num_around, num_replicates, method, seed, num_processes)
+
+    tail = (1 - confidence) / 2 * 100
+    lower, upper = np.percentile(replicates, [tail, 100 - tail], axis=0)
+
+    flat_arrays = {'': observed,
+                   '_lower': lower,
+                   '_upper': upper,
+                  }
+
+    if method == 'permutation':
+        null_means = replicates.mean(axis=0)
+        as_extreme = np.abs(replicates - null_means) >= np.abs(observed - null_means)
+        flat_arrays['_p_value'] = (1 + as_extreme.sum(axis=0)) / (1 + num_replicates)
+
+    arrays = {}
+    for suffix, flat in flat_arrays.items():
+        for key, array in unflatten(flat, num_around).items():
+            arrays[key + suffix] = array
+
+    label = make_hdf5_key(*condition)
+    resampled = StratifiedMeanEnrichments(num_around, {label: arrays})
+    return resampled
@@ -14,6 +14,8 @@ import codons
 import visualize
 import rna_experiment
 import pausing
+import feature_store
+import step_executor
 import examine_specific_codon
 from Sequencing import mapping_tools, fastq, sam, utilities, fasta, annotation
 import Sequencing.genomes as genomes
@@ -32,11 +34,14 @@ from Serialize import (read_positions,
                        expression,
                        RPKMs,
                        enrichments,
+                       ragged_counts,
+                       gene_arrays,
                       )
 from find_polyA_cython import predominantly_A
 
 class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
     num_stages = 2
+    cost_bam_key = 'merged_mappings'
     
     specific_results_files = [
         ('clean_composition', array_3d, '{name}_clean_composition.npy'),
@@ -71,6 +76,7 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
         ('codon_counts', codon_counts, '{name}_codon_counts.txt'),
         ('codon_counts_anisomycin', codon_counts, '{name}_codon_counts_anisomycin.txt'),
         ('codon_counts_stringent', codon_counts, '{name}_codon_counts_stringent.txt'),
+        ('codon_counts_hdf5', ragged_counts, '{name}_codon_counts.hdf5'),
         ('buffered_codon_counts', read_positions, '{name}_buffered_codon_counts.hdf5'),
         ('metacodon_counts', read_positions, '{name}_metacodon_counts.hdf5'),
         ('metanucleotide_counts', read_positions, '{name}_metanucleotide_counts.hdf5'),
@@ -79,8 +85,12 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
         ('mean_densities_no_misannotated', read_positions, '{name}_mean_densities_no_misannotated.hdf5'),
         ('RPKMs', RPKMs, '{name}_RPKMs.txt'),
         ('RPKMs_exclude_edges', RPKMs, '{name}_RPKMs_exclude_edges.txt'),
+        ('RPKMs_hdf5', gene_arrays, '{name}_RPKMs.hdf5'),
+        ('RPKMs_exclude_edges_hdf5', gene_arrays, '{name}_RPKMs_exclude_edges.hdf5'),
         ('read_counts', expression, '{name}_read_counts.txt'),
         ('read_counts_exclude_edges', expression, '{name}_read_counts_exclude_edges.txt'),
+        ('read_counts_hdf5', gene_arrays, '{name}_read_counts.hdf5'),
+        ('read_counts_exclude_edges_hdf5', gene_arrays, '{name}_read_counts_exclude_edges.hdf5'),
 
         ('rRNA_coverage', coverage, '{name}_rRNA_coverage.hdf5'),
         ('dominant_stretches', 'PH', '{name}_dominant_stretches.txt'),
@@ -101,6 +111,8 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
         ('stratified_mean_enrichments_anisomycin', enrichments, '{name}_stratified_mean_enrichments_anisomycin.hdf5'),
 
         ('yield', '', '{name}_yield.txt'),
+
+        ('step_fingerprints', None, '{name}_step_fingerprints.json'),
     ]
 
     specific_figure_files = [
@@ -147,8 +159,11 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
          'metagene_positions',
          'buffered_codon_counts',
          'codon_counts',
+         'codon_counts_hdf5',
          'read_counts',
          'read_counts_exclude_edges',
+         'read_counts_hdf5',
+         'read_counts_exclude_edges_hdf5',
         ],
     ]
     
@@ -181,6 +196,7 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
         ['compute_RPKMs',
          'compute_mean_densities',
          'compute_stratified_mean_enrichments',
+         'update_feature_store',
          'plot_starts_and_ends',
          'plot_frames',
         ],
@@ -214,6 +230,10 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
             self.relevant_lengths = range(start, min(stop, self.max_read_length) + 1)
         
         self.max_interesting_length = int(kwargs.get('max_interesting_length', 51))
+
+        # Gene-level results are added to a store shared across experiments
+        # if one is given.
+        self.feature_store_fn = kwargs.get('feature_store_fn', None)
         
         #if self.adapter_type == 'polyA':
         #    specific_outputs[0].extend(['unambiguous_lengths',
@@ -234,6 +254,27 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
                 gene_name, codon_number = locus.split(',')
                 self.codons_to_examine.append((gene_name, int(codon_number)))
 
+        # If cleanup_processes is given, each cleanup stage is run by
+        # step_executor, which skips steps whose outputs are up to date and
+        # runs independent steps in parallel.
+        cleanup_processes = kwargs.get('cleanup_processes')
+        if cleanup_processes != None:
+            self.cleanup = [[self.make_cleanup_runner(step_names, int(cleanup_processes))]
+                            for step_names in self.cleanup]
+
+    def make_cleanup_runner(self, step_names, num_processes):
+        def run_cleanup_steps():
+            step_executor.run_steps(self,
+                                    step_names,
+                                    self.file_names['step_fingerprints'],
+                                    num_processes,
+                                   )
+        # profile_stages rebuilds the runner around profiled steps instead
+        # of profiling the runner itself.
+        run_cleanup_steps.step_names = step_names
+        run_cleanup_steps.with_steps = lambda names: self.make_cleanup_runner(names, num_processes)
+        return run_cleanup_steps
+
     def compute_base_composition(self):
         seq_info_pairs = composition.get_seq_info_pairs(self.file_names['clean_bam'])
         all_array, perfect_array = composition.length_stratified_composition(seq_info_pairs, self.max_read_length)
@@ -866,20 +907,7 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
                                                               self.relevant_lengths,
                                                              )
 
-        self.read_positions = {}
-        for name, info in gene_infos.iteritems():
-            five_prime_counts = info['five_prime_positions']
-            three_prime_counts = info['three_prime_positions']
-
-            all_positions = {'three_prime_genomic': three_prime_counts[0],
-                             'three_prime_nongenomic': three_prime_counts['all'] - three_prime_counts[0],
-                             'three_prime_nonunique': three_prime_counts['all_nonunique'],
-                             'sequence': info['sequence'],
-                            }
-            all_positions.update(five_prime_counts)
-
-            self.read_positions[name] = all_positions
-
+        self.read_positions = positions.gene_infos_to_read_positions(gene_infos)
         self.write_file('read_positions', self.read_positions)
         
     def get_metagene_positions(self):
@@ -895,28 +923,14 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
     def compute_codon_occupancy_counts(self):
         read_positions = self.load_read_positions()
 
-        buffered_codon_counts = {}
-        codon_counts = {}
-        codon_counts_stringent = {}
-        codon_counts_anisomycin = {}
-        for name, position_counts in read_positions.iteritems():
-            buffered_counts, identities = positions.compute_codon_counts(position_counts, self.offset_type)
-            buffered_counts_stringent, _ = positions.compute_codon_counts(position_counts, self.offset_type + '_stringent')
-            buffered_counts_anisomycin, _ = positions.compute_codon_counts(position_counts, self.offset_type + '_anisomycin')
-            buffered_codon_counts[name] = {'relaxed': buffered_counts,
-                                           'stringent': buffered_counts_stringent,
-                                           'anisomycin': buffered_counts_anisomycin,
-                                           'identities': identities,
-                                          }
-            num_codons = buffered_counts.CDS_length
-
-            # + 1 is to include the stop codon
-            codon_counts[name] = buffered_counts['start_codon', :num_codons + 1]
-            codon_counts_stringent[name] = buffered_counts_stringent['start_codon', :num_codons + 1]
-            codon_counts_anisomycin[name] = buffered_counts_anisomycin['start_codon', :num_codons + 1]
+        buffered_codon_counts = positions.compute_buffered_codon_counts(read_positions, self.offset_type)
+        codon_counts = positions.extract_CDS_codon_counts(buffered_codon_counts, 'relaxed')
+        codon_counts_stringent = positions.extract_CDS_codon_counts(buffered_codon_counts, 'stringent')
+        codon_counts_anisomycin = positions.extract_CDS_codon_counts(buffered_codon_counts, 'anisomycin')
 
         self.write_file('buffered_codon_counts', buffered_codon_counts)
         self.write_file('codon_counts', codon_counts)
+        self.write_file('codon_counts_hdf5', codon_counts)
         self.write_file('codon_counts_anisomycin', codon_counts_anisomycin) 
         self.write_file('codon_counts_stringent', codon_counts_stringent)
 
@@ -924,8 +938,10 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
         read_positions = self.load_read_positions()
         read_counts = positions.compute_read_counts(read_positions, 0, 0)
         self.write_file('read_counts', read_counts)
+        self.write_file('read_counts_hdf5', read_counts)
         read_counts_exclude_edges = positions.compute_read_counts(read_positions, 30, 4)
         self.write_file('read_counts_exclude_edges', read_counts_exclude_edges)
+        self.write_file('read_counts_exclude_edges_hdf5', read_counts_exclude_edges)
 
     def compute_metacodon_counts(self):
         codon_counts = self.read_file('buffered_codon_counts')
@@ -952,10 +968,23 @@ class RibosomeProfilingExperiment(rna_experiment.RNAExperiment):
         gene_infos = self.read_file('read_counts', merged=True)
         RPKMs = positions.compute_RPKMs(gene_infos, 0, 0)
         self.write_file('RPKMs', RPKMs)
+        self.write_file('RPKMs_hdf5', RPKMs)
         
         gene_infos = self.read_file('read_counts_exclude_edges', merged=True)
         RPKMs_exclude_edges = positions.compute_RPKMs(gene_infos, 30, 4)
         self.write_file('RPKMs_exclude_edges', RPKMs_exclude_edges)
+        self.write_file('RPKMs_exclude_edges_hdf5', RPKMs_exclude_edges)
+
+    def update_feature_store(self):
+        if self.feature_store_fn == None:
+            return
+
+        feature_store.update_experiment(self.feature_store_fn,
+                                        feature_store.full_name(self),
+                                        read_counts=self.read_file('read_counts', merged=True),
+                                        RPKMs=self.read_file('RPKMs'),
+                                        stratified_mean_enrichments=self.read_file('stratified_mean_enrichments'),
+                                       )
 
 if __name__ == '__main__':
     script_path = os.path.realpath(__file__)
@@ -1,14 +1,37 @@
 import glob
 import numpy as np
-from Sequencing.Parallel import map_reduce, split_file, piece_of_list
-from Serialize import read_positions, lengths
+from Sequencing.Parallel import map_reduce, split_file
+from Serialize import read_positions, lengths, step_profile, gene_arrays
 from Sequencing import fastq
 from itertools import chain
 import gtf
 import gff
+import step_profiling
 import os
 from collections import defaultdict
 import logging
+import heapq
+import pysam
+
+# max_read_length of data directories already known from elsewhere (e.g.
+# experiment_registry's index), used instead of reading the data.
+known_max_read_lengths = {}
+
+def partition_by_cost(costs, num_pieces):
+    ''' Splits the indices of costs into num_pieces pieces of similar total
+        cost by repeatedly giving the most costly remaining item to the least
+        loaded piece. Ties are broken by index and piece number, so every
+        piece computes the same assignment. Returns a list of the (sorted)
+        indices in each piece.
+    '''
+    loads = [(0, piece) for piece in range(num_pieces)]
+    pieces = [[] for piece in range(num_pieces)]
+    for i in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        load, piece = heapq.heappop(loads)
+        pieces[piece].append(i)
+        heapq.heappush(loads, (load + costs[i], piece))
+
+    return [sorted(indices) for indices in pieces]
 
 class RNAExperiment(map_reduce.MapReduceExperiment):
     specific_results_files = [ 
@@ -19,6 +42,10 @@ class RNAExperiment(map_reduce.MapReduceExperiment):
         ('read_positions', read_positions, '{name}_read_positions.hdf5'),
         ('metagene_positions', read_positions, '{name}_metagene_positions.hdf5'),
         ('lengths', lengths, '{name}_lengths.hdf5'),
+        ('step_profile', step_profile, '{name}_step_profile.jsonl'),
+        ('cleanup_step_profile', step_profile, '{name}_cleanup_step_profile.jsonl'),
+        ('step_samples', None, '{name}_step_samples.txt'),
+        ('CDS_read_counts', gene_arrays, '{name}_CDS_read_counts.hdf5'),
     ]
 
     specific_figure_files = [
@@ -29,6 +56,11 @@ class RNAExperiment(map_reduce.MapReduceExperiment):
     specific_outputs = []
     specific_work = []
     specific_cleanup = []
+
+    # Key in merged_file_names of the indexed BAM file that stage 2 counts
+    # reads from. The cleanup of the stage that makes it counts the reads in
+    # each CDS's region once, to estimate how much work each transcript is.
+    cost_bam_key = None
     
     def __init__(self, **kwargs):
         super(RNAExperiment, self).__init__(**kwargs)
@@ -62,9 +94,92 @@ class RNAExperiment(map_reduce.MapReduceExperiment):
         self.min_length = 12
         self.max_read_length = kwargs.get('max_read_length', None)
         if self.max_read_length == None:
-            self.max_read_length = self.get_max_read_length()
+            self.max_read_length = known_max_read_lengths.get(self.data_dir)
+            if self.max_read_length == None:
+                self.max_read_length = self.get_max_read_length()
         else:
             self.max_read_length = int(self.max_read_length)
+
+        # Steps that read records (reads, transcripts) add how many they
+        # processed to this, so that profiled steps can report throughput.
+        self.records_processed = 0
+
+        if self.cost_bam_key is not None:
+            for stage, outputs in enumerate(self.outputs):
+                if self.cost_bam_key in outputs:
+                    self.cleanup[stage] = ['count_CDS_reads'] + self.cleanup[stage]
+                    break
+
+        # If profile_steps is True, the resource usage of every work and
+        # cleanup step is recorded. If sampled_step is the name of a step, it
+        # is run under a sampling profiler.
+        self.profile_steps = kwargs.get('profile_steps', 'False') == 'True'
+        self.sampled_step = kwargs.get('sampled_step', None)
+        if self.profile_steps:
+            self.profile_stages()
+
+    def profile_stages(self):
+        ''' Wraps the steps of work and cleanup to record their resource
+            usage. Subclasses that add or move steps after this has run can
+            call it again; steps that are already wrapped are only rewrapped
+            if they are now in a different stage. Steps run by a cleanup
+            runner are wrapped inside it, and the runner is rebuilt around
+            them.
+        '''
+        self.work = [[self.profiled_step(step, 'work', stage) for step in steps]
+                     for stage, steps in enumerate(self.work)]
+        self.cleanup = [[self.profiled_step(step, 'cleanup', stage) for step in steps]
+                        for stage, steps in enumerate(self.cleanup)]
+        self.outputs = [steps if 'step_profile' in steps else steps + ['step_profile']
+                        for steps in self.outputs]
+
+    def profiled_step(self, step, kind, stage):
+        if isinstance(step, tuple):
+            function, description = step
+            return (self.profiled_step(function, kind, stage), description)
+
+        if getattr(step, 'with_steps', None) is not None:
+            step_names = [self.profiled_step(name, kind, stage) for name in step.step_names]
+            return step.with_steps(step_names)
+
+        if getattr(step, 'step_name', None) is not None:
+            if (step.kind, step.stage) == (kind, stage):
+                return step
+            else:
+                step = step.unwrapped_step
+
+        if isinstance(step, basestring):
+            step_name = step
+            function = lambda: getattr(self, step_name)()
+        else:
+            step_name = getattr(step, '__name__', str(step))
+            function = step
+
+        def run_step():
+            if kind == 'work':
+                profile_fn = self.file_names['step_profile']
+            else:
+                profile_fn = self.merged_file_names['cleanup_step_profile']
+
+            if step_name == self.sampled_step:
+                samples_fn = self.file_names['step_samples']
+            else:
+                samples_fn = None
+
+            record = {'step': step_name,
+                      'kind': kind,
+                      'stage': stage,
+                      'piece': self.which_piece,
+                     }
+            step_profiling.run_profiled(self, function, record, profile_fn, samples_fn)
+
+        run_step.__name__ = step_name
+        # step_executor finds the files a step uses from this.
+        run_step.step_name = step_name
+        run_step.kind = kind
+        run_step.stage = stage
+        run_step.unwrapped_step = step
+        return run_step
         
     def get_max_read_length(self):
         def length_from_file_name(file_name):
@@ -117,6 +232,7 @@ class RNAExperiment(map_reduce.MapReduceExperiment):
 
             head, tail = os.path.split(file_name)
             self.summary.append(('Reads in {0}'.format(tail), total_reads_from_file))
+            self.records_processed += total_reads_from_file
 
         logging.info('{0:,} total reads processed'.format(total_reads))
         
@@ -179,14 +295,62 @@ class RNAExperiment(map_reduce.MapReduceExperiment):
             CDSs = [t for t in all_CDSs if t.name in transcripts]
         
         max_gene_length = 0
+        transcript_lengths = []
         for CDS in CDSs:
             CDS.build_coordinate_maps()
             max_gene_length = max(max_gene_length, CDS.transcript_length)
+            transcript_lengths.append(CDS.transcript_length)
             CDS.delete_coordinate_maps()
         
-        if force_all:
+        if force_all or self.num_pieces == 1:
             piece_CDSs = CDSs
         else:
-            piece_CDSs = piece_of_list(CDSs, self.num_pieces, self.which_piece)
+            costs = self.estimate_CDS_costs(CDSs, transcript_lengths)
+            pieces = partition_by_cost(costs, self.num_pieces)
+            piece_CDSs = [CDSs[i] for i in pieces[self.which_piece]]
+
+        self.records_processed += len(piece_CDSs)
 
         return piece_CDSs, max_gene_length
+
+    def count_CDS_reads(self):
+        ''' Counts the reads in each CDS's region of the cost BAM file, if it
+            is indexed, for estimate_CDS_costs to split stage 2 by.
+        '''
+        if self.num_pieces == 1:
+            return
+
+        bam_fn = self.merged_file_names[self.cost_bam_key]
+        if not os.path.exists(bam_fn + '.bai'):
+            return
+
+        CDSs, _ = self.get_CDSs(force_all=True)
+
+        bam_file = pysam.Samfile(bam_fn)
+        references = set(bam_file.references)
+        counts = {}
+        for CDS in CDSs:
+            if CDS.seqname in references:
+                reads = bam_file.count(CDS.seqname, max(0, CDS.start), CDS.end + 1)
+            else:
+                reads = 0
+            counts[CDS.name] = {'reads': reads}
+
+        self.write_file('CDS_read_counts', counts)
+
+    def estimate_CDS_costs(self, CDSs, transcript_lengths):
+        ''' The work of processing each of CDSs, estimated as its transcript
+            length plus the number of reads in its region of the cost BAM
+            file, if count_CDS_reads has counted them.
+        '''
+        costs = list(transcript_lengths)
+
+        if self.cost_bam_key is None or not os.path.exists(self.merged_file_names['CDS_read_counts']):
+            return costs
+
+        read_counts = self.read_file('CDS_read_counts', merged=True)
+        for i, CDS in enumerate(CDSs):
+            if CDS.name in read_counts:
+                costs[i] += int(read_counts[CDS.name]['reads'])
+
+        return costs
@@ -6,10 +6,22 @@ import subprocess
 import numpy as np
 import visualize
 import contaminants
+import Serialize
+import experiment_registry
+import feature_store
 from collections import Counter
 
-def build_all_experiments(verbose=False):
-    experiment_from_file_name = ribosome_profiling_experiment.RibosomeProfilingExperiment.from_description_file_name
+def get_experiments_prefix():
+    return '{0}/projects/ribosomes/experiments'.format(os.environ['HOME'])
+
+def get_registry_index_fn():
+    return '{0}/registry_index.json'.format(get_experiments_prefix())
+
+def build_all_experiments(verbose=False, lazy=True):
+    ''' If lazy, experiments are experiment_registry.LazyExperiment stand-ins
+        that are only built when first used.
+    '''
+    experiment_class = ribosome_profiling_experiment.RibosomeProfilingExperiment
     
     families = ['zinshteyn_plos_genetics',
                 'ingolia_science',
@@ -38,34 +50,56 @@ def build_all_experiments(verbose=False):
                 'sen_gr',
                ]
 
+    experiments_prefix = get_experiments_prefix()
+    registry_index_fn = get_registry_index_fn()
+    index = experiment_registry.read_index(registry_index_fn)
+
     experiments = {}
     for family in families:
         if verbose:
             print family
         experiments[family] = {}
-        prefix = '{0}/projects/ribosomes/experiments/{1}/'.format(os.environ['HOME'], family)
+        prefix = '{0}/{1}/'.format(experiments_prefix, family)
         dirs = [path for path in glob.glob('{}*'.format(prefix)) if os.path.isdir(path)]
         for d in sorted(dirs):
             _, name = os.path.split(d)
             if verbose:
                 print '\t', name
             description_file_name = '{0}/job/description.txt'.format(d)
-            experiments[family][name] = experiment_from_file_name(description_file_name)
+            if lazy:
+                experiments[family][name] = experiment_registry.LazyExperiment(experiment_class,
+                                                                               description_file_name,
+                                                                               index,
+                                                                               registry_index_fn,
+                                                                              )
+            else:
+                experiments[family][name] = experiment_class.from_description_file_name(description_file_name)
 
     return experiments
 
-def build_all_simulation_experiments(verbose=False):
-    experiment_from_file_name = simulate.SimulationExperiment.from_description_file_name
+def build_all_simulation_experiments(verbose=False, lazy=True):
+    experiment_class = simulate.SimulationExperiment
     
+    experiments_prefix = get_experiments_prefix()
+    registry_index_fn = get_registry_index_fn()
+    index = experiment_registry.read_index(registry_index_fn)
+
     experiments = {}
-    prefix = '{0}/projects/ribosomes/experiments/simulation/'.format(os.environ['HOME'])
+    prefix = '{0}/simulation/'.format(experiments_prefix)
     dirs = [path for path in glob.glob('{}*'.format(prefix)) if os.path.isdir(path)]
     for d in sorted(dirs):
         _, name = os.path.split(d)
         if verbose:
             print '\t', name
         description_file_name = '{0}/job/description.txt'.format(d)
-        experiments[name] = experiment_from_file_name(description_file_name)
+        if lazy:
+            experiments[name] = experiment_registry.LazyExperiment(experiment_class,
+                                                                   description_file_name,
+                                                                   index,
+                                                                   registry_index_fn,
+                                                                  )
+        else:
+            experiments[name] = experiment_class.from_description_file_name(description_file_name)
 
     return experiments
 
@@ -105,32 +139,64 @@ def make_counts_array_file(exclude_edges=False):
     os.chdir(prefix)
     if exclude_edges:
         fn = 'all_read_counts_exclude_edges.txt'
+        key = 'read_counts_exclude_edges'
     else:
         fn = 'all_read_counts.txt'
-    read_counts = {}
+        key = 'read_counts'
     full_experiments = []
     experiments = build_all_experiments()
     for family in sorted(experiments):
-        read_counts[family] = {}
         for name in sorted(experiments[family]):
             full_experiment = '{0}:{1}'.format(family, name)
             full_experiments.append(full_experiment)
-            if exclude_edges:
-                read_counts[family][name] = experiments[family][name].read_file('read_counts_exclude_edges')
-            else:
-                read_counts[family][name] = experiments[family][name].read_file('read_counts')
 
-    gene_names = sorted(read_counts[family][name].keys())
-    gene_lengths = [read_counts[family][name][gene_name]['CDS_length'] for gene_name in gene_names]
+    def get_experiment(full_experiment):
+        family, name = full_experiment.split(':')
+        return experiments[family][name]
+
+    hdf5_fns = [get_experiment(full_experiment).file_names[key + '_hdf5']
+                for full_experiment in full_experiments]
+
+    # The feature store only holds read counts over entire CDSs.
+    store_fn = get_experiment(full_experiments[0]).feature_store_fn
+    use_store = (not exclude_edges and
+                 store_fn is not None and
+                 os.path.exists(store_fn) and
+                 feature_store.has_experiments(store_fn, full_experiments)
+                )
+
+    if use_store:
+        gene_names, experiment_names, read_counts = feature_store.read_matrix(store_fn, 'read_counts')
+        # Genes are only ever appended, so this lines up with gene_names even
+        # if genes were added in between.
+        CDS_lengths = feature_store.read_vector(store_fn, 'CDS_lengths')[:len(gene_names)]
+
+        columns = [experiment_names.index(full_experiment) for full_experiment in full_experiments]
+        counts = read_counts[:, columns]
+
+        # Leave out genes that only other experiments in the store counted.
+        counted = ~np.all(np.isnan(counts), axis=1)
+        gene_names = [name for name, is_counted in zip(gene_names, counted) if is_counted]
+        full_array = np.hstack([CDS_lengths[counted, np.newaxis], counts[counted]])
+    elif all(os.path.exists(hdf5_fn) for hdf5_fn in hdf5_fns):
+        # Stack memory-mapped arrays instead of parsing every text file.
+        gene_names, gene_lengths = Serialize.gene_arrays.read_matrix(hdf5_fns[:1], 'CDS_length')
+        gene_names, counts = Serialize.gene_arrays.read_matrix(hdf5_fns, 'expression', column=0, gene_names=gene_names)
+        full_array = np.hstack([gene_lengths, counts])
+    else:
+        read_counts = {full_experiment: get_experiment(full_experiment).read_file(key)
+                       for full_experiment in full_experiments}
 
-    full_array = [gene_lengths]
+        gene_names = sorted(read_counts[full_experiment].keys())
+        gene_lengths = [read_counts[full_experiment][gene_name]['CDS_length'] for gene_name in gene_names]
 
-    for full_experiment in full_experiments:
-        family, name = full_experiment.split(':')
-        counts = [read_counts[family][name][gene_name]['expression'][0] for gene_name in gene_names]
-        full_array.append(counts)
+        full_array = [gene_lengths]
+
+        for full_experiment in full_experiments:
+            counts = [read_counts[full_experiment][gene_name]['expression'][0] for gene_name in gene_names]
+            full_array.append(counts)
 
-    full_array = np.asarray(full_array).T
+        full_array = np.asarray(full_array).T
 
     with open(fn, 'w') as fh:
         fh.write('name\tlength\t{0}\n'.format('\t'.join(full_experiments)))
@@ -6,6 +6,7 @@ ext_modules = [Extension('trim_cython', ['trim_cython.pyx']),
                Extension('composition_cython', ['composition_cython.pyx']),
                Extension('find_polyA_cython', ['find_polyA_cython.pyx']),
                Extension('pausing_cython', ['pausing_cython.pyx']),
+               Extension('simulate_cython', ['simulate_cython.pyx']),
               ]
 
 setup(
@@ -1,4 +1,6 @@
 import heapq
+import hashlib
+import multiprocessing
 import numpy as np
 import logging
 import codons
@@ -11,11 +13,36 @@ import Sequencing.Parallel
 import ribosome_profiling_experiment
 import Serialize.read_positions as read_positions
 import Serialize.enrichments as enrichments
+import simulate_cython
 
 experiment_from_fn = ribosome_profiling_experiment.RibosomeProfilingExperiment.from_description_file_name
 
 exponential = np.random.exponential
 
+def perturb_codon_means(codon_means, perturbation_model, new_codon_means=None):
+    ''' Mean elongation times for each codon after CHX is added under
+        perturbation_model. new_codon_means is only used by 'change_all'.
+    '''
+    if perturbation_model == 'same':
+        perturbed_codon_means = {codon_id: codon_means[codon_id] for codon_id in codons.all_codons}
+    elif perturbation_model == 'reciprocal':
+        perturbed_codon_means = {codon_id: 1. / codon_means[codon_id] for codon_id in codons.all_codons}
+    elif perturbation_model == 'shuffle':
+        codon_mean_values = np.array([codon_means[codon_id] for codon_id in codons.all_codons])
+        shuffle = [i * 163 % 64 for i in range(64)]
+        perturbed_codon_means = {codon_id: codon_mean_values[shuffle[i]] for i, codon_id in enumerate(codons.all_codons)}
+    elif perturbation_model == 'uniform':
+        perturbed_codon_means = {codon_id: 1 for codon_id in codons.all_codons}
+    elif perturbation_model == 'change_one':
+        perturbed_codon_means = {codon_id: codon_means[codon_id] for codon_id in codons.all_codons}
+        perturbed_codon_means['CGA'] = 1. / perturbed_codon_means['CGA']
+    elif perturbation_model == 'change_all':
+        perturbed_codon_means = new_codon_means
+    else:
+        raise ValueError(perturbation_model)
+
+    return perturbed_codon_means
+
 class Message(object):
     def __init__(self, codon_sequence, initiation_mean, codon_means, CHX_mean, perturbed_codon_means=None):
         self.codon_sequence = codon_sequence
@@ -98,26 +125,17 @@ class Message(object):
         self.CHX_introduction_time = self.current_time
 
         for ribosome in self.ribosomes.values():
-            ribosome.register_CHX_arrival_time(introduction_time)
+            ribosome.register_CHX_arrival_time(self.CHX_introduction_time)
             
         event = None
         while event != 'empty':
             event = self.process_next_event()
 
     def evolve_perturbed_CHX_model(self, perturbation_model):
-        if perturbation_model == 'reciprocal':
-            perturbed_codon_means = {codon_id: 1. / self.codon_means[codon_id] for codon_id in codons.all_codons}
-        elif perturbation_model == 'shuffle':
-            codon_mean_values = np.array([self.codon_means[codon_id] for codon_id in codons.all_codons])
-            shuffle = [i * 163 % 64 for i in range(64)]
-            perturbed_codon_means = {codon_id: codon_mean_values[shuffle[i]] for i, codon_id in enumerate(codons.all_codons)}
-        elif perturbation_model == 'uniform':
-            perturbed_codon_means = {codon_id: 1 for codon_id in codons.all_codons}
-        elif perturbation_model == 'change_one':
-            perturbed_codon_means = {codon_id: self.codon_means[codon_id] for codon_id in codons.all_codons}
-            perturbed_codon_means['CGA'] = 1. / perturbed_codon_means['CGA']
-        elif perturbation_model == 'change_all':
-            perturbed_codon_means = self.perturbed_codon_means
+        perturbed_codon_means = perturb_codon_means(self.codon_means,
+                                                    perturbation_model,
+                                                    self.perturbed_codon_means,
+                                                   )
 
         self.codon_mean_sequence = [perturbed_codon_means[codon_id] for codon_id in self.codon_sequence]
         
@@ -211,6 +229,156 @@ class Ribosome(object):
         CHX_arrival_time = time + exponential(self.message.CHX_mean)
         heapq.heappush(self.message.events, (CHX_arrival_time, 'CHX_arrival', self)) 
 
+def task_random_state(seed_key):
+    ''' Returns a RandomState whose stream is determined by seed_key, so that
+        each (experiment, gene, block) task draws the same numbers no matter
+        which process runs it or in what order.
+    '''
+    digest = hashlib.md5(repr(seed_key)).digest()
+    seed = np.frombuffer(digest, dtype=np.uint32)
+    return np.random.RandomState(seed)
+
+def estimate_simulation_cost(means, initiation_mean, target):
+    ''' Rough number of events needed to collect target ribosomes. Every
+        collected ribosome costs about one pass along the message, and
+        messages that are sparsely loaded because initiation is slow
+        relative to transit also pay for warm-up per collected ribosome.
+    '''
+    transit_time = np.sum(means)
+    messages_per_ribosome = max(1., initiation_mean / max(transit_time, 1e-9))
+    return len(means) * max(1, target) * messages_per_ribosome
+
+def count_blocks(cost, target, max_block_cost=1e8):
+    ''' Number of blocks to split a simulation of cost events collecting
+        target ribosomes into.
+    '''
+    return int(max(1, min(target, np.ceil(cost / max_block_cost))))
+
+def simulate_task(task):
+    random_state = task_random_state(task['seed_key'])
+    counts, num_messages = simulate_cython.simulate_messages(task['means'],
+                                                             task['perturbed_means'],
+                                                             task['initiation_mean'],
+                                                             task['CHX_mean'],
+                                                             task['target'],
+                                                             random_state,
+                                                             steady_state=task['steady_state'],
+                                                             snapshot_spacing=task['snapshot_spacing'],
+                                                            )
+    return counts, num_messages
+
+def make_gene_tasks(seed_prefix,
+                    gene_name,
+                    means,
+                    perturbed_means,
+                    initiation_mean,
+                    CHX_mean,
+                    target,
+                    steady_state='from_empty',
+                    snapshot_spacing=0.1,
+                    max_block_cost=1e8,
+                    num_blocks=None,
+                   ):
+    ''' Splits the simulation of target ribosomes on gene_name into blocks
+        of at most about max_block_cost events, or into num_blocks blocks if
+        it is given. Each block draws from the stream keyed by (seed_prefix,
+        gene_name, block).
+    '''
+    cost = estimate_simulation_cost(means, initiation_mean, target)
+    if num_blocks is None:
+        num_blocks = count_blocks(cost, target, max_block_cost)
+    block_targets = [len(block) for block in np.array_split(np.arange(target), num_blocks)]
+
+    tasks = []
+    for block, block_target in enumerate(block_targets):
+        task = {'seed_key': (seed_prefix, gene_name, block),
+                'gene_name': gene_name,
+                'means': means,
+                'perturbed_means': perturbed_means,
+                'initiation_mean': initiation_mean,
+                'CHX_mean': CHX_mean,
+                'target': block_target,
+                'steady_state': steady_state,
+                'snapshot_spacing': snapshot_spacing,
+                'cost': cost / num_blocks,
+               }
+        tasks.append(task)
+
+    return tasks
+
+def run_simulation_tasks(tasks, num_processes=1, pool=None):
+    ''' Runs tasks over a pool of num_processes (or over an existing pool),
+        starting the most costly first, and returns results in the same
+        order as tasks.
+    '''
+    if num_processes == 1 and pool is None:
+        return [simulate_task(task) for task in tasks]
+
+    by_cost = sorted(range(len(tasks)), key=lambda i: tasks[i]['cost'], reverse=True)
+
+    if pool is None:
+        own_pool = multiprocessing.Pool(num_processes)
+    else:
+        own_pool = None
+
+    results_by_cost = (pool or own_pool).map(simulate_task, [tasks[i] for i in by_cost], chunksize=1)
+
+    if own_pool is not None:
+        own_pool.close()
+        own_pool.join()
+
+    results = [None for _ in tasks]
+    for i, result in zip(by_cost, results_by_cost):
+        results[i] = result
+
+    return results
+
+def merge_task_results(tasks, results):
+    ''' Sums the counts and numbers of messages of the blocks of each gene. '''
+    gene_counts = {}
+    gene_messages = Counter()
+    for task, (counts, num_messages) in zip(tasks, results):
+        gene_name = task['gene_name']
+        if gene_name not in gene_counts:
+            gene_counts[gene_name] = counts
+        else:
+            gene_counts[gene_name] = gene_counts[gene_name] + counts
+        gene_messages[gene_name] += num_messages
+
+    return gene_counts, gene_messages
+
+def mean_field_counts(seed_key, means, initiation_mean, target):
+    ''' Samples target counts from the mean-field occupancy of a message. '''
+    densities, current = simulate_cython.mean_field_densities(means, initiation_mean)
+
+    if target > 0:
+        random_state = task_random_state(seed_key)
+        counts = random_state.multinomial(target, densities / densities.sum())
+    else:
+        counts = np.zeros(len(densities), int)
+
+    return counts
+
+def make_simulated_gene(identities, counts, cds_slice=slice('start_codon', ('stop_codon', 1))):
+    simulated_counts = positions.PositionCounts(identities.landmarks,
+                                                identities.left_buffer,
+                                                identities.right_buffer,
+                                               )
+    simulated_counts[cds_slice] = counts
+    
+    simulated_gene = {'identities': identities,
+                      'relaxed': simulated_counts,
+                     }
+    return simulated_gene
+
+def load_codon_means(experiment):
+    enrichments = experiment.read_file('stratified_mean_enrichments')
+    codon_means = {codon_id: enrichments['codon', 0, codon_id] for codon_id in codons.non_stop_codons}
+    for codon in codons.stop_codons:
+        codon_means[codon] = 1
+
+    return codon_means
+
 class SimulationExperiment(Sequencing.Parallel.map_reduce.MapReduceExperiment):
     num_stages = 1
 
@@ -268,6 +436,15 @@ class SimulationExperiment(Sequencing.Parallel.map_reduce.MapReduceExperiment):
 
         self.method = kwargs['method']
 
+        self.num_processes = int(kwargs.get('num_processes', 1))
+        self.max_block_cost = float(kwargs.get('max_block_cost', 1e8))
+
+        # 'from_empty' starts every measured message with no ribosomes;
+        # 'trajectory' takes snapshots of one long steady-state trajectory
+        # per block, spaced by snapshot_spacing transit times.
+        self.steady_state = kwargs.get('steady_state', 'from_empty')
+        self.snapshot_spacing = float(kwargs.get('snapshot_spacing', 0.1))
+
     def load_TEs(self):
         if self.RPF_experiment and self.mRNA_experiment:
             TEs = pausing.load_TEs(self.RPF_experiment, self.mRNA_experiment)
@@ -281,15 +458,25 @@ class SimulationExperiment(Sequencing.Parallel.map_reduce.MapReduceExperiment):
             self.simulate()
         elif self.method == 'analytical':
             self.distribute_analytically()
+        elif self.method == 'mean_field':
+            self.distribute_mean_field()
+        else:
+            raise ValueError(self.method)
 
     def simulate(self):
         buffered_codon_counts = self.template_experiment.read_file('buffered_codon_counts')
         
         codon_means = self.load_codon_means(self.template_experiment)
         if self.perturbation_model == 'change_all':
-            perturbed_codon_means = self.load_codon_means(self.new_rates_experiment)
+            new_codon_means = self.load_codon_means(self.new_rates_experiment)
         else:
-            perturbed_codon_means = None
+            new_codon_means = None
+
+        if self.perturbation_model != None:
+            perturbed_codon_means = perturb_codon_means(codon_means,
+                                                        self.perturbation_model,
+                                                        new_codon_means,
+                                                       )
 
         TEs = self.load_TEs()
         initiation_means = {gene_name: self.initiation_mean_numerator / TEs[gene_name] for gene_name in buffered_codon_counts} 
@@ -300,59 +487,52 @@ class SimulationExperiment(Sequencing.Parallel.map_reduce.MapReduceExperiment):
                                                              self.which_piece,
                                                             )
         
-        simulated_codon_counts = {}
         cds_slice = slice('start_codon', ('stop_codon', 1))
-        for i, gene_name in enumerate(piece_gene_names):
-            logging.info('Starting {0} ({1:,} / {2:,})'.format(gene_name, i, len(piece_gene_names) - 1))
-            identities = buffered_codon_counts[gene_name]['identities']
-            codon_sequence = identities[cds_slice]
+
+        tasks = []
+        for gene_name in piece_gene_names:
+            codon_sequence = buffered_codon_counts[gene_name]['identities'][cds_slice]
 
             real_counts = buffered_codon_counts[gene_name]['relaxed'][cds_slice]
             total_real_counts = sum(real_counts)
             target = int(np.ceil(total_real_counts))
 
-            all_measurements = Counter()
-            num_messages = 0
-            while sum(all_measurements.values()) < target:
-                message = Message(codon_sequence, initiation_means[gene_name], codon_means, self.CHX_mean, perturbed_codon_means=perturbed_codon_means)
-                message.evolve_to_steady_state()
-
-                if self.perturbation_model == None:
-                    message.introduce_CHX()
-                else:
-                    message.evolve_perturbed_CHX_model(self.perturbation_model)
-
-                all_measurements.update(message.collect_measurements())
-                num_messages += 1
-
-                if num_messages % 10000 == 0:
-                    logging.info('{0:,} counts generated for {1} from {2:,} messages (target = {3})'.format(sum(all_measurements.values()), gene_name, num_messages, target))
-
-            simulated_counts = positions.PositionCounts(identities.landmarks,
-                                                        identities.left_buffer,
-                                                        identities.right_buffer,
-                                                       )
+            means = np.array([codon_means[codon_id] for codon_id in codon_sequence])
+            if self.perturbation_model == None:
+                perturbed_means = None
+            else:
+                perturbed_means = np.array([perturbed_codon_means[codon_id] for codon_id in codon_sequence])
+
+            tasks.extend(make_gene_tasks(self.name,
+                                         gene_name,
+                                         means,
+                                         perturbed_means,
+                                         initiation_means[gene_name],
+                                         self.CHX_mean,
+                                         target,
+                                         self.steady_state,
+                                         self.snapshot_spacing,
+                                         self.max_block_cost,
+                                        ))
+
+        block_results = run_simulation_tasks(tasks, self.num_processes)
+        gene_counts, gene_messages = merge_task_results(tasks, block_results)
 
-            for key, value in all_measurements.items():
-                simulated_counts['start_codon', key] = value
-            
-            simulated_codon_counts[gene_name] = {'identities': identities,
-                                                 'relaxed': simulated_counts,
-                                                }
-            logging.info('{0:,} counts generated for {1} from {2:,} messages'.format(sum(all_measurements.values()), gene_name, num_messages))
+        simulated_codon_counts = {}
+        for gene_name in piece_gene_names:
+            identities = buffered_codon_counts[gene_name]['identities']
+            counts = gene_counts[gene_name]
+            simulated_codon_counts[gene_name] = make_simulated_gene(identities, counts, cds_slice)
+            logging.info('{0:,} counts generated for {1} from {2:,} messages'.format(counts.sum(), gene_name, gene_messages[gene_name]))
 
         self.write_file('simulated_codon_counts', simulated_codon_counts)
     
     def load_codon_means(self, experiment):
-        enrichments = experiment.read_file('stratified_mean_enrichments')
-        codon_means = {codon_id: enrichments['codon', 0, codon_id] for codon_id in codons.non_stop_codons}
-        for codon in codons.stop_codons:
-            codon_means[codon] = 1
-
-        return codon_means
+        return load_codon_means(experiment)
     
     def distribute_analytically(self):
         buffered_codon_counts = self.template_experiment.read_file('buffered_codon_counts')
+        codon_means = self.load_codon_means(self.template_experiment)
         
         all_gene_names = sorted(buffered_codon_counts)
         piece_gene_names = Sequencing.Parallel.piece_of_list(all_gene_names,
@@ -369,8 +549,10 @@ class SimulationExperiment(Sequencing.Parallel.map_reduce.MapReduceExperiment):
             real_counts = buffered_codon_counts[gene_name]['relaxed'][cds_slice]
             total_real_counts = sum(real_counts)
 
-            rates_array = np.array([codon_rates[codon_id] for codon_id in codon_sequence])
-            fractions_array = rates_array / sum(rates_array)
+            # Without interference, the density at each codon is proportional
+            # to the mean time spent there.
+            means_array = np.array([codon_means[codon_id] for codon_id in codon_sequence])
+            fractions_array = means_array / sum(means_array)
             
             simulated_counts = positions.PositionCounts(identities.landmarks,
                                                          identities.left_buffer,
@@ -385,6 +567,43 @@ class SimulationExperiment(Sequencing.Parallel.map_reduce.MapReduceExperiment):
                                                 }
 
         self.write_file('simulated_codon_counts', simulated_codon_counts)
+
+    def distribute_mean_field(self):
+        ''' Samples counts from the mean-field steady-state occupancy of each
+            gene, accounting for interference between ribosomes but not for
+            run-on after CHX or perturbations of elongation rates. Close to the
+            simulated profiles when interference is light; queues behind slow
+            codons in the maximal current phase are underestimated.
+        '''
+        if self.perturbation_model != None:
+            raise ValueError('mean_field method does not model perturbation_model')
+
+        buffered_codon_counts = self.template_experiment.read_file('buffered_codon_counts')
+        codon_means = self.load_codon_means(self.template_experiment)
+
+        TEs = self.load_TEs()
+
+        all_gene_names = sorted(buffered_codon_counts)
+        piece_gene_names = Sequencing.Parallel.piece_of_list(all_gene_names,
+                                                             self.num_pieces,
+                                                             self.which_piece,
+                                                            )
+        
+        simulated_codon_counts = {}
+        cds_slice = slice('start_codon', ('stop_codon', 1))
+        for gene_name in piece_gene_names:
+            identities = buffered_codon_counts[gene_name]['identities']
+            codon_sequence = identities[cds_slice]
+
+            real_counts = buffered_codon_counts[gene_name]['relaxed'][cds_slice]
+            target = int(np.ceil(sum(real_counts)))
+
+            means = np.array([codon_means[codon_id] for codon_id in codon_sequence])
+            initiation_mean = self.initiation_mean_numerator / TEs[gene_name]
+            counts = mean_field_counts((self.name, gene_name, 'mean_field'), means, initiation_mean, target)
+            simulated_codon_counts[gene_name] = make_simulated_gene(identities, counts, cds_slice)
+
+        self.write_file('simulated_codon_counts', simulated_codon_counts)
     
     def compute_stratified_mean_enrichments(self, min_means=[0.1, 0]):
         ''' Ugly duplication of code in ribosome_profiling_experiment '''
@@ -0,0 +1,527 @@
+''' Compiled simulation of translation of individual messages, following the
+    same model as simulate.Message: initiation at the first codon unless it
+    is occluded by a ribosome within the first 10 codons, elongation with
+    exponentially distributed waiting times at each codon, a 10 codon
+    footprint that blocks advancing into the ribosome ahead, and either CHX
+    arriving at each ribosome with an exponentially distributed delay or a
+    perturbation of elongation rates for a fixed time before harvest.
+'''
+
+from __future__ import division
+cimport cython
+import numpy as np
+from libc.math cimport INFINITY
+
+cdef long footprint = 10
+
+cdef enum:
+    NO_EVENT = 0
+    OTHER_EVENT = 1
+    RUNOFF = 2
+
+cdef class ExponentialBlocks:
+    ''' Standard exponential variates drawn from random_state block_size at
+        a time.
+    '''
+    cdef object random_state
+    cdef double [::1] values
+    cdef long index, block_size
+
+    def __init__(self, random_state, long block_size):
+        self.random_state = random_state
+        self.block_size = block_size
+        self.refill()
+
+    cdef int refill(self) except -1:
+        self.values = self.random_state.standard_exponential(self.block_size)
+        self.index = 0
+        return 0
+
+    cdef double next(self) except? -1:
+        if self.index == self.block_size:
+            self.refill()
+        self.index += 1
+        return self.values[self.index - 1]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef class MessageSimulator:
+    ''' Ribosomes occupy slots 0 through capacity - 1, and slot capacity
+        holds the next initiation. Each slot's next event time is kept in an
+        indexed binary heap.
+    '''
+    cdef long length, capacity, initiation_slot, num_free
+    cdef double [::1] means, perturbed_means, current_means
+    cdef double initiation_mean, CHX_mean, time, CHX_introduction_time
+    cdef bint perturbed, CHX_introduced
+    cdef double [::1] keys, advance_times, arrival_times
+    cdef long [::1] heap, heap_index, positions, free_slots, occupants
+    cdef unsigned char [::1] arrested, active
+    cdef ExponentialBlocks exponentials
+    cdef object random_state
+
+    cdef double [::1] saved_keys, saved_advance_times, saved_arrival_times
+    cdef long [::1] saved_heap, saved_heap_index, saved_positions, saved_free_slots, saved_occupants
+    cdef unsigned char [::1] saved_arrested, saved_active
+    cdef long saved_num_free
+    cdef double saved_time
+
+    def __init__(self,
+                 means,
+                 perturbed_means,
+                 double initiation_mean,
+                 double CHX_mean,
+                 random_state,
+                 long block_size=4096,
+                ):
+        self.means = np.ascontiguousarray(means, dtype=float)
+        self.length = len(self.means)
+        self.perturbed = perturbed_means is not None
+        if self.perturbed:
+            self.perturbed_means = np.ascontiguousarray(perturbed_means, dtype=float)
+        else:
+            self.perturbed_means = self.means
+        self.initiation_mean = initiation_mean
+        self.CHX_mean = CHX_mean
+
+        self.capacity = self.length // footprint + 2
+        self.initiation_slot = self.capacity
+        num_slots = self.capacity + 1
+
+        self.keys = np.empty(num_slots)
+        self.heap = np.empty(num_slots, dtype=long)
+        self.heap_index = np.empty(num_slots, dtype=long)
+        self.advance_times = np.empty(self.capacity)
+        self.arrival_times = np.empty(self.capacity)
+        self.positions = np.empty(self.capacity, dtype=long)
+        self.free_slots = np.empty(self.capacity, dtype=long)
+        self.arrested = np.empty(self.capacity, dtype=np.uint8)
+        self.active = np.empty(self.capacity, dtype=np.uint8)
+        self.occupants = np.empty(self.length, dtype=long)
+
+        self.saved_keys = np.empty_like(self.keys)
+        self.saved_heap = np.empty_like(self.heap)
+        self.saved_heap_index = np.empty_like(self.heap_index)
+        self.saved_advance_times = np.empty_like(self.advance_times)
+        self.saved_arrival_times = np.empty_like(self.arrival_times)
+        self.saved_positions = np.empty_like(self.positions)
+        self.saved_free_slots = np.empty_like(self.free_slots)
+        self.saved_arrested = np.empty_like(self.arrested)
+        self.saved_active = np.empty_like(self.active)
+        self.saved_occupants = np.empty_like(self.occupants)
+
+        self.random_state = random_state
+        self.exponentials = ExponentialBlocks(random_state, block_size)
+
+    cdef void sift_up(self, long i):
+        cdef long slot = self.heap[i]
+        cdef double key = self.keys[slot]
+        cdef long parent
+        while i > 0:
+            parent = (i - 1) >> 1
+            if self.keys[self.heap[parent]] <= key:
+                break
+            self.heap[i] = self.heap[parent]
+            self.heap_index[self.heap[i]] = i
+            i = parent
+        self.heap[i] = slot
+        self.heap_index[slot] = i
+
+    cdef void sift_down(self, long i):
+        cdef long num_slots = self.capacity + 1
+        cdef long slot = self.heap[i]
+        cdef double key = self.keys[slot]
+        cdef long child
+        while True:
+            child = 2 * i + 1
+            if child >= num_slots:
+                break
+            if child + 1 < num_slots and self.keys[self.heap[child + 1]] < self.keys[self.heap[child]]:
+                child += 1
+            if self.keys[self.heap[child]] >= key:
+                break
+            self.heap[i] = self.heap[child]
+            self.heap_index[self.heap[i]] = i
+            i = child
+        self.heap[i] = slot
+        self.heap_index[slot] = i
+
+    cdef void set_key(self, long slot, double key):
+        cdef double old_key = self.keys[slot]
+        self.keys[slot] = key
+        if key < old_key:
+            self.sift_up(self.heap_index[slot])
+        else:
+            self.sift_down(self.heap_index[slot])
+
+    cdef void update_ribosome_key(self, long slot):
+        self.set_key(slot, min(self.advance_times[slot], self.arrival_times[slot]))
+
+    cdef void reset(self):
+        cdef long i
+        for i in range(self.capacity + 1):
+            self.keys[i] = INFINITY
+            self.heap[i] = i
+            self.heap_index[i] = i
+        for i in range(self.capacity):
+            self.free_slots[i] = self.capacity - 1 - i
+            self.active[i] = 0
+        self.num_free = self.capacity
+        for i in range(self.length):
+            self.occupants[i] = -1
+        self.time = 0
+        self.current_means = self.means
+        self.CHX_introduced = False
+        self.CHX_introduction_time = INFINITY
+
+    cdef void save_state(self):
+        self.saved_keys[:] = self.keys
+        self.saved_heap[:] = self.heap
+        self.saved_heap_index[:] = self.heap_index
+        self.saved_advance_times[:] = self.advance_times
+        self.saved_arrival_times[:] = self.arrival_times
+        self.saved_positions[:] = self.positions
+        self.saved_free_slots[:] = self.free_slots
+        self.saved_arrested[:] = self.arrested
+        self.saved_active[:] = self.active
+        self.saved_occupants[:] = self.occupants
+        self.saved_num_free = self.num_free
+        self.saved_time = self.time
+
+    cdef void restore_state(self):
+        ''' Restores the state saved by save_state, which is always taken
+            before CHX or a perturbation.
+        '''
+        self.keys[:] = self.saved_keys
+        self.heap[:] = self.saved_heap
+        self.heap_index[:] = self.saved_heap_index
+        self.advance_times[:] = self.saved_advance_times
+        self.arrival_times[:] = self.saved_arrival_times
+        self.positions[:] = self.saved_positions
+        self.free_slots[:] = self.saved_free_slots
+        self.arrested[:] = self.saved_arrested
+        self.active[:] = self.saved_active
+        self.occupants[:] = self.saved_occupants
+        self.num_free = self.saved_num_free
+        self.time = self.saved_time
+        self.current_means = self.means
+        self.CHX_introduced = False
+        self.CHX_introduction_time = INFINITY
+
+    cdef int initiate(self) except -1:
+        cdef long p, slot
+        cdef long occluding = -1
+
+        for p in range(min(footprint, self.length)):
+            if self.occupants[p] >= 0:
+                occluding = self.occupants[p]
+                break
+
+        if occluding >= 0:
+            if self.arrested[occluding]:
+                # The occlusion will never clear, so there is no point in
+                # trying to initiate again later.
+                self.set_key(self.initiation_slot, INFINITY)
+            else:
+                self.set_key(self.initiation_slot, self.time + self.initiation_mean * self.exponentials.next())
+            return 0
+
+        self.num_free -= 1
+        slot = self.free_slots[self.num_free]
+        self.active[slot] = 1
+        self.arrested[slot] = 0
+        self.positions[slot] = 0
+        self.occupants[0] = slot
+        self.advance_times[slot] = self.time + self.current_means[0] * self.exponentials.next()
+        if self.CHX_introduced and self.time > self.CHX_introduction_time:
+            self.arrival_times[slot] = self.time + self.CHX_mean * self.exponentials.next()
+        else:
+            self.arrival_times[slot] = INFINITY
+        self.update_ribosome_key(slot)
+
+        self.set_key(self.initiation_slot, self.time + self.initiation_mean * self.exponentials.next())
+        return 0
+
+    cdef int advance(self, long slot) except -1:
+        cdef long p = self.positions[slot]
+
+        if p + footprint < self.length and self.occupants[p + footprint] >= 0:
+            # Occluded from advancing
+            self.advance_times[slot] = self.time + self.current_means[p] * self.exponentials.next()
+            self.update_ribosome_key(slot)
+            return OTHER_EVENT
+
+        self.occupants[p] = -1
+
+        if p == self.length - 1:
+            self.active[slot] = 0
+            self.free_slots[self.num_free] = slot
+            self.num_free += 1
+            self.advance_times[slot] = INFINITY
+            self.arrival_times[slot] = INFINITY
+            self.update_ribosome_key(slot)
+            return RUNOFF
+
+        p += 1
+        self.positions[slot] = p
+        self.occupants[p] = slot
+        self.advance_times[slot] = self.time + self.current_means[p] * self.exponentials.next()
+        self.update_ribosome_key(slot)
+        return OTHER_EVENT
+
+    cdef int step(self, double stop_time) except -1:
+        ''' Processes the next event if it happens before stop_time. '''
+        cdef long slot = self.heap[0]
+        cdef double time = self.keys[slot]
+
+        if time == INFINITY or time > stop_time:
+            return NO_EVENT
+
+        self.time = time
+
+        if slot == self.initiation_slot:
+            self.initiate()
+            return OTHER_EVENT
+        elif self.arrival_times[slot] <= self.advance_times[slot]:
+            self.arrested[slot] = 1
+            self.advance_times[slot] = INFINITY
+            self.arrival_times[slot] = INFINITY
+            self.update_ribosome_key(slot)
+            return OTHER_EVENT
+        else:
+            return self.advance(slot)
+
+    cdef int evolve_to_steady_state(self) except -1:
+        cdef double steady_state_time
+
+        while self.step(INFINITY) == OTHER_EVENT:
+            pass
+
+        steady_state_time = self.random_state.uniform(self.time, 2 * self.time)
+        while self.step(steady_state_time) != NO_EVENT:
+            pass
+        self.time = steady_state_time
+        return 0
+
+    cdef int introduce_CHX(self) except -1:
+        cdef long slot
+
+        self.CHX_introduced = True
+        self.CHX_introduction_time = self.time
+        for slot in range(self.capacity):
+            if self.active[slot]:
+                self.arrival_times[slot] = self.time + self.CHX_mean * self.exponentials.next()
+                self.update_ribosome_key(slot)
+
+        while self.step(INFINITY) != NO_EVENT:
+            pass
+        return 0
+
+    cdef int evolve_perturbed(self) except -1:
+        cdef long slot
+        cdef double harvest_time
+
+        self.current_means = self.perturbed_means
+        # Redraw the times of any elongation events from the new
+        # distributions.
+        for slot in range(self.capacity):
+            if self.active[slot]:
+                self.advance_times[slot] = self.time + self.current_means[self.positions[slot]] * self.exponentials.next()
+                self.update_ribosome_key(slot)
+
+        harvest_time = self.time + self.CHX_mean
+        while self.step(harvest_time) != NO_EVENT:
+            pass
+        self.time = harvest_time
+        return 0
+
+    cdef int evolve_for(self, double duration) except -1:
+        cdef double stop_time = self.time + duration
+        while self.step(stop_time) != NO_EVENT:
+            pass
+        self.time = stop_time
+        return 0
+
+    cdef long measure(self, long [::1] counts) except -1:
+        ''' Adds CHX or the perturbation to the current state and records
+            the positions of the ribosomes that are left.
+        '''
+        cdef long slot
+        cdef long collected = 0
+
+        if self.perturbed:
+            self.evolve_perturbed()
+        else:
+            self.introduce_CHX()
+
+        for slot in range(self.capacity):
+            if self.active[slot]:
+                counts[self.positions[slot]] += 1
+                collected += 1
+
+        return collected
+
+    def simulate(self, long target, long [::1] counts, bint trajectory=False, double spacing=0):
+        ''' Collects at least target ribosomes, adding the position of each
+            to counts. If trajectory is False, every measurement comes from a
+            new message evolved from empty to steady state. If trajectory is
+            True, a single message is evolved to steady state once, and
+            measurements are taken from copies of its state every spacing
+            time units as it continues to evolve. Returns the number of
+            ribosomes collected and the number of measurements taken.
+        '''
+        cdef long collected = 0
+        cdef long num_measurements = 0
+
+        if trajectory:
+            self.reset()
+            self.initiate()
+            self.evolve_to_steady_state()
+
+        while collected < target:
+            if trajectory:
+                self.save_state()
+            else:
+                self.reset()
+                self.initiate()
+                self.evolve_to_steady_state()
+
+            collected += self.measure(counts)
+            num_measurements += 1
+
+            if trajectory:
+                self.restore_state()
+                self.evolve_for(spacing)
+
+        return collected, num_measurements
+
+def simulate_messages(means,
+                      perturbed_means,
+                      double initiation_mean,
+                      double CHX_mean,
+                      long target,
+                      random_state=None,
+                      long block_size=4096,
+                      steady_state='from_empty',
+                      double snapshot_spacing=0.1,
+                     ):
+    ''' Simulates messages whose codons have mean elongation times means
+        until at least target ribosomes have been collected. If
+        perturbed_means is None, CHX is introduced at steady state and each
+        ribosome stops after an exponentially distributed delay with mean
+        CHX_mean; otherwise elongation switches to perturbed_means for
+        CHX_mean before harvest.
+
+        With steady_state='from_empty', each measurement is taken from an
+        independent message started with no ribosomes. With
+        steady_state='trajectory', measurements are snapshots of one long
+        trajectory spaced by snapshot_spacing times the mean transit time of
+        an unobstructed ribosome, which skips the warm-up of every message
+        after the first. Ribosomes move far from the codons they occupied
+        well within a transit time, so the default spacing of a tenth of a
+        transit time is enough to make measurements at each codon close to
+        independent.
+
+        Returns an array of ribosome counts at each codon and the number of
+        measurements taken.
+    '''
+    if random_state is None:
+        random_state = np.random.mtrand._rand
+
+    simulator = MessageSimulator(means,
+                                 perturbed_means,
+                                 initiation_mean,
+                                 CHX_mean,
+                                 random_state,
+                                 block_size,
+                                )
+    counts = np.zeros(len(means), dtype=long)
+
+    if steady_state == 'from_empty':
+        collected, num_messages = simulator.simulate(target, counts)
+    elif steady_state == 'trajectory':
+        spacing = snapshot_spacing * np.sum(means)
+        collected, num_messages = simulator.simulate(target, counts, True, spacing)
+    else:
+        raise ValueError(steady_state)
+
+    return counts, num_messages
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double densities_for_current(double current,
+                                  double [::1] rates,
+                                  long footprint_length,
+                                  double [::1] densities,
+                                 ):
+    ''' Fills in the mean-field density of ribosomes at each codon that
+        carries current through every codon, working back from the end.
+        Returns the total density in the first footprint_length codons, or
+        -1 if no profile can carry current.
+    '''
+    cdef long length = rates.shape[0]
+    cdef long i
+    cdef double window = 0
+    cdef double ahead, density
+
+    for i in range(length - 1, -1, -1):
+        # window is the total density in codons i + 1 to i + footprint_length
+        if i + footprint_length < length:
+            ahead = densities[i + footprint_length]
+        else:
+            ahead = 0
+
+        if window >= 1:
+            return -1
+
+        density = current * (1 - window + ahead) / (rates[i] * (1 - window))
+        densities[i] = density
+        window += density - ahead
+
+    if window >= 1:
+        return -1
+
+    return window
+
+def mean_field_densities(means, double initiation_mean, long footprint_length=footprint, long max_iterations=200):
+    ''' Solves the mean-field equations for a TASEP with extended particles
+        of footprint_length codons (Shaw, Zia and Lee, 2003) with elongation
+        rates 1 / means and initiation rate 1 / initiation_mean. The current
+        J through a codon i satisfies
+
+            J = k_i rho_i (1 - S_i) / (1 - S_i + rho_{i + footprint_length})
+
+        where S_i is the total density in the footprint_length codons after
+        i, and initiation requires the first footprint_length codons to be
+        free, J = alpha (1 - (total density in those codons)). Densities
+        for a given J are filled in backwards from the end, and J is found
+        by bisection. If no J satisfies the initiation condition, the
+        largest J that any profile can carry is used (maximal current
+        phase). Returns the densities and J.
+    '''
+    cdef double [::1] rates = 1. / np.ascontiguousarray(means, dtype=float)
+    cdef double initiation_rate = 1. / initiation_mean
+    cdef double low, high, middle, occupied
+    cdef long iteration
+
+    densities = np.zeros(len(means))
+    if len(means) == 0:
+        return densities, 0.
+
+    low = 0
+    high = min(np.min(rates), initiation_rate)
+
+    for iteration in range(max_iterations):
+        middle = (low + high) / 2
+        occupied = densities_for_current(middle, rates, footprint_length, densities)
+        if occupied >= 0 and initiation_rate * (1 - occupied) > middle:
+            low = middle
+        else:
+            high = middle
+
+        if high - low <= 1e-12 * high:
+            break
+
+    densities_for_current(low, rates, footprint_length, densities)
+
+    return densities, low
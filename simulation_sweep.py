@@ -0,0 +1,333 @@
+''' Runs the simulations of SimulationExperiment for a grid of parameter
+    points without a description file per point. Template data is loaded and
+    encoded once, every point's simulations share one process pool, and each
+    point's simulated codon counts and stratified mean enrichments are
+    written to a group of one HDF5 store keyed by the point's parameters.
+    Points already in the store are skipped, and the settings shared by all
+    points are recorded on the store so a resumed sweep can't mix them.
+'''
+
+import itertools
+import multiprocessing
+import logging
+import h5py
+import numpy as np
+import codons
+import pausing
+import simulate
+import Serialize.read_positions as read_positions
+import Serialize.enrichments as enrichments
+from collections import defaultdict
+
+cds_slice = slice('start_codon', ('stop_codon', 1))
+
+default_parameters = {'method': 'mechanistic',
+                      'perturbation_model': None,
+                      'steady_state': 'from_empty',
+                      'snapshot_spacing': 0.1,
+                     }
+
+def full_point(point):
+    ''' Fills in default values of any parameters missing from point. '''
+    full = dict(default_parameters)
+    full.update(point)
+    return full
+
+def point_key(point):
+    ''' A name for the store group of point that only depends on its
+        parameter values.
+    '''
+    items = sorted(full_point(point).items())
+    return ','.join('{0}={1}'.format(name, value) for name, value in items)
+
+def make_grid(**parameter_values):
+    ''' Returns every combination of the lists of values given for each
+        parameter, e.g. make_grid(CHX_mean=[0, 10], initiation_mean_numerator=[20, 50]).
+    '''
+    names = sorted(parameter_values)
+    points = [dict(zip(names, values))
+              for values in itertools.product(*[parameter_values[name] for name in names])]
+    return points
+
+def means_lookup(codon_means):
+    ''' An array of the mean of every codon indexed by encoded codon, with
+        nan for unknown codons.
+    '''
+    return np.array([codon_means[codon_id] for codon_id in codons.all_codons] + [np.nan])
+
+def load_template(template_description_fn,
+                  RPF_description_fn=None,
+                  mRNA_description_fn=None,
+                  new_rates_description_fn=None,
+                 ):
+    ''' Reads everything that SimulationExperiment reads from its template
+        experiments and encodes the coding sequence of each gene.
+    '''
+    template_experiment = simulate.experiment_from_fn(template_description_fn)
+    buffered_codon_counts = template_experiment.read_file('buffered_codon_counts',
+                                                          specific_keys={'relaxed', 'identities'},
+                                                         )
+
+    codon_means = simulate.load_codon_means(template_experiment)
+    if new_rates_description_fn:
+        new_rates_experiment = simulate.experiment_from_fn(new_rates_description_fn)
+        new_codon_means = simulate.load_codon_means(new_rates_experiment)
+    else:
+        new_codon_means = None
+
+    if RPF_description_fn and mRNA_description_fn:
+        RPF_experiment = simulate.experiment_from_fn(RPF_description_fn)
+        mRNA_experiment = simulate.experiment_from_fn(mRNA_description_fn)
+        TEs = pausing.load_TEs(RPF_experiment, mRNA_experiment)
+    else:
+        TEs = defaultdict(lambda: 1)
+
+    template = {'gene_names': sorted(buffered_codon_counts),
+                'identities': {},
+                'codon_indices': {},
+                'targets': {},
+                'TEs': {},
+                'codon_means': codon_means,
+                'new_codon_means': new_codon_means,
+               }
+
+    for gene_name in template['gene_names']:
+        identities = buffered_codon_counts[gene_name]['identities']
+        codon_indices = codons.encode_codons(identities[cds_slice])
+        if (codon_indices == codons.unknown_codon_index).any():
+            raise ValueError('{0} has an unknown codon in its coding sequence'.format(gene_name))
+
+        real_counts = buffered_codon_counts[gene_name]['relaxed'][cds_slice]
+
+        template['identities'][gene_name] = identities
+        template['codon_indices'][gene_name] = codon_indices
+        template['targets'][gene_name] = int(np.ceil(sum(real_counts)))
+        template['TEs'][gene_name] = TEs[gene_name]
+
+    return template
+
+def block_counts(template, point, max_block_cost=1e8, codon_means=None):
+    ''' The number of blocks simulate_point splits each gene's simulation
+        into for point.
+    '''
+    point = full_point(point)
+    if codon_means is None:
+        codon_means = template['codon_means']
+
+    lookup = means_lookup(codon_means)
+    counts = {}
+    for gene_name in template['gene_names']:
+        means = lookup[template['codon_indices'][gene_name]]
+        initiation_mean = point['initiation_mean_numerator'] / template['TEs'][gene_name]
+        target = template['targets'][gene_name]
+        cost = simulate.estimate_simulation_cost(means, initiation_mean, target)
+        counts[gene_name] = simulate.count_blocks(cost, target, max_block_cost)
+
+    return counts
+
+def simulate_point(template,
+                   point,
+                   pool=None,
+                   max_block_cost=1e8,
+                   codon_means=None,
+                   seed_prefix=None,
+                   num_blocks=None,
+                  ):
+    ''' Returns simulated codon counts for every gene in template under the
+        parameters of point, matching what a SimulationExperiment with the
+        same parameters would produce. codon_means overrides the template's
+        codon means, seed_prefix overrides the point's key as the prefix of
+        every task's random stream, and num_blocks (from block_counts)
+        overrides the number of blocks each gene is split into.
+    '''
+    point = full_point(point)
+    if seed_prefix is None:
+        key = point_key(point)
+    else:
+        key = seed_prefix
+
+    if codon_means is None:
+        codon_means = template['codon_means']
+
+    lookup = means_lookup(codon_means)
+    if point['perturbation_model'] is None:
+        perturbed_lookup = None
+    else:
+        perturbed_codon_means = simulate.perturb_codon_means(codon_means,
+                                                             point['perturbation_model'],
+                                                             template['new_codon_means'],
+                                                            )
+        perturbed_lookup = means_lookup(perturbed_codon_means)
+
+    if point['method'] == 'mean_field' and perturbed_lookup is not None:
+        raise ValueError('mean_field method does not model perturbation_model')
+
+    gene_counts = {}
+    tasks = []
+    for gene_name in template['gene_names']:
+        codon_indices = template['codon_indices'][gene_name]
+        means = lookup[codon_indices]
+        initiation_mean = point['initiation_mean_numerator'] / template['TEs'][gene_name]
+        target = template['targets'][gene_name]
+
+        if point['method'] == 'mechanistic':
+            if perturbed_lookup is None:
+                perturbed_means = None
+            else:
+                perturbed_means = perturbed_lookup[codon_indices]
+
+            if num_blocks is None:
+                gene_num_blocks = None
+            else:
+                gene_num_blocks = num_blocks[gene_name]
+
+            tasks.extend(simulate.make_gene_tasks(key,
+                                                  gene_name,
+                                                  means,
+                                                  perturbed_means,
+                                                  initiation_mean,
+                                                  point['CHX_mean'],
+                                                  target,
+                                                  point['steady_state'],
+                                                  point['snapshot_spacing'],
+                                                  max_block_cost,
+                                                  gene_num_blocks,
+                                                 ))
+        elif point['method'] == 'mean_field':
+            seed_key = (key, gene_name, 'mean_field')
+            gene_counts[gene_name] = simulate.mean_field_counts(seed_key, means, initiation_mean, target)
+        else:
+            raise ValueError(point['method'])
+
+    if tasks:
+        results = simulate.run_simulation_tasks(tasks, pool=pool)
+        gene_counts, _ = simulate.merge_task_results(tasks, results)
+
+    simulated_codon_counts = {}
+    for gene_name in template['gene_names']:
+        identities = template['identities'][gene_name]
+        simulated_codon_counts[gene_name] = simulate.make_simulated_gene(identities,
+                                                                         gene_counts[gene_name],
+                                                                         cds_slice,
+                                                                        )
+
+    return simulated_codon_counts
+
+def check_settings(store_fn, settings):
+    ''' Records settings, which affect the results of every point but aren't
+        part of point keys, as attrs of store_fn, or raises a ValueError if
+        store_fn already has results made with different settings.
+    '''
+    with h5py.File(store_fn, 'a') as store:
+        for name, value in sorted(settings.items()):
+            value = repr(value)
+            if name not in store.attrs:
+                store.attrs[name] = value
+            elif store.attrs[name] != value:
+                message = '{0} has results with {1}={2}, not {3}'.format(store_fn, name, store.attrs[name], value)
+                raise ValueError(message)
+
+def cached_keys(store_fn):
+    ''' Keys of the points whose results have been completely written to
+        store_fn.
+    '''
+    try:
+        with h5py.File(store_fn, 'r') as store:
+            keys = {key for key in store if store[key].attrs.get('complete', False)}
+    except IOError:
+        keys = set()
+
+    return keys
+
+def write_point(store_fn, point, simulated_codon_counts, stratified_mean_enrichments):
+    point = full_point(point)
+    key = point_key(point)
+
+    with h5py.File(store_fn, 'a') as store:
+        if key in store:
+            # Left over from an interrupted write.
+            del store[key]
+
+        group = store.create_group(key)
+        for name, value in point.items():
+            group.attrs[name] = str(value)
+
+        # Identities are the same for every point, so only counts are stored.
+        counts_only = {gene_name: {'relaxed': simulated_codon_counts[gene_name]['relaxed']}
+                       for gene_name in simulated_codon_counts}
+        read_positions.write_group(counts_only, group.create_group('simulated_codon_counts'))
+        enrichments.write_group(stratified_mean_enrichments, group.create_group('stratified_mean_enrichments'))
+
+        group.attrs['complete'] = True
+
+def read_point(store_fn, point):
+    ''' Returns the simulated 'relaxed' codon counts and stratified mean
+        enrichments stored for point.
+    '''
+    key = point_key(point)
+    with h5py.File(store_fn, 'r') as store:
+        group = store[key]
+        simulated_codon_counts = read_positions.read_group(group['simulated_codon_counts'])
+        stratified_mean_enrichments = enrichments.read_group(group['stratified_mean_enrichments'])
+
+    return simulated_codon_counts, stratified_mean_enrichments
+
+def run_sweep(store_fn,
+              points,
+              template_description_fn,
+              RPF_description_fn=None,
+              mRNA_description_fn=None,
+              new_rates_description_fn=None,
+              num_processes=1,
+              max_block_cost=1e8,
+              exclude_from_edges=[(90, 90)],
+              min_means=[0.1],
+              num_around=100,
+             ):
+    ''' Simulates every point not already in store_fn and writes its
+        results as soon as it is finished, so an interrupted sweep can be
+        resumed by running it again. Resuming with different template
+        experiments or enrichment arguments raises a ValueError.
+    '''
+    settings = {'template_description_fn': template_description_fn,
+                'RPF_description_fn': RPF_description_fn,
+                'mRNA_description_fn': mRNA_description_fn,
+                'new_rates_description_fn': new_rates_description_fn,
+                'max_block_cost': max_block_cost,
+                'exclude_from_edges': exclude_from_edges,
+                'min_means': min_means,
+                'num_around': num_around,
+               }
+    check_settings(store_fn, settings)
+
+    already_cached = cached_keys(store_fn)
+    remaining = [point for point in points if point_key(point) not in already_cached]
+    logging.info('{0} of {1} points already cached'.format(len(points) - len(remaining), len(points)))
+    if not remaining:
+        return
+
+    template = load_template(template_description_fn,
+                             RPF_description_fn,
+                             mRNA_description_fn,
+                             new_rates_description_fn,
+                            )
+
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes)
+    else:
+        pool = None
+
+    for point in remaining:
+        logging.info('simulating {0}'.format(point_key(point)))
+        simulated_codon_counts = simulate_point(template, point, pool, max_block_cost)
+        stratified_mean_enrichments = pausing.fast_stratified_mean_enrichments(simulated_codon_counts,
+                                                                               exclude_from_edges,
+                                                                               min_means,
+                                                                               num_around,
+                                                                               count_type='relaxed',
+                                                                              )
+        write_point(store_fn, point, simulated_codon_counts, stratified_mean_enrichments)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
@@ -0,0 +1,92 @@
+''' Vectorized smoothing and binning of position tracks. Every function works
+    along one axis (by default the first) of 1-D arrays or of stacks of
+    tracks.
+'''
+
+from __future__ import division
+import numpy as np
+import scipy.ndimage
+
+def cumulative_sums(array):
+    ''' sums[i] is the sum of array[:i] along axis 0. '''
+    sums = np.zeros((len(array) + 1,) + array.shape[1:])
+    np.cumsum(array, axis=0, out=sums[1:])
+    return sums
+
+def moving_average(array, half_width, edges='keep', axis=0):
+    ''' Means over windows of 2 * half_width + 1 positions centered on each
+        position. edges determines what happens within half_width of either
+        end:
+            'keep' - the original values are left in place.
+            'one_sided' - on the left, the mean of everything up to and
+                including the position; on the right, the mean of everything
+                from the position to the end.
+            'truncate' - the mean of the part of the centered window that
+                lies inside the array.
+    '''
+    array = np.moveaxis(np.asarray(array, dtype=float), axis, 0)
+    length = len(array)
+
+    if half_width == 0 or length == 0:
+        return np.moveaxis(np.copy(array), 0, axis)
+
+    sums = cumulative_sums(array)
+    positions = np.arange(length)
+    extra_dims = (slice(None),) + (np.newaxis,) * (array.ndim - 1)
+
+    if edges == 'keep':
+        smoothed = np.copy(array)
+    elif edges == 'one_sided':
+        smoothed = np.empty_like(array)
+        left = positions[:half_width]
+        smoothed[left] = sums[left + 1] / (left + 1)[extra_dims]
+        right = positions[max(0, length - half_width):]
+        smoothed[right] = (sums[length] - sums[right]) / (length - right)[extra_dims]
+    elif edges == 'truncate':
+        starts = np.maximum(0, positions - half_width)
+        ends = np.minimum(length, positions + half_width + 1)
+        smoothed = (sums[ends] - sums[starts]) / (ends - starts)[extra_dims]
+    else:
+        raise ValueError(edges)
+
+    interior = positions[half_width:length - half_width]
+    smoothed[interior] = (sums[interior + half_width + 1] - sums[interior - half_width]) / float(2 * half_width + 1)
+
+    return np.moveaxis(smoothed, 0, axis)
+
+def gaussian_smooth(array, sigma, truncate=4.0, axis=0):
+    ''' Convolves with a Gaussian kernel of standard deviation sigma
+        positions. Near the ends, the kernel is renormalized over the part
+        that lies inside the array rather than treating the outside as zero.
+    '''
+    array = np.asarray(array, dtype=float)
+    if sigma == 0:
+        return np.copy(array)
+
+    filtered = scipy.ndimage.gaussian_filter1d(array, sigma, axis=axis, mode='constant', truncate=truncate)
+    weights = scipy.ndimage.gaussian_filter1d(np.ones(array.shape[axis]), sigma, mode='constant', truncate=truncate)
+
+    shape = [1] * array.ndim
+    shape[axis] = -1
+    return filtered / weights.reshape(shape)
+
+def bin_sums(array, bin_width, axis=0):
+    ''' Sums over consecutive bins of bin_width positions. A final partial bin
+        is kept.
+    '''
+    array = np.asarray(array)
+    bin_starts = np.arange(0, array.shape[axis], bin_width)
+    return np.add.reduceat(array, bin_starts, axis=axis)
+
+def bin_means(array, bin_width, axis=0):
+    ''' Means over consecutive bins of bin_width positions. A final partial
+        bin is averaged over the positions it contains.
+    '''
+    array = np.asarray(array)
+    length = array.shape[axis]
+    bin_starts = np.arange(0, length, bin_width)
+    bin_sizes = np.minimum(bin_width, length - bin_starts)
+
+    shape = [1] * array.ndim
+    shape[axis] = -1
+    return bin_sums(array, bin_width, axis=axis) / bin_sizes.reshape(shape).astype(float)
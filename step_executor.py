@@ -0,0 +1,227 @@
+''' Runs the steps of one stage of an experiment's work or cleanup in
+    dependency order, skipping steps whose outputs are up to date and running
+    independent steps in parallel.
+
+    The files a step reads and writes are found by scanning its source (and
+    the source of the experiment methods it calls) for read_file/write_file
+    calls, figure_file_names lookups, and file_names/merged_file_names
+    lookups, which are outputs when followed by a mode that writes (e.g.
+    open(self.file_names['yield'], 'w')) and inputs otherwise. A step is up
+    to date if all of its outputs exist and the fingerprint of its inputs and
+    of the experiment's parameters hasn't changed since it last ran. Steps with no outputs that
+    can be found always run, and nothing runs alongside them.
+'''
+
+import os
+import re
+import json
+import time
+import inspect
+import hashlib
+import logging
+import multiprocessing
+
+fingerprint_parameters = ['relevant_lengths',
+                          'offset_type',
+                          'adapter_type',
+                          'max_read_length',
+                         ]
+
+# Each pattern finds keys of one of the experiment's dictionaries of file
+# names: 'file' (file_names), 'merged' (merged_file_names) or 'figure'
+# (figure_file_names).
+output_patterns = [('file', re.compile(r"write_file\(\s*'(\w+)'")),
+                   ('figure', re.compile(r"figure_file_names\['(\w+)'\]")),
+                   # File names passed along with a mode that writes, as in
+                   # open(self.file_names['yield'], 'w').
+                   ('file', re.compile(r"(?<!merged_)(?<!figure_)file_names\['(\w+)'\]\s*,\s*'[wa]b?'")),
+                   ('merged', re.compile(r"merged_file_names\['(\w+)'\]\s*,\s*'[wa]b?'")),
+                  ]
+input_patterns = [('file', re.compile(r"read_file\(\s*'(\w+)'(?!\s*,\s*merged=True)")),
+                  ('merged', re.compile(r"read_file\(\s*'(\w+)'\s*,\s*merged=True")),
+                  ('file', re.compile(r"(?<!merged_)(?<!figure_)file_names\['(\w+)'\]")),
+                  ('merged', re.compile(r"merged_file_names\['(\w+)'\]")),
+                 ]
+call_pattern = re.compile(r"self\.(\w+)\(")
+
+def scan_method(experiment, method_name, seen):
+    ''' (namespace, key) pairs read and written by method_name and the
+        methods it calls.
+    '''
+    inputs = set()
+    outputs = set()
+    if method_name in seen:
+        return inputs, outputs
+    seen.add(method_name)
+
+    try:
+        source = inspect.getsource(getattr(experiment, method_name))
+    except (AttributeError, TypeError, IOError):
+        return inputs, outputs
+
+    for namespace, pattern in output_patterns:
+        outputs.update((namespace, key) for key in pattern.findall(source))
+    for namespace, pattern in input_patterns:
+        inputs.update((namespace, key) for key in pattern.findall(source))
+
+    for called in call_pattern.findall(source):
+        called_inputs, called_outputs = scan_method(experiment, called, seen)
+        inputs.update(called_inputs)
+        outputs.update(called_outputs)
+
+    return inputs, outputs
+
+def resolve(experiment, pairs):
+    ''' File names of (namespace, key) pairs, skipping keys that aren't
+        results or figure files of experiment.
+    '''
+    namespaces = {'file': experiment.file_names,
+                  'merged': getattr(experiment, 'merged_file_names', experiment.file_names),
+                  'figure': experiment.figure_file_names,
+                 }
+    fns = {namespaces[namespace][key] for namespace, key in pairs if key in namespaces[namespace]}
+    return fns
+
+def step_files(experiment, step_name):
+    ''' Returns the file names of the inputs and outputs of step_name. '''
+    inputs, outputs = scan_method(experiment, step_name, set())
+
+    output_fns = resolve(experiment, outputs)
+    # A file that a step writes isn't also one of its inputs, even if its
+    # name is looked up again after it is opened.
+    input_fns = resolve(experiment, inputs) - output_fns
+
+    return sorted(input_fns), sorted(output_fns)
+
+def fingerprint(experiment, step_name, input_fns):
+    def describe_file(fn):
+        if os.path.exists(fn):
+            return [fn, os.path.getsize(fn), os.path.getmtime(fn)]
+        else:
+            return [fn, None, None]
+
+    parameters = [[name, repr(getattr(experiment, name, None))] for name in fingerprint_parameters]
+    description = [step_name, parameters, [describe_file(fn) for fn in input_fns]]
+    return hashlib.sha1(json.dumps(description)).hexdigest()
+
+def read_fingerprints(fingerprints_fn):
+    if os.path.exists(fingerprints_fn):
+        fingerprints = json.load(open(fingerprints_fn))
+    else:
+        fingerprints = {}
+    return fingerprints
+
+def write_fingerprints(fingerprints, fingerprints_fn):
+    temp_fn = fingerprints_fn + '.tmp'
+    with open(temp_fn, 'w') as fingerprints_fh:
+        json.dump(fingerprints, fingerprints_fh, indent=1, sort_keys=True)
+    os.rename(temp_fn, fingerprints_fn)
+
+def make_steps(experiment, step_names):
+    ''' Returns a list of dictionaries describing each step, including the
+        indices of the earlier steps it has to wait for.
+    '''
+    steps = []
+    for i, step_name in enumerate(step_names):
+        if isinstance(step_name, basestring):
+            input_fns, output_fns = step_files(experiment, step_name)
+            function = getattr(experiment, step_name)
+        elif getattr(step_name, 'step_name', None) is not None:
+            # Steps wrapped by RNAExperiment.profiled_step run the method
+            # named step_name.
+            function = step_name
+            step_name = function.step_name
+            input_fns, output_fns = step_files(experiment, step_name)
+        else:
+            # map_reduce also accepts callables and (callable, description)
+            # pairs, whose files can't be found.
+            input_fns, output_fns = [], []
+            if isinstance(step_name, tuple):
+                function = step_name[0]
+            else:
+                function = step_name
+            step_name = getattr(function, '__name__', str(function))
+
+        step = {'name': step_name,
+                'function': function,
+                'input_fns': input_fns,
+                'output_fns': output_fns,
+                'is_barrier': len(output_fns) == 0,
+               }
+
+        if step['is_barrier']:
+            step['waits_for'] = set(range(i))
+        else:
+            step['waits_for'] = set()
+            for j, earlier in enumerate(steps):
+                if earlier['is_barrier'] or set(earlier['output_fns']) & set(input_fns):
+                    step['waits_for'].add(j)
+
+        steps.append(step)
+
+    return steps
+
+def run_steps(experiment, step_names, fingerprints_fn, num_processes=1):
+    ''' Runs step_names (as they would appear in a stage of work or cleanup)
+        on experiment, skipping up to date steps. With num_processes > 1,
+        steps whose inputs don't depend on each other's outputs run at the
+        same time in forked processes, so steps should only communicate
+        through files.
+    '''
+    steps = make_steps(experiment, step_names)
+    fingerprints = read_fingerprints(fingerprints_fn)
+
+    def is_up_to_date(step, current):
+        if step['is_barrier']:
+            return False
+        all_exist = all(os.path.exists(fn) for fn in step['output_fns'])
+        return all_exist and fingerprints.get(step['name']) == current
+
+    def record(step, current):
+        if not step['is_barrier']:
+            fingerprints[step['name']] = current
+            write_fingerprints(fingerprints, fingerprints_fn)
+
+    finished = set()
+    running = {}
+
+    while len(finished) < len(steps):
+        for i, step in enumerate(steps):
+            if i in finished or i in running or not step['waits_for'] <= finished:
+                continue
+
+            if step['is_barrier'] and running:
+                break
+
+            current = fingerprint(experiment, step['name'], step['input_fns'])
+            if is_up_to_date(step, current):
+                logging.info('{0} is up to date'.format(step['name']))
+                finished.add(i)
+                continue
+
+            if num_processes == 1 or step['is_barrier']:
+                logging.info('running {0}'.format(step['name']))
+                step['function']()
+                record(step, current)
+                finished.add(i)
+            elif len(running) < num_processes:
+                logging.info('starting {0}'.format(step['name']))
+                process = multiprocessing.Process(target=step['function'])
+                process.start()
+                running[i] = (process, current)
+
+            if step['is_barrier']:
+                # Anything after a barrier has to wait for it.
+                break
+
+        for i, (process, current) in running.items():
+            if not process.is_alive():
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError('{0} failed'.format(steps[i]['name']))
+                record(steps[i], current)
+                finished.add(i)
+                del running[i]
+
+        if running:
+            time.sleep(0.1)
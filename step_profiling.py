@@ -0,0 +1,233 @@
+''' Records the wall time, CPU time, peak RSS, records processed and bytes
+    read and written of each work and cleanup step of an experiment.
+
+    Work steps append a record to their piece's step_profile file, which is
+    merged across pieces like any other output. Cleanup steps append to the
+    merged cleanup_step_profile file. CPU time includes waited-for child
+    processes (e.g. aligners), but bytes read and written only count the
+    step's own process. Peak RSS is measured per step by resetting the
+    process's high water mark before the step, and includes children whose
+    peak exceeded that of every earlier child.
+
+    One named step can also be run under StackSampler, a sampling profiler
+    that writes collapsed stacks (the input format of flamegraph.pl).
+'''
+
+import os
+import time
+import signal
+import resource
+from collections import Counter, defaultdict
+from Serialize import step_profile
+
+def read_io_counts():
+    ''' Bytes read and written by this process so far, or Nones if
+        /proc/self/io isn't available.
+    '''
+    counts = {}
+    try:
+        for line in open('/proc/self/io'):
+            key, value = line.split(':')
+            counts[key] = int(value)
+    except IOError:
+        pass
+
+    return counts.get('rchar'), counts.get('wchar')
+
+def reset_peak_rss():
+    ''' Resets this process's peak RSS (VmHWM) to its current RSS. Returns
+        False if /proc/self/clear_refs isn't available.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_fh:
+            clear_refs_fh.write('5')
+    except IOError:
+        return False
+    return True
+
+def read_peak_rss_MB():
+    ''' This process's peak RSS since it started or was last reset, or None
+        if /proc/self/status isn't available.
+    '''
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                kilobytes = int(line.split()[1])
+                return kilobytes / 1024.
+    except IOError:
+        pass
+    return None
+
+def get_usage():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    bytes_read, bytes_written = read_io_counts()
+
+    usage = {'wall_time': time.time(),
+             'cpu_time': sum(u.ru_utime + u.ru_stime for u in [self_usage, children_usage]),
+             'peak_rss_MB': read_peak_rss_MB(),
+             # ru_maxrss is in kilobytes on Linux.
+             'children_peak_rss_MB': children_usage.ru_maxrss / 1024.,
+             'bytes_read': bytes_read,
+             'bytes_written': bytes_written,
+            }
+    return usage
+
+def step_peak_rss_MB(before, after, could_reset):
+    ''' The peak RSS of a step, from usages before and after it. Children's
+        peak RSS is only known over the life of the process, so it only
+        counts if it grew during the step.
+    '''
+    if could_reset:
+        peak = after['peak_rss_MB']
+    else:
+        peak = None
+
+    children_peak = after['children_peak_rss_MB']
+    if children_peak > before['children_peak_rss_MB'] and (peak is None or children_peak > peak):
+        peak = children_peak
+
+    return peak
+
+class StackSampler(object):
+    ''' Counts the call stacks of the main thread every interval seconds of
+        CPU time.
+    '''
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = Counter()
+        self.previous_handler = None
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler)
+
+    def write(self, file_name):
+        with open(file_name, 'w') as fh:
+            for stack, count in self.counts.most_common():
+                fh.write('{0} {1}\n'.format(stack, count))
+
+def run_profiled(experiment, function, record, profile_fn, samples_fn=None):
+    ''' Calls function and appends record, filled in with the resources it
+        used, to profile_fn. If samples_fn is given, function is sampled by a
+        StackSampler whose counts are written to samples_fn.
+    '''
+    records_before = experiment.records_processed
+    could_reset = reset_peak_rss()
+    before = get_usage()
+    succeeded = False
+
+    if samples_fn is not None:
+        sampler = StackSampler()
+        sampler.start()
+
+    try:
+        function()
+        succeeded = True
+    finally:
+        if samples_fn is not None:
+            sampler.stop()
+            sampler.write(samples_fn)
+
+        after = get_usage()
+        record['started'] = before['wall_time']
+        record['succeeded'] = succeeded
+        record['records'] = experiment.records_processed - records_before
+        record['peak_rss_MB'] = step_peak_rss_MB(before, after, could_reset)
+        for key in ['wall_time', 'cpu_time', 'bytes_read', 'bytes_written']:
+            if after[key] is None:
+                record[key] = None
+            else:
+                record[key] = after[key] - before[key]
+
+        step_profile.append_record(record, profile_fn)
+
+def read_records(experiment):
+    ''' All records of experiment's merged profile files. '''
+    records = []
+    for key in ['step_profile', 'cleanup_step_profile']:
+        file_name = experiment.merged_file_names[key]
+        if os.path.exists(file_name):
+            records.extend(step_profile.read_file(file_name))
+    return records
+
+def summarize(records):
+    ''' Aggregates records across pieces into one dictionary per step, in
+        the order the steps ran. Only the latest record of each step of each
+        piece is used, since reruns append to existing files.
+    '''
+    latest = {}
+    for record in records:
+        key = (record['kind'], record['stage'], record['step'], record['piece'])
+        if key not in latest or record['started'] > latest[key]['started']:
+            latest[key] = record
+
+    by_step = defaultdict(list)
+    for (kind, stage, step, piece), record in latest.items():
+        by_step[kind, stage, step].append(record)
+
+    def maximum(step_records, key):
+        values = [r[key] for r in step_records if r[key] is not None]
+        if values:
+            return max(values)
+        else:
+            return None
+
+    def total(step_records, key):
+        values = [r[key] for r in step_records]
+        if None in values:
+            return None
+        else:
+            return sum(values)
+
+    summaries = []
+    for (kind, stage, step), step_records in by_step.items():
+        summary = {'kind': kind,
+                   'stage': stage,
+                   'step': step,
+                   'pieces': len(step_records),
+                   'started': min(r['started'] for r in step_records),
+                   'succeeded': all(r['succeeded'] for r in step_records),
+                   'max_wall_time': max(r['wall_time'] for r in step_records),
+                   'peak_rss_MB': maximum(step_records, 'peak_rss_MB'),
+                  }
+        for key in ['wall_time', 'cpu_time', 'records', 'bytes_read', 'bytes_written']:
+            summary[key] = total(step_records, key)
+
+        summaries.append(summary)
+
+    summaries.sort(key=lambda s: s['started'])
+    return summaries
+
+def find_regressions(old_summaries, new_summaries, threshold=1.5, min_time=1.):
+    ''' Steps whose slowest piece took at least threshold times as long in
+        new_summaries as in old_summaries, as (step, old time, new time).
+        Steps that took less than min_time seconds in both are ignored.
+    '''
+    old_times = {(s['kind'], s['stage'], s['step']): s['max_wall_time'] for s in old_summaries}
+
+    regressions = []
+    for summary in new_summaries:
+        key = (summary['kind'], summary['stage'], summary['step'])
+        if key not in old_times:
+            continue
+        old_time = old_times[key]
+        new_time = summary['max_wall_time']
+        if max(old_time, new_time) < min_time:
+            continue
+        if new_time >= threshold * old_time:
+            regressions.append((summary['step'], old_time, new_time))
+
+    return regressions
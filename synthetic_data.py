@@ -0,0 +1,357 @@
+''' A small synthetic organism and ribosome profiling experiment on it, for
+    benchmarking without downloaded data or aligners. make_all writes
+    - a genome directory with one fasta file (and index) per sequence,
+    - a GFF of genes, some spliced and some overlapping their neighbors, and
+      an rRNA,
+    - FASTQ files of footprints followed by either a linker or a poly-A
+      tail, with rRNA fragments mixed in,
+    - a coordinate-sorted, indexed BAM file of the footprints as they would
+      be mapped, built directly with pysam.
+    Everything is drawn from a RandomState seeded by the caller, so the same
+    seed and sizes always give the same files.
+'''
+
+import os
+import json
+import numpy as np
+import pysam
+import Sequencing.utilities as utilities
+import codons
+import trim
+
+# Footprint lengths and the offset of the A site from their 5' ends, as in
+# positions.A_site_offsets['yeast'].
+footprint_lengths = [27, 28, 29, 30, 31]
+footprint_length_weights = [0.05, 0.2, 0.4, 0.3, 0.05]
+A_site_offsets = {27: 15, 28: 15, 29: 15, 30: 16, 31: 16}
+
+read_length = 50
+edge_margin = 1000
+
+def random_seq(random_state, length):
+    bases = np.array(list('TCAG'))
+    return ''.join(bases[random_state.randint(4, size=length)])
+
+def coding_sequence(random_state, num_codons):
+    ''' A start codon, num_codons - 2 random sense codons, and a stop codon. '''
+    sense_codons = [c for c in codons.non_stop_codons if c != 'ATG']
+    middle = random_state.choice(sense_codons, size=num_codons - 2)
+    stop = random_state.choice(codons.stop_codons)
+    return 'ATG' + ''.join(middle) + stop
+
+def layout_genes(random_state, seq_lengths, num_genes):
+    ''' Lays genes out along the sequences. A gene is a dictionary of its
+        strand, its exons in genomic order, and its CDS segments in genomic
+        order, with inclusive 0-based coordinates. About a third of genes
+        have an intron in their CDS and about one in five overlap the
+        untranslated end of the previous gene.
+    '''
+    genes = []
+    seqnames = sorted(seq_lengths)
+    genes_per_seq = int(np.ceil(num_genes / float(len(seqnames))))
+
+    for seqname in seqnames:
+        position = edge_margin
+        previous = None
+        for i in range(genes_per_seq):
+            if len(genes) == num_genes:
+                break
+
+            UTR_5 = random_state.randint(50, 150)
+            UTR_3 = random_state.randint(50, 200)
+            num_codons = random_state.randint(200, 600)
+            CDS_length = 3 * num_codons
+
+            strand = random_state.choice(['+', '-'])
+            overlaps = previous is not None and random_state.rand() < 0.2
+            if overlaps:
+                # Only untranslated regions overlap, so every base of each
+                # coding sequence is determined by one gene.
+                previous_right_UTR = previous['end'] - previous['CDSs'][-1][1]
+                left_UTR = UTR_3 if strand == '-' else UTR_5
+                overlap = random_state.randint(1, min(previous_right_UTR, left_UTR))
+                start = previous['end'] + 1 - overlap
+            else:
+                start = position + random_state.randint(100, 1000)
+
+            if strand == '+':
+                left_UTR, right_UTR = UTR_5, UTR_3
+            else:
+                left_UTR, right_UTR = UTR_3, UTR_5
+
+            CDS_start = start + left_UTR
+            if random_state.rand() < 0.33:
+                intron_start = CDS_start + 3 * random_state.randint(20, num_codons - 20) + 1
+                intron_length = random_state.randint(60, 300)
+                first_part = intron_start - CDS_start
+                CDSs = [(CDS_start, intron_start - 1),
+                        (intron_start + intron_length, intron_start + intron_length + CDS_length - first_part - 1),
+                       ]
+            else:
+                CDSs = [(CDS_start, CDS_start + CDS_length - 1)]
+
+            end = CDSs[-1][1] + right_UTR
+            exons = [(start, CDSs[0][1])] + CDSs[1:-1] + [(CDSs[-1][0], end)]
+            if len(CDSs) == 1:
+                exons = [(start, end)]
+
+            if end + edge_margin > seq_lengths[seqname]:
+                break
+
+            gene = {'name': 'gene{0:05d}'.format(len(genes)),
+                    'seqname': seqname,
+                    'strand': strand,
+                    'start': start,
+                    'end': end,
+                    'exons': exons,
+                    'CDSs': CDSs,
+                    'expression': random_state.lognormal(0, 1.5),
+                   }
+            genes.append(gene)
+            previous = gene
+            position = end
+
+    return genes
+
+def genomic_positions(exons, strand):
+    ''' The genomic position of each transcript position. '''
+    positions = np.concatenate([np.arange(start, end + 1) for start, end in exons])
+    if strand == '-':
+        positions = positions[::-1]
+    return positions
+
+def make_genome(random_state, seq_lengths, genes):
+    genome = {name: bytearray(random_seq(random_state, length))
+              for name, length in seq_lengths.items()}
+
+    for gene in genes:
+        positions = genomic_positions(gene['CDSs'], gene['strand'])
+        CDS = coding_sequence(random_state, len(positions) // 3)
+        if gene['strand'] == '-':
+            CDS = utilities.reverse_complement(CDS)
+            positions = positions[::-1]
+        for position, base in zip(positions, CDS):
+            genome[gene['seqname']][position] = base
+
+    return {name: str(seq) for name, seq in genome.items()}
+
+def write_genome(genome, genome_dir):
+    if not os.path.isdir(genome_dir):
+        os.makedirs(genome_dir)
+
+    for name in sorted(genome):
+        fasta_fn = '{0}/{1}.fa'.format(genome_dir, name)
+        with open(fasta_fn, 'w') as fasta_fh:
+            fasta_fh.write('>{0}\n'.format(name))
+            seq = genome[name]
+            for i in range(0, len(seq), 60):
+                fasta_fh.write(seq[i:i + 60] + '\n')
+        pysam.faidx(fasta_fn)
+
+def write_gff(genes, rRNA, gff_fn):
+    def line(seqname, feature, start, end, strand, attribute):
+        # GFF coordinates are 1-based.
+        fields = [seqname, 'synthetic', feature, str(start + 1), str(end + 1), '.', strand, '.', attribute]
+        return '\t'.join(fields) + '\n'
+
+    with open(gff_fn, 'w') as gff_fh:
+        gff_fh.write('##gff-version 3\n')
+        for gene in genes:
+            name = gene['name']
+            mRNA = name + '_mRNA'
+            gff_fh.write(line(gene['seqname'], 'gene', gene['start'], gene['end'], gene['strand'], 'ID=' + name))
+            gff_fh.write(line(gene['seqname'], 'mRNA', gene['start'], gene['end'], gene['strand'],
+                              'ID={0};Parent={1}'.format(mRNA, name)))
+            for i, (start, end) in enumerate(gene['exons']):
+                gff_fh.write(line(gene['seqname'], 'exon', start, end, gene['strand'],
+                                  'ID={0}_exon{1};Parent={2}'.format(name, i, mRNA)))
+            for i, (start, end) in enumerate(gene['CDSs']):
+                gff_fh.write(line(gene['seqname'], 'CDS', start, end, gene['strand'],
+                                  'ID={0}_CDS{1};Parent={2}'.format(name, i, mRNA)))
+
+        name = rRNA['name']
+        gff_fh.write(line(rRNA['seqname'], 'rRNA', rRNA['start'], rRNA['end'], '+', 'ID=' + name))
+        gff_fh.write(line(rRNA['seqname'], 'noncoding_exon', rRNA['start'], rRNA['end'], '+',
+                          'ID={0}_exon0;Parent={0}'.format(name)))
+
+def make_footprints(random_state, genome, genes, num_reads):
+    ''' Draws footprints from genes in proportion to their expression, with
+        A sites in the CDS and the 5' end in frame. Returns a list of
+        dictionaries of each footprint's gene, sequence in read orientation
+        and genomic positions in read orientation.
+    '''
+    weights = np.array([gene['expression'] for gene in genes])
+    gene_indices = random_state.choice(len(genes), size=num_reads, p=weights / weights.sum())
+
+    footprints = []
+    for gene_index in sorted(gene_indices):
+        gene = genes[gene_index]
+        if 'positions' not in gene:
+            gene['positions'] = genomic_positions(gene['exons'], gene['strand'])
+            CDS_start = genomic_positions(gene['CDSs'], gene['strand'])[0]
+            gene['transcript_start_codon'] = int(np.where(gene['positions'] == CDS_start)[0][0])
+            gene['num_codons'] = sum(end - start + 1 for start, end in gene['CDSs']) // 3
+
+        length = random_state.choice(footprint_lengths, p=footprint_length_weights)
+        codon = random_state.randint(1, gene['num_codons'])
+        five_prime = gene['transcript_start_codon'] + 3 * codon - A_site_offsets[length]
+        five_prime = int(np.clip(five_prime, 0, len(gene['positions']) - length))
+
+        positions = gene['positions'][five_prime:five_prime + length]
+        seq = ''.join(genome[gene['seqname']][p] for p in np.sort(positions))
+        if gene['strand'] == '-':
+            seq = utilities.reverse_complement(seq)
+
+        footprints.append({'seqname': gene['seqname'],
+                           'strand': gene['strand'],
+                           'positions': positions,
+                           'seq': seq,
+                          })
+
+    return footprints
+
+def write_fastqs(random_state, footprints, rRNA_seq, fastq_fns, rRNA_fraction=0.2):
+    ''' Writes each footprint (and rRNA fragments) followed by a linker to
+        fastq_fns['linker'] and by a poly-A tail to fastq_fns['polyA'].
+    '''
+    num_rRNA = int(len(footprints) * rRNA_fraction)
+    seqs = [f['seq'] for f in footprints]
+    for i in range(num_rRNA):
+        length = random_state.choice(footprint_lengths)
+        start = random_state.randint(0, len(rRNA_seq) - length)
+        seqs.append(rRNA_seq[start:start + length])
+
+    order = random_state.permutation(len(seqs))
+
+    tails = {'linker': lambda: trim.smRNA_linker + trim.truseq_R2_rc,
+             'polyA': lambda: 'A' * random_state.randint(10, 30),
+            }
+    for adapter_type in sorted(fastq_fns):
+        with open(fastq_fns[adapter_type], 'w') as fastq_fh:
+            for i in order:
+                read_seq = seqs[i] + tails[adapter_type]()
+                read_seq = (read_seq + random_seq(random_state, read_length))[:read_length]
+                qual = 'I' * read_length
+                fastq_fh.write('@{0}\n{1}\n+\n{2}\n'.format(i, read_seq, qual))
+
+def footprint_mapping(random_state, footprint, tids):
+    ''' An AlignedRead of footprint as tophat would report it, with an
+        untemplated mismatch at the 5' end of about one in ten.
+    '''
+    positions = footprint['positions']
+    ascending = np.sort(positions)
+
+    cigar = []
+    block_length = 1
+    for previous, current in zip(ascending, ascending[1:]):
+        if current == previous + 1:
+            block_length += 1
+        else:
+            cigar.append((0, block_length))
+            cigar.append((3, int(current - previous - 1)))
+            block_length = 1
+    cigar.append((0, block_length))
+
+    seq = footprint['seq']
+    if random_state.rand() < 0.1:
+        others = [b for b in 'TCAG' if b != seq[0]]
+        seq = random_state.choice(others) + seq[1:]
+
+    if footprint['strand'] == '-':
+        seq = utilities.reverse_complement(seq)
+
+    mapping = pysam.AlignedRead()
+    mapping.qname = 'footprint'
+    mapping.seq = seq
+    mapping.qual = 'I' * len(seq)
+    mapping.is_reverse = footprint['strand'] == '-'
+    mapping.tid = tids[footprint['seqname']]
+    mapping.pos = int(ascending[0])
+    mapping.cigar = cigar
+    mapping.rnext = -1
+    mapping.pnext = -1
+    if random_state.rand() < 0.1:
+        mapping.mapq = 1
+        mapping.is_secondary = random_state.rand() < 0.5
+    else:
+        mapping.mapq = 50
+    mapping.tags = [('ZN', int(random_state.randint(0, 3)))]
+
+    return mapping
+
+def write_bam(random_state, footprints, seq_lengths, bam_fn):
+    seqnames = sorted(seq_lengths)
+    tids = {name: i for i, name in enumerate(seqnames)}
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': name, 'LN': seq_lengths[name]} for name in seqnames],
+             }
+
+    mappings = [footprint_mapping(random_state, footprint, tids) for footprint in footprints]
+    mappings.sort(key=lambda m: (m.tid, m.pos))
+
+    bam_file = pysam.Samfile(bam_fn, 'wb', header=header)
+    for i, mapping in enumerate(mappings):
+        mapping.qname = str(i)
+        bam_file.write(mapping)
+    bam_file.close()
+    pysam.index(bam_fn)
+
+def make_all(data_dir, seed=0, num_genes=300, num_reads=100000, num_seqs=4):
+    ''' Writes everything to data_dir, unless it already holds data made with
+        the same arguments. Returns a dictionary of file names.
+    '''
+    file_names = {'genome': '{0}/genome'.format(data_dir),
+                  'genes': '{0}/genes.gff'.format(data_dir),
+                  'bam': '{0}/footprints.bam'.format(data_dir),
+                  'fastq': {'linker': '{0}/reads_linker.fastq'.format(data_dir),
+                            'polyA': '{0}/reads_polyA.fastq'.format(data_dir),
+                           },
+                  'parameters': '{0}/parameters.json'.format(data_dir),
+                 }
+
+    parameters = {'seed': seed,
+                  'num_genes': num_genes,
+                  'num_reads': num_reads,
+                  'num_seqs': num_seqs,
+                 }
+    if os.path.exists(file_names['parameters']):
+        if json.load(open(file_names['parameters'])) == parameters:
+            return file_names
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    random_state = np.random.RandomState(seed)
+
+    # Leave room for about 2.5 kb per gene and the rRNA at the end of the
+    # last sequence.
+    seq_length = int(2500 * num_genes / float(num_seqs)) + 2 * edge_margin
+    seq_lengths = {'chr{0}'.format(i + 1): seq_length for i in range(num_seqs)}
+    rRNA_length = 1800
+    last_seq = sorted(seq_lengths)[-1]
+    seq_lengths[last_seq] += rRNA_length + edge_margin
+
+    genes = layout_genes(random_state, seq_lengths, num_genes)
+    rRNA_start = seq_lengths[last_seq] - edge_margin - rRNA_length
+    rRNA = {'name': 'rRNA',
+            'seqname': last_seq,
+            'start': rRNA_start,
+            'end': rRNA_start + rRNA_length - 1,
+           }
+    # Gene layout stops short of the end of each sequence, so the rRNA
+    # doesn't overlap any genes.
+    genes = [gene for gene in genes if gene['seqname'] != last_seq or gene['end'] < rRNA_start - 100]
+
+    genome = make_genome(random_state, seq_lengths, genes)
+    write_genome(genome, file_names['genome'])
+    write_gff(genes, rRNA, file_names['genes'])
+
+    rRNA_seq = genome[last_seq][rRNA['start']:rRNA['end'] + 1]
+    footprints = make_footprints(random_state, genome, genes, num_reads)
+    write_fastqs(random_state, footprints, rRNA_seq, file_names['fastq'])
+    write_bam(random_state, footprints, seq_lengths, file_names['bam'])
+
+    with open(file_names['parameters'], 'w') as parameters_fh:
+        json.dump(parameters, parameters_fh)
+
+    return file_names
@@ -15,6 +15,7 @@ from collections import Counter
 
 class ThreePExperiment(rna_experiment.RNAExperiment):
     num_stages = 2
+    cost_bam_key = 'extended'
         
     specific_results_files = [
         ('trimmed_reads', 'fastq', '{name}_trimmed.fastq'),
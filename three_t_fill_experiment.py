@@ -15,6 +15,7 @@ import visualize
 
 class ThreeTFillExperiment(rna_experiment.RNAExperiment):
     num_stages = 2
+    cost_bam_key = 'combined'
 
     specific_results_files = [
         ('R1_preprocessed', 'fastq', '{name}_R1_preprocessed.fastq'),
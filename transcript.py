@@ -73,15 +73,12 @@ class Transcript(object):
     def __lt__(self, other):
         return self.comparison_key < other.comparison_key
 
-    def build_coordinate_maps(self, left_buffer=0, right_buffer=0):
-        ''' Make dictionaries mapping from genomic coordinates to transcript
-            coordinates and vice-versa.
+    def set_neighbors(self, closest_left, closest_right, num_overlapping):
+        ''' Set num_overlapping and the genomic positions of the closest
+            features upstream and downstream.
         '''
-        self.num_overlapping = int(self.top_level_feature.attribute.get('overlapping', 0))
+        self.num_overlapping = num_overlapping
 
-        closest_left = int(self.top_level_feature.attribute.get('closest_left', 0))
-        closest_right = int(self.top_level_feature.attribute.get('closest_right', 1e10))
-        
         if self.strand == '+':
             self.upstream = closest_left
             self.downstream = closest_right
@@ -89,6 +86,43 @@ class Transcript(object):
             self.upstream = closest_right
             self.downstream = closest_left
 
+    def read_neighbors(self):
+        ''' Set neighbors from the attributes of the top level feature. '''
+        attribute = self.top_level_feature.attribute
+        self.set_neighbors(int(attribute.get('closest_left', 0)),
+                           int(attribute.get('closest_right', 1e10)),
+                           int(attribute.get('overlapping', 0)),
+                          )
+
+    def find_transcript_downstream(self, right_buffer=0):
+        ''' The value build_coordinate_maps(right_buffer=right_buffer) would
+            give transcript_downstream, without building the maps unless the
+            downstream feature lies within the span of the transcript.
+        '''
+        if self.start <= self.downstream <= self.end:
+            self.build_coordinate_maps(right_buffer=right_buffer)
+            transcript_downstream = self.transcript_downstream
+            self.delete_coordinate_maps()
+            return transcript_downstream
+
+        transcript_length = sum(exon.end - exon.start + 1 for exon in self.exons)
+
+        if self.strand == '+':
+            past_end = self.downstream - (self.end + 1)
+        elif self.strand == '-':
+            past_end = (self.start - 1) - self.downstream
+
+        if 0 <= past_end < right_buffer:
+            transcript_downstream = transcript_length + past_end
+        else:
+            transcript_downstream = transcript_length + right_buffer
+
+        return transcript_downstream
+
+    def build_coordinate_maps(self, left_buffer=0, right_buffer=0):
+        ''' Make dictionaries mapping from genomic coordinates to transcript
+            coordinates and vice-versa.
+        '''
         if self.strand == '+':
             exon_position_lists = [np.arange(exon.start, exon.end + 1) for exon in self.exons]
         elif self.strand == '-':
@@ -295,15 +329,24 @@ class GFFTranscript(Transcript):
         self.start = feature.start
         self.end = feature.end
 
+        self.read_neighbors()
+
 def get_gff_transcripts(all_features, genome_dir):
     region_fetcher = genomes.build_region_fetcher(genome_dir, load_references=True)
     genes = []
     for feature in all_features:
+        # Checked in order of cost, so that only top level features have
+        # their attributes parsed and descendants collected.
         top_level = feature.parent == None
+        if not top_level:
+            continue
+
         dubious = feature.attribute.get('orf_classification') == 'Dubious'
+        if dubious:
+            continue
+
         has_exon = any('exon' in c.feature for c in feature.descendants) 
-        
-        if top_level and has_exon and not dubious:
+        if has_exon:
             gene = GFFTranscript(feature, region_fetcher)
             genes.append(gene)
 
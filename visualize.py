@@ -14,6 +14,7 @@ import Circles.variants as variants
 import codons
 import scipy.stats
 import pausing
+import smoothing
     
 bmap = brewer2mpl.get_map('Set1', 'qualitative', 9)
 colors = bmap.mpl_colors[:5] + bmap.mpl_colors[6:] + ['black']
@@ -632,7 +633,7 @@ def plot_averaged_codon_densities(data_sets,
     for (name, mean_densities, color_index), label in zip(data_sets, labels):
         densities = mean_densities['from_start']['codons']
         start_densities = densities['start_codon', start_xs]
-        start_densities = pausing.smooth(start_densities, smooth_window)
+        start_densities = smoothing.moving_average(start_densities, smooth_window)
         if normalize_to_asymptotic:
             start_densities /= np.mean(densities['start_codon', 500 - 10:500 + 10])
 
@@ -650,7 +651,7 @@ def plot_averaged_codon_densities(data_sets,
         if show_end:
             densities = mean_densities['from_end']['codons']
             end_densities = densities['stop_codon', end_xs]
-            end_densities = pausing.smooth(end_densities, smooth_window)
+            end_densities = smoothing.moving_average(end_densities, smooth_window)
             
             end_ax.plot(end_xs,
                         end_densities,